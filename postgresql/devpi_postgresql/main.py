@@ -1,20 +1,156 @@
 from devpi_common.types import cached_property
-from devpi_server.fileutil import dumps, loads
+from devpi_server.fileutil import ChunkedFile, get_codec, iter_file_chunks
+from devpi_server.fileutil import loads
 from devpi_server.log import threadlog, thread_push_log, thread_pop_log
 from devpi_server.readonly import ReadonlyView
-from devpi_server.readonly import ensure_deeply_readonly, get_mutable_deepcopy
+from devpi_server.readonly import ensure_deeply_readonly
 from functools import partial
 from repoze.lru import LRUCache
 import contextlib
 import os
 import pg8000
 import py
+import select
+import tempfile
+import threading
 import time
 
 
+# channel on which commits are announced to all devpi-server processes
+COMMIT_CHANNEL = "devpi_commit"
+
+
+class ConnectionPool:
+    """ thread safe pool of at most ``maxsize`` open database connections.
+
+    Connections which were idle for more than ``idle_timeout`` seconds are
+    closed, the ones idle for more than ``check_after`` seconds are checked
+    with a query before they are handed out again. The first time a caller
+    has to wait for a connection a warning mentioning ``name`` is logged. """
+
+    def __init__(self, connect, maxsize, idle_timeout=300.0,
+                 check_after=10.0, name="connection"):
+        self.connect = connect
+        self.maxsize = maxsize
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._cv = threading.Condition()
+        # (sqlconn, last_used) of the available connections, the most
+        # recently used last
+        self._idle = []
+        # open connections, including the checked out ones
+        self.size = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.discarded = 0
+
+    def _close_expired(self):
+        # called with the lock held
+        expired_before = time.time() - self.idle_timeout
+        while self._idle and self._idle[0][1] < expired_before:
+            (sqlconn, last_used) = self._idle.pop(0)
+            self._discard(sqlconn)
+
+    def _discard(self, sqlconn):
+        # called with the lock held
+        self.size -= 1
+        self.discarded += 1
+        self._cv.notify()
+        try:
+            sqlconn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, sqlconn):
+        try:
+            c = sqlconn.cursor()
+            c.execute("SELECT 1")
+            c.fetchall()
+            c.close()
+            sqlconn.rollback()
+        except Exception:
+            threadlog.warn("DB: discarding broken pooled connection")
+            return False
+        return True
+
+    def get(self):
+        while 1:
+            with self._cv:
+                self._close_expired()
+                if not self._idle and self.size >= self.maxsize:
+                    if not self.waits:
+                        threadlog.warn(
+                            "DB: all %s connections of the %s pool are in "
+                            "use, waiting for one to be returned. Consider "
+                            "raising the %s setting.",
+                            self.maxsize, self.name, self.name + "_size")
+                    self.waits += 1
+                    start = time.time()
+                    while not self._idle and self.size >= self.maxsize:
+                        self._cv.wait()
+                    self.wait_time += time.time() - start
+                self.checkouts += 1
+                if self._idle:
+                    (sqlconn, last_used) = self._idle.pop()
+                else:
+                    sqlconn = last_used = None
+                    self.size += 1
+            if sqlconn is None:
+                try:
+                    return self.connect()
+                except Exception:
+                    with self._cv:
+                        self.size -= 1
+                        self._cv.notify()
+                    raise
+            if time.time() - last_used < self.check_after:
+                return sqlconn
+            if self._is_healthy(sqlconn):
+                return sqlconn
+            with self._cv:
+                self._discard(sqlconn)
+
+    def put(self, sqlconn):
+        """ return a connection to the pool, a still open transaction
+        is rolled back. """
+        try:
+            sqlconn.rollback()
+        except Exception:
+            with self._cv:
+                self._discard(sqlconn)
+            return
+        with self._cv:
+            self._idle.append((sqlconn, time.time()))
+            self._close_expired()
+            self._cv.notify()
+
+    def close(self):
+        with self._cv:
+            while self._idle:
+                (sqlconn, last_used) = self._idle.pop()
+                self._discard(sqlconn)
+
+    def get_stats(self):
+        with self._cv:
+            return {
+                "size": self.size,
+                "max-size": self.maxsize,
+                "idle": len(self._idle),
+                "in-use": self.size - len(self._idle),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait-time": self.wait_time,
+                "discarded": self.discarded}
+
+
 class Connection:
-    def __init__(self, sqlconn, storage):
+    max_batch_size = 500
+
+    def __init__(self, sqlconn, storage, pool=None):
         self._sqlconn = sqlconn
+        self._pool = pool
         self.dirty_files = {}
         self.changes = {}
         self.storage = storage
@@ -27,7 +163,10 @@ class Connection:
         pass
 
     def close(self):
-        self._sqlconn.close()
+        if self._pool is None:
+            self._sqlconn.close()
+        else:
+            self._pool.put(self._sqlconn)
         del self._sqlconn
         del self.storage
 
@@ -54,18 +193,207 @@ class Connection:
             raise KeyError(relpath)
         return tuple(row[:2])
 
-    def db_write_typedkey(self, relpath, name, next_serial):
-        q = "SELECT set_kv(%s, %s, %s)"
+    def db_read_typedkey_value(self, relpath):
+        """ return (keyname, serial, value) for the latest state of relpath,
+        where value is None if the key was deleted at serial. """
+        q = "SELECT keyname, serial, value FROM kv WHERE key = %s"
+        c = self._sqlconn.cursor()
+        c.execute(q, (relpath,))
+        row = c.fetchone()
+        c.close()
+        if row is None:
+            raise KeyError(relpath)
+        keyname, serial, data = row
+        if data is None:
+            # the key was last written before the value column existed
+            (keyname, back_serial, val) = self.get_changes(serial)[relpath]
+            return keyname, serial, val
+        return keyname, serial, ensure_deeply_readonly(loads(bytes(data)))
+
+    def db_read_typedkey_values(self, relpaths):
+        """ return a dict of relpath to (keyname, serial, value) like
+        ``db_read_typedkey_value`` for all existing relpaths, with one
+        query per ``max_batch_size`` relpaths. """
+        relpaths = list(relpaths)
+        result = {}
+        c = self._sqlconn.cursor()
+        for i in range(0, len(relpaths), self.max_batch_size):
+            batch = relpaths[i:i + self.max_batch_size]
+            q = "SELECT key, keyname, serial, value FROM kv WHERE key IN (%s)"
+            q = q % ",".join(["%s"] * len(batch))
+            c.execute(q, batch)
+            for relpath, keyname, serial, data in c.fetchall():
+                if data is None:
+                    # the key was last written before the value column existed
+                    (keyname, back_serial, val) = self.get_changes(
+                        serial)[relpath]
+                else:
+                    val = ensure_deeply_readonly(loads(bytes(data)))
+                result[relpath] = (keyname, serial, val)
+        c.close()
+        return result
+
+    def db_read_typedkey_values_range(self, after_relpath, limit):
+        """ return a list of up to limit (relpath, keyname, serial, value)
+        tuples like ``db_read_typedkey_value`` for the relpaths sorted
+        after after_relpath, which can be None to start at the first. """
+        if after_relpath is None:
+            after_relpath = ""
+        q = """
+            SELECT key, keyname, serial, value FROM kv
+            WHERE key > %s ORDER BY key LIMIT %s"""
+        c = self._sqlconn.cursor()
+        c.execute(q, (after_relpath, limit))
+        rows = c.fetchall()
+        c.close()
+        result = []
+        for relpath, keyname, serial, data in rows:
+            if data is None:
+                # the key was last written before the value column existed
+                (keyname, back_serial, val) = self.get_changes(
+                    serial)[relpath]
+            else:
+                val = ensure_deeply_readonly(loads(bytes(data)))
+            result.append((relpath, keyname, serial, val))
+        return result
+
+    def db_read_typedkey_value_at(self, relpath, at_serial):
+        """ return (serial, value) of the last change of relpath at or before
+        at_serial, where value is None if the key was deleted at serial.
+        Raise KeyError if relpath didn't exist at at_serial and return None
+        if the history doesn't reach back far enough to know. """
+        q = """
+            SELECT serial, value FROM kv_history
+            WHERE key = %s AND serial <= %s
+            ORDER BY serial DESC LIMIT 1"""
+        c = self._sqlconn.cursor()
+        c.execute(q, (relpath, at_serial))
+        row = c.fetchone()
+        c.close()
+        if row is not None:
+            return row[0], ensure_deeply_readonly(loads(bytes(row[1])))
+        snapshot_serial = self.db_read_snapshot_serial()
+        if snapshot_serial is not None:
+            if at_serial >= snapshot_serial:
+                # the history is complete from the snapshot onwards
+                raise KeyError(relpath)
+            # a compaction may have pruned the history before the snapshot
+            return None
+        if self.db_read_history_start_serial() == 0:
+            raise KeyError(relpath)
+        return None
+
+    def db_read_history_start_serial(self):
+        """ return the first serial recorded in the history or None. """
+        start_serial = self.storage.history_start_serial
+        if start_serial is None:
+            c = self._sqlconn.cursor()
+            c.execute("SELECT MIN(serial) FROM kv_history")
+            start_serial = c.fetchone()[0]
+            c.close()
+            # reset by pruning
+            self.storage.history_start_serial = start_serial
+        return start_serial
+
+    def db_read_snapshot_serial(self):
+        """ return the serial of the latest snapshot or None. """
+        c = self._sqlconn.cursor()
+        c.execute("SELECT MAX(serial) FROM snapshot")
+        serial = c.fetchone()[0]
+        c.close()
+        return serial
+
+    def db_read_relpaths_without_history(self, serial):
+        """ return the relpaths whose state at serial is neither in
+        the kv table nor in the history. """
+        q = """
+            SELECT key FROM kv
+            WHERE (serial > %s OR value IS NULL) AND NOT EXISTS (
+                SELECT 1 FROM kv_history
+                WHERE kv_history.key = kv.key AND kv_history.serial <= %s)"""
+        c = self._sqlconn.cursor()
+        c.execute(q, (serial, serial))
+        relpaths = [x[0] for x in c.fetchall()]
+        c.close()
+        return relpaths
+
+    def db_write_snapshot(self, serial, entries):
+        """ make sure the state of all keys at serial is in the history
+        and record the snapshot.  The entries are (relpath, last_serial,
+        value) tuples for ``db_read_relpaths_without_history``. """
+        c = self._sqlconn.cursor()
+        c.execute("""
+            INSERT INTO kv_history (key, serial, value)
+            SELECT key, serial, value FROM kv
+            WHERE serial <= %s AND value IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM kv_history
+                WHERE kv_history.key = kv.key
+                AND kv_history.serial = kv.serial)""", (serial,))
+        for relpath, last_serial, value in entries:
+            data = pg8000.Binary(self.storage.codec.dumps(value))
+            c.execute(
+                "INSERT INTO kv_history (key, serial, value) VALUES (%s, %s, %s)",
+                (relpath, last_serial, data))
+            # keys last written before the value column existed need their
+            # value, as the changelog entry it is read from will be pruned
+            c.execute(
+                "UPDATE kv SET value = %s "
+                "WHERE key = %s AND serial = %s AND value IS NULL",
+                (data, relpath, last_serial))
+        c.execute("DELETE FROM snapshot WHERE serial = %s", (serial,))
+        c.execute("INSERT INTO snapshot (serial) VALUES (%s)", (serial,))
+        c.close()
+
+    def db_prune_changelog(self, serial):
+        """ delete the changelog entries before the snapshot at serial
+        and the history entries superseded at serial.  Returns the number
+        of deleted changelog entries. """
+        assert self.db_read_snapshot_serial() == serial
+        # the first serial of the history may change
+        self.storage.history_start_serial = None
+        c = self._sqlconn.cursor()
+        c.execute("DELETE FROM changelog WHERE serial < %s", (serial,))
+        count = c.rowcount
+        c.execute("""
+            DELETE FROM kv_history WHERE serial < %s AND EXISTS (
+                SELECT 1 FROM kv_history AS newer
+                WHERE newer.key = kv_history.key
+                AND newer.serial > kv_history.serial AND newer.serial <= %s)
+            """, (serial, serial))
+        c.execute("DELETE FROM snapshot WHERE serial < %s", (serial,))
+        c.close()
+        return count
+
+    def db_write_typedkey_values(self, entries):
+        """ write the (relpath, keyname, serial, value) entries to the kv
+        table without history and changelog, used for importing a
+        snapshot. """
+        c = self._sqlconn.cursor()
+        for relpath, keyname, serial, value in entries:
+            data = pg8000.Binary(self.storage.codec.dumps(value))
+            c.execute("SELECT set_kv(%s, %s, %s, %s)",
+                      (relpath, keyname, serial, data))
+        c.close()
+
+    def db_write_typedkey(self, relpath, name, next_serial, value):
+        data = pg8000.Binary(self.storage.codec.dumps(value))
         c = self._sqlconn.cursor()
-        c.execute(q, (relpath, name, next_serial))
+        c.execute("SELECT set_kv(%s, %s, %s, %s)",
+                  (relpath, name, next_serial, data))
+        c.execute("DELETE FROM kv_history WHERE key = %s AND serial = %s",
+                  (relpath, next_serial))
+        c.execute("INSERT INTO kv_history (key, serial, value) VALUES (%s, %s, %s)",
+                  (relpath, next_serial, data))
         c.close()
 
     def write_changelog_entry(self, serial, entry):
         threadlog.debug("writing changelog for serial %s", serial)
-        data = dumps(entry)
+        data = self.storage.codec.dumps(entry)
         c = self._sqlconn.cursor()
         c.execute("INSERT INTO changelog (serial, data) VALUES (%s, %s)",
                   (serial, pg8000.Binary(data)))
+        # delivered to the listening processes on commit
+        c.execute("SELECT pg_notify(%s, %s)", (COMMIT_CHANNEL, str(serial)))
         c.close()
         self._sqlconn.commit()
 
@@ -81,16 +409,62 @@ class Connection:
         c.close()
         return result is not None
 
+    def io_file_new_open(self, path):
+        """ return a new temporary file for spooling content which is then
+        passed to ``io_file_set``. """
+        return tempfile.TemporaryFile(dir=str(self.storage.basedir))
+
     def io_file_set(self, path, content):
+        """ store the bytes or the content of the file like object
+        ``content`` in chunks, so it never has to be in memory at once. """
         assert not os.path.isabs(path)
         assert not path.endswith("-tmp")
         c = self._sqlconn.cursor()
+        c.execute("DELETE FROM file_chunks WHERE path = %s", (path,))
+        q = "INSERT INTO file_chunks (path, idx, data) VALUES (%s, %s, %s)"
+        size = 0
+        chunks = iter_file_chunks(content, self.storage.file_chunk_size)
+        for index, chunk in enumerate(chunks):
+            c.execute(q, (path, index, pg8000.Binary(chunk)))
+            size += len(chunk)
+        # the data column is only used by files stored before chunking
         q = "SELECT set_files(%s, %s, %s)"
-        c.execute(q, (path, len(content), pg8000.Binary(content)))
+        c.execute(q, (path, size, pg8000.Binary(b"")))
+        c.close()
+
+    def db_read_file_chunk(self, path, index):
+        q = "SELECT data FROM file_chunks WHERE path = %s AND idx = %s"
+        c = self._sqlconn.cursor()
+        c.execute(q, (path, index))
+        row = c.fetchone()
         c.close()
+        if row is not None:
+            return bytes(row[0])
+
+    def _read_file_chunk(self, path, index):
+        if getattr(self, "_sqlconn", None) is not None:
+            # the file might only be written in our uncommitted transaction
+            return self.db_read_file_chunk(path, index)
+        with self.storage.get_connection() as conn:
+            return conn.db_read_file_chunk(path, index)
 
     def io_file_open(self, path):
-        return py.io.BytesIO(self.io_file_get(path))
+        """ return a file like object which reads the chunks only when
+        needed, it can still be used after the transaction ended. """
+        assert not os.path.isabs(path)
+        c = self._sqlconn.cursor()
+        q = "SELECT size, length(data) FROM files WHERE path = %s"
+        c.execute(q, (path,))
+        row = c.fetchone()
+        c.close()
+        if row is None:
+            raise IOError()
+        (size, legacy_size) = row
+        if legacy_size:
+            return py.io.BytesIO(self.io_file_get(path))
+        return ChunkedFile(
+            size, self.storage.file_chunk_size,
+            partial(self._read_file_chunk, path))
 
     def io_file_get(self, path):
         assert not os.path.isabs(path)
@@ -98,10 +472,17 @@ class Connection:
         q = "SELECT data FROM files WHERE path = %s"
         c.execute(q, (path,))
         content = c.fetchone()
-        c.close()
         if content is None:
+            c.close()
             raise IOError()
-        return content[0]
+        if len(content[0]):
+            c.close()
+            return content[0]
+        q = "SELECT data FROM file_chunks WHERE path = %s ORDER BY idx"
+        c.execute(q, (path,))
+        content = b"".join(bytes(row[0]) for row in c.fetchall())
+        c.close()
+        return content
 
     def io_file_size(self, path):
         assert not os.path.isabs(path)
@@ -116,6 +497,7 @@ class Connection:
     def io_file_delete(self, path):
         assert not os.path.isabs(path)
         c = self._sqlconn.cursor()
+        c.execute("DELETE FROM file_chunks WHERE path = %s", (path,))
         q = "DELETE FROM files WHERE path = %s"
         c.execute(q, (path,))
         c.close()
@@ -149,6 +531,32 @@ class Connection:
         return Writer(self.storage, self)
 
 
+SET_KV_FUNCTION = """
+    CREATE FUNCTION set_kv(_key TEXT, _keyname TEXT, _serial INT, _value BYTEA) RETURNS VOID AS
+    $$
+    BEGIN
+        LOOP
+            -- first try to update the key
+            UPDATE kv SET keyname = _keyname, serial = _serial, value = _value WHERE key = _key;
+            IF found THEN
+                RETURN;
+            END IF;
+            -- not there, so try to insert the key
+            -- if someone else inserts the same key concurrently,
+            -- we could get a unique-key failure
+            BEGIN
+                INSERT INTO kv(key, keyname, serial, value) VALUES (_key, _keyname, _serial, _value);
+                RETURN;
+            EXCEPTION WHEN unique_violation THEN
+                -- Do nothing, and loop to try the UPDATE again.
+            END;
+        END LOOP;
+    END;
+    $$
+    LANGUAGE plpgsql;
+"""
+
+
 class Storage:
     database = "devpi"
     host = "localhost"
@@ -156,6 +564,11 @@ class Storage:
     unix_sock = None
     user = "devpi"
     password = None
+    read_pool_size = 10
+    write_pool_size = 2
+    pool_idle_timeout = 300.0
+    # files are stored in chunks of this many bytes
+    file_chunk_size = 1024 * 1024
 
     def __init__(self, basedir, notify_on_commit, cache_size, settings=None):
         if settings is None:
@@ -163,10 +576,25 @@ class Storage:
         for key in ("database", "host", "port", "unix_sock", "user", "password"):
             if key in settings:
                 setattr(self, key, settings[key])
+        for key in ("read_pool_size", "write_pool_size"):
+            if key in settings:
+                setattr(self, key, int(settings[key]))
+        if "pool_idle_timeout" in settings:
+            self.pool_idle_timeout = float(settings["pool_idle_timeout"])
+        self._read_pool = ConnectionPool(
+            self._connect, self.read_pool_size,
+            idle_timeout=self.pool_idle_timeout, name="read_pool")
+        # writers wait for each other anyway, so they need fewer
+        self._write_pool = ConnectionPool(
+            self._connect, self.write_pool_size,
+            idle_timeout=self.pool_idle_timeout, name="write_pool")
+        self.codec = get_codec(settings)
         self.basedir = basedir
         self._notify_on_commit = notify_on_commit
         self._changelog_cache = LRUCache(cache_size)  # is thread safe
         self.last_commit_timestamp = time.time()
+        self.history_start_serial = None
+        self._listen_conn = None
         self.ensure_tables_exist()
         with self.get_connection() as conn:
             c = conn._sqlconn.cursor()
@@ -182,8 +610,8 @@ class Storage:
     def perform_crash_recovery(self):
         pass
 
-    def get_connection(self, closing=True, write=False):
-        sqlconn = pg8000.connect(
+    def _connect(self):
+        return pg8000.connect(
             user=self.user,
             database=self.database,
             host=self.host,
@@ -191,8 +619,12 @@ class Storage:
             unix_sock=self.unix_sock,
             password=self.password,
             timeout=60)
+
+    def get_connection(self, closing=True, write=False):
+        pool = self._write_pool if write else self._read_pool
+        sqlconn = pool.get()
         sqlconn.text_factory = bytes
-        conn = Connection(sqlconn, self)
+        conn = Connection(sqlconn, self, pool=pool)
         if write:
             q = 'SELECT pg_advisory_xact_lock(1);'
             c = conn._sqlconn.cursor()
@@ -201,6 +633,125 @@ class Storage:
             return contextlib.closing(conn)
         return conn
 
+    def close(self):
+        """ close the idle pooled connections and the one listening
+        for commits. """
+        self._read_pool.close()
+        self._write_pool.close()
+        if self._listen_conn is not None:
+            self._listen_conn.close()
+            self._listen_conn = None
+
+    def get_pool_stats(self):
+        return {
+            "read": self._read_pool.get_stats(),
+            "write": self._write_pool.get_stats()}
+
+    def wait_for_commit(self, timeout):
+        """ wait up to timeout seconds for a notification about a commit of
+        any process.  Return True if there might have been one. """
+        if self._listen_conn is None:
+            sqlconn = self._connect()
+            sqlconn.autocommit = True
+            c = sqlconn.cursor()
+            c.execute("LISTEN %s" % COMMIT_CHANNEL)
+            c.close()
+            self._listen_conn = sqlconn
+            # commits before we started listening are missed
+            return True
+        sqlconn = self._listen_conn
+        sock = getattr(sqlconn, "_usock", None)
+        if sock is None:
+            time.sleep(timeout)
+            return True
+        try:
+            (readable, _, _) = select.select([sock], [], [], timeout)
+            if not readable:
+                return False
+            # the notifications are only processed during a query
+            c = sqlconn.cursor()
+            c.execute("SELECT 1")
+            c.close()
+        except Exception:
+            self._listen_conn = None
+            try:
+                sqlconn.close()
+            except Exception:
+                pass
+            raise
+        notifications = sqlconn.notifications
+        found = len(notifications) > 0
+        notifications.clear()
+        return found
+
+    def import_snapshot(self, serial, changes, batches):
+        """ initialize the empty database with the state at serial.
+
+        The batches are lists of (relpath, keyname, serial, value) entries
+        and changes is the changelog entry for serial.  Returns the number
+        of imported keys. """
+        count = 0
+        with self.get_connection(write=True) as conn:
+            if conn.last_changelog_serial != -1:
+                raise ValueError(
+                    "a snapshot can only be imported into an empty database")
+            for entries in batches:
+                conn.db_write_typedkey_values(entries)
+                count += len(entries)
+            conn.db_write_snapshot(serial, [])
+            # commits the database transaction
+            conn.write_changelog_entry(serial, (changes, []))
+        self.next_serial = serial + 1
+        self._changelog_cache.put(serial, ensure_deeply_readonly(changes))
+        self.last_commit_timestamp = time.time()
+        self._notify_on_commit(serial)
+        threadlog.info(
+            "DB: Imported snapshot of %s keys at serial %s", count, serial)
+        return count
+
+    def recode(self, batch_size=1000):
+        """ re-encode all stored data with the configured codec,
+        yields (table, count) when done with a table. """
+        for table, keys, column in (
+                ("changelog", ("serial",), "data"),
+                ("kv", ("key",), "value"),
+                ("kv_history", ("key", "serial"), "value")):
+            count = 0
+            last_key = None
+            keylist = ", ".join(keys)
+            placeholders = ", ".join(["%s"] * len(keys))
+            while 1:
+                with self.get_connection(write=True) as conn:
+                    c = conn._sqlconn.cursor()
+                    q = "SELECT %s, %s FROM %s" % (keylist, column, table)
+                    args = ()
+                    if last_key is not None:
+                        q += " WHERE (%s) > (%s)" % (keylist, placeholders)
+                        args = last_key
+                    q += " ORDER BY %s LIMIT %d" % (keylist, batch_size)
+                    c.execute(q, args)
+                    rows = c.fetchall()
+                    for row in rows:
+                        last_key = tuple(row[:len(keys)])
+                        data = row[len(keys)]
+                        if data is None:
+                            continue
+                        data = bytes(data)
+                        new_data = self.codec.dumps(loads(data))
+                        if new_data == data:
+                            continue
+                        c.execute(
+                            "UPDATE %s SET %s = %%s WHERE (%s) = (%s)" % (
+                                table, column, keylist, placeholders),
+                            (pg8000.Binary(new_data),) + last_key)
+                        count += 1
+                    c.close()
+                    conn.commit()
+                if len(rows) < batch_size:
+                    break
+            threadlog.info("DB: Recoded %s rows of %s table", count, table)
+            yield table, count
+
     def ensure_tables_exist(self):
         with self.get_connection() as conn:
             sqlconn = conn._sqlconn
@@ -217,7 +768,8 @@ class Storage:
                     CREATE TABLE kv (
                         key TEXT NOT NULL PRIMARY KEY,
                         keyname TEXT,
-                        serial INTEGER
+                        serial INTEGER,
+                        value BYTEA
                     )
                 """)
                 c.execute("""
@@ -233,30 +785,7 @@ class Storage:
                         data BYTEA NOT NULL
                     )
                 """)
-                c.execute("""
-                    CREATE FUNCTION set_kv(_key TEXT, _keyname TEXT, _serial INT) RETURNS VOID AS
-                    $$
-                    BEGIN
-                        LOOP
-                            -- first try to update the key
-                            UPDATE kv SET keyname = _keyname, serial = _serial WHERE key = _key;
-                            IF found THEN
-                                RETURN;
-                            END IF;
-                            -- not there, so try to insert the key
-                            -- if someone else inserts the same key concurrently,
-                            -- we could get a unique-key failure
-                            BEGIN
-                                INSERT INTO kv(key, keyname, serial) VALUES (_key, _keyname, _serial);
-                                RETURN;
-                            EXCEPTION WHEN unique_violation THEN
-                                -- Do nothing, and loop to try the UPDATE again.
-                            END;
-                        END LOOP;
-                    END;
-                    $$
-                    LANGUAGE plpgsql;
-                """)
+                c.execute(SET_KV_FUNCTION)
                 c.execute("""
                     CREATE FUNCTION set_files(_path TEXT, _size INTEGER, _data BYTEA) RETURNS VOID AS
                     $$
@@ -284,6 +813,84 @@ class Storage:
                 sqlconn.commit()
             finally:
                 c.close()
+        self.upgrade_tables()
+
+    def upgrade_tables(self):
+        with self.get_connection() as conn:
+            sqlconn = conn._sqlconn
+            c = sqlconn.cursor()
+            try:
+                c.execute("select value from kv limit 1")
+                c.fetchall()
+            except pg8000.ProgrammingError:
+                sqlconn.rollback()
+                threadlog.info("DB: Adding value column to kv table")
+                c.execute("ALTER TABLE kv ADD COLUMN value BYTEA")
+                c.execute("DROP FUNCTION set_kv(TEXT, TEXT, INT)")
+                c.execute(SET_KV_FUNCTION)
+                sqlconn.commit()
+            finally:
+                c.close()
+        with self.get_connection() as conn:
+            sqlconn = conn._sqlconn
+            c = sqlconn.cursor()
+            try:
+                c.execute("select * from kv_history limit 1")
+                c.fetchall()
+            except pg8000.ProgrammingError:
+                sqlconn.rollback()
+                threadlog.info("DB: Creating kv_history table")
+                c.execute("""
+                    CREATE TABLE kv_history (
+                        key TEXT NOT NULL,
+                        serial INTEGER NOT NULL,
+                        value BYTEA NOT NULL,
+                        PRIMARY KEY (key, serial)
+                    )
+                """)
+                c.execute("""
+                    CREATE INDEX kv_history_serial_idx ON kv_history (serial)
+                """)
+                sqlconn.commit()
+            finally:
+                c.close()
+        with self.get_connection() as conn:
+            sqlconn = conn._sqlconn
+            c = sqlconn.cursor()
+            try:
+                c.execute("select * from snapshot limit 1")
+                c.fetchall()
+            except pg8000.ProgrammingError:
+                sqlconn.rollback()
+                threadlog.info("DB: Creating snapshot table")
+                c.execute("""
+                    CREATE TABLE snapshot (
+                        serial INTEGER NOT NULL PRIMARY KEY
+                    )
+                """)
+                sqlconn.commit()
+            finally:
+                c.close()
+        with self.get_connection() as conn:
+            sqlconn = conn._sqlconn
+            c = sqlconn.cursor()
+            try:
+                c.execute("select * from file_chunks limit 1")
+                c.fetchall()
+            except pg8000.ProgrammingError:
+                sqlconn.rollback()
+                threadlog.info("DB: Creating file_chunks table")
+                c.execute("""
+                    CREATE TABLE file_chunks (
+                        path TEXT NOT NULL,
+                        idx INTEGER NOT NULL,
+                        data BYTEA NOT NULL,
+                        PRIMARY KEY (path, idx)
+                    )
+                """)
+                sqlconn.commit()
+            finally:
+                c.close()
 
 
 def devpiserver_storage_backend(settings):
@@ -301,16 +908,16 @@ class Writer:
 
     def record_set(self, typedkey, value=None):
         """ record setting typedkey to value (None means it's deleted) """
-        assert not isinstance(value, ReadonlyView), value
         try:
             _, back_serial = self.conn.db_read_typedkey(typedkey.relpath)
         except KeyError:
             back_serial = -1
-        self.conn.db_write_typedkey(typedkey.relpath, typedkey.name,
-                                    self.storage.next_serial)
         # at __exit__ time we write out changes to the _changelog_cache
-        # so we protect here against the caller modifying the value later
-        value = get_mutable_deepcopy(value)
+        # so we protect here against the caller modifying the value later,
+        # parts which are already frozen are shared and not copied
+        value = ensure_deeply_readonly(value)
+        self.conn.db_write_typedkey(typedkey.relpath, typedkey.name,
+                                    self.storage.next_serial, value)
         self.changes[typedkey.relpath] = (typedkey.name, back_serial, value)
 
     def __enter__(self):
@@ -323,6 +930,9 @@ class Writer:
             entry = self.changes, []
             self.conn.write_changelog_entry(self.storage.next_serial, entry)
             commit_serial = self.storage.next_serial
+            # the values are already frozen, so the decoding can be skipped
+            self.conn.cache_commit_changes(
+                commit_serial, ensure_deeply_readonly(self.changes))
             self.storage.next_serial += 1
             message = "committed: keys: %s"
             args = [",".join(map(repr, list(self.changes)))]
@@ -0,0 +1,2 @@
+support reading many keys with one query for ``Transaction.get_many`` and
+``Transaction.exists_many``.
@@ -0,0 +1,2 @@
+support the ``codec``, ``compression`` and ``compress_min_size`` settings and
+``--recode-changelog`` of devpi-server.
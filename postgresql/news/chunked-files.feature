@@ -0,0 +1 @@
+release files are stored in chunks of 1MiB in the new ``file_chunks`` table and downloads read them chunk by chunk, so big files never have to be in memory at once. Files stored by older versions are still readable.
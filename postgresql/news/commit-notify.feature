@@ -0,0 +1 @@
+commits are announced with ``NOTIFY`` and every devpi-server process sharing the database ``LISTEN`` s for them, so waiting requests of all processes learn about new commits immediately.
@@ -0,0 +1 @@
+support changelog snapshots and compaction with ``--compact-changelog``.
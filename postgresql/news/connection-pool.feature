@@ -0,0 +1 @@
+database connections are kept in a read and a write pool instead of connecting for every transaction. The sizes are set with the ``read_pool_size`` and ``write_pool_size`` settings, idle connections are closed after ``pool_idle_timeout`` seconds. A warning is logged the first time a request has to wait for a pooled connection. The pool statistics are shown in ``/+status``.
@@ -0,0 +1,3 @@
+store the latest value of each key along with the key in the ``kv`` table,
+so reading the current state of a key doesn't need to deserialize the
+whole changelog entry. Existing databases get the new column on startup.
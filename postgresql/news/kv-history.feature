@@ -0,0 +1,2 @@
+record every change of a key in a new ``kv_history`` table for fast lookups
+of historical values.
@@ -0,0 +1 @@
+support importing a snapshot of the master state for ``--replica-bootstrap``.
@@ -52,7 +52,7 @@ def postgresql():
             settings = dict(host=host, port=port, user=getpass.getuser())
             main.Storage(
                 tmpdir, notify_on_commit=False,
-                cache_size=10000, settings=settings)
+                cache_size=10000, settings=settings).close()
             yield settings
             for conn, db, ts in Storage._connections:
                 try:
@@ -75,6 +75,11 @@ def postgresql():
 class Storage(main.Storage):
     _dbs_created = set()
     _connections = []
+    _storages = []
+
+    def __init__(self, *args, **kwargs):
+        main.Storage.__init__(self, *args, **kwargs)
+        self._storages.append(self)
 
     @property
     def database(self):
@@ -100,6 +105,9 @@ class Storage(main.Storage):
 def db_cleanup():
     # this fixture is doing cleanups after tests, so it doesn't yield anything
     yield
+    # pooled connections would keep the databases in use
+    while Storage._storages:
+        Storage._storages.pop().close()
     dbs_to_skip = set()
     for i, (conn, db, ts) in reversed(list(enumerate(Storage._connections))):
         sqlconn = getattr(conn, '_sqlconn', None)
@@ -0,0 +1,128 @@
+from devpi_postgresql.main import ConnectionPool
+import pg8000
+import pytest
+import subprocess
+import threading
+import time
+
+
+@pytest.yield_fixture
+def connect(postgresql):
+    # a database of our own, connections to the "devpi" template
+    # database would prevent creating the databases of other tests
+    database = "test_connection_pool"
+    args = ['-h', postgresql['host'], '-p', str(postgresql['port'])]
+    subprocess.check_call(['createdb'] + args + [database])
+    connections = []
+
+    def connect():
+        sqlconn = pg8000.connect(
+            user=postgresql['user'], database=database,
+            host=postgresql['host'], port=int(postgresql['port']),
+            timeout=60)
+        connections.append(sqlconn)
+        return sqlconn
+    yield connect
+    for sqlconn in connections:
+        try:
+            sqlconn.close()
+        except Exception:
+            pass
+    subprocess.check_call(['dropdb'] + args + [database])
+
+
+def query(sqlconn, q):
+    c = sqlconn.cursor()
+    try:
+        c.execute(q)
+        return c.fetchone()[0]
+    finally:
+        c.close()
+
+
+def test_get_blocks_at_maxsize(caplog, connect):
+    pool = ConnectionPool(connect, 1, name="read_pool")
+    sqlconn = pool.get()
+    result = []
+    thread = threading.Thread(target=lambda: result.append(pool.get()))
+    thread.start()
+    while not pool.get_stats()["waits"]:
+        time.sleep(0.01)
+    assert result == []
+    assert pool.get_stats()["in-use"] == 1
+    pool.put(sqlconn)
+    thread.join()
+    # the waiting caller got the returned connection
+    assert result == [sqlconn]
+    stats = pool.get_stats()
+    assert stats["size"] == 1
+    assert stats["waits"] == 1
+    assert stats["checkouts"] == 2
+    # the wait is logged with the setting to raise
+    assert caplog.text.count("read_pool_size") == 1
+    pool.put(sqlconn)
+    pool.close()
+
+
+def test_broken_idle_connection_is_discarded(connect):
+    pool = ConnectionPool(connect, 2, check_after=0)
+    sqlconn = pool.get()
+    pid = query(sqlconn, "SELECT pg_backend_pid()")
+    pool.put(sqlconn)
+    other = connect()
+    assert query(other, "SELECT pg_terminate_backend(%s)" % pid)
+    other.rollback()
+    sqlconn2 = pool.get()
+    assert sqlconn2 is not sqlconn
+    assert query(sqlconn2, "SELECT 1") == 1
+    stats = pool.get_stats()
+    assert stats["discarded"] == 1
+    assert stats["size"] == 1
+    pool.put(sqlconn2)
+    pool.close()
+
+
+def test_idle_timeout(connect):
+    pool = ConnectionPool(connect, 2, idle_timeout=0.1)
+    sqlconn = pool.get()
+    pool.put(sqlconn)
+    assert pool.get_stats()["idle"] == 1
+    time.sleep(0.2)
+    sqlconn2 = pool.get()
+    assert sqlconn2 is not sqlconn
+    stats = pool.get_stats()
+    assert stats["discarded"] == 1
+    assert stats["size"] == 1
+    # the expired connection was closed
+    with pytest.raises(Exception):
+        query(sqlconn, "SELECT 1")
+    pool.put(sqlconn2)
+    pool.close()
+
+
+def test_put_rolls_back(connect):
+    pool = ConnectionPool(connect, 1)
+    sqlconn = pool.get()
+    query(sqlconn, "SELECT pg_advisory_xact_lock(1)")
+    other = connect()
+    assert query(other, "SELECT pg_try_advisory_xact_lock(1)") is False
+    other.rollback()
+    # the transaction ends and releases the lock
+    pool.put(sqlconn)
+    assert query(other, "SELECT pg_try_advisory_xact_lock(1)") is True
+    other.rollback()
+    assert pool.get() is sqlconn
+    pool.put(sqlconn)
+    pool.close()
+
+
+def test_close(connect):
+    pool = ConnectionPool(connect, 2)
+    connections = [pool.get(), pool.get()]
+    for sqlconn in connections:
+        pool.put(sqlconn)
+    assert pool.get_stats()["idle"] == 2
+    pool.close()
+    stats = pool.get_stats()
+    assert stats["size"] == 0
+    assert stats["discarded"] == 2
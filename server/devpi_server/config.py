@@ -53,6 +53,14 @@ def addoptions(parser, pluginmanager):
                  "and the web server does not set or you want to override "
                  "the custom X-outside-url header.")
 
+    web.addoption("--file-offload", dest="file_offload", default=None,
+            choices=["x-accel-redirect", "x-sendfile"],
+            help="let the web server in front of devpi-server send release "
+                 "files which are stored on the local filesystem. Use "
+                 "'x-accel-redirect' for nginx (the config from --gen-config "
+                 "contains the needed internal location) or 'x-sendfile' "
+                 "for Apache with mod_xsendfile or lighttpd.")
+
     web.addoption("--debug", action="store_true",
             help="run wsgi application with debug logging")
 
@@ -107,6 +115,33 @@ def addoptions(parser, pluginmanager):
             help="run as a replica of the specified master server",
             default=None)
 
+    deploy.addoption("--replica-bootstrap", action="store_true",
+            help="initialize an empty replica from a snapshot of the master "
+                 "state instead of fetching every changelog entry. Event "
+                 "hooks don't run for the state in the snapshot, so for "
+                 "example devpi-web needs '--recreate-search-index' "
+                 "afterwards.")
+
+    deploy.addoption("--replica-stream", action="store_true",
+            help="keep one connection to the master open on which it "
+                 "sends new changelog entries as they are committed, "
+                 "instead of polling for every entry. Proxies between "
+                 "replica and master must not buffer the responses.")
+
+    deploy.addoption("--replica-file-workers", type=int, metavar="NUM",
+            default=0,
+            help="number of threads which download the release files "
+                 "from the master in the background. By default (0) files "
+                 "are downloaded while importing the changelog entries, "
+                 "so a file exists once its serial is imported. With "
+                 "workers a file may still be missing and is fetched from "
+                 "the master on demand.")
+
+    deploy.addoption("--replica-cascade", action="store_true",
+            help="serve the changelog and files to other replicas which "
+                 "use this replica as their master. Writes are still "
+                 "relayed upstream to the master.")
+
     deploy.addoption("--replica-cert", action="store", dest="replica_cert",
             metavar="pem_file",
             help="when running as a replica, use the given .pem file as the "
@@ -162,6 +197,15 @@ def addoptions(parser, pluginmanager):
                  "improve performance. Each entry uses 1kb of memory on "
                  "average. So by default about 10MB are used.")
 
+    deploy.addoption("--keyfs-value-cache-size", type=int, metavar="NUM",
+            action="store", default=10000,
+            help="number of key values kept in the cache shared by all "
+                 "read transactions, for example user and index "
+                 "configurations and release file metadata. The limit "
+                 "counts values, not bytes. Most are below 1kb, but the "
+                 "metadata of a version with many release files can be "
+                 "much larger, so lower the limit if memory is tight.")
+
     backends = sorted(
         pluginmanager.hook.devpiserver_storage_backend(settings=None),
         key=itemgetter("name"))
@@ -171,6 +215,32 @@ def addoptions(parser, pluginmanager):
                  "your '--serverdir' upon initialization.\n" + ", ".join(
                  '"%s": %s' % (x['name'], x['description']) for x in backends))
 
+    deploy.addoption("--recode-changelog", action="store_true",
+            help="re-encode all changelog entries and stored values with "
+                 "the codec set in the storage settings, i.e. "
+                 "'--storage sqlite:codec=marshal,compression=zlib', "
+                 "and exit.")
+
+    deploy.addoption("--benchmark-codecs", action="store_true",
+            help="compare decode speed and size of the available codecs "
+                 "with the latest changelog entries and exit.")
+
+    deploy.addoption("--compact-changelog", action="store_true",
+            help="write a snapshot of the state at an older serial, delete "
+                 "the changelog entries before it and exit. See "
+                 "'--compact-changelog-keep'.")
+
+    deploy.addoption("--compact-changelog-keep", type=int, metavar="NUM",
+            action="store", default=10000,
+            help="number of latest changelog entries kept when compacting "
+                 "the changelog. Replicas which are further behind can't "
+                 "catch up anymore and need to be set up again.")
+
+    deploy.addoption("--compact-changelog-interval", type=int,
+            metavar="SECONDS", action="store", default=0,
+            help="compact the changelog every SECONDS while running, "
+                 "0 disables the periodic compaction.")
+
     expimp = parser.addgroup("serverstate export / import options")
     expimp.addoption("--export", type=str, metavar="PATH",
             help="export devpi-server database state into PATH. "
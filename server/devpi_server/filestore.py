@@ -12,6 +12,7 @@ import py
 import re
 import sys
 from devpi_common.types import cached_property, parse_hash_spec
+from .fileutil import iter_file_chunks
 from .log import threadlog
 
 
@@ -23,6 +24,9 @@ else:
 log = threadlog
 _nodefault = object()
 
+DEFAULT_HASH_TYPE = "sha256"
+
+
 def get_default_hash_spec(content):
     #return "md5=" + hashlib.md5(content).hexdigest()
     return "sha256=" + hashlib.sha256(content).hexdigest()
@@ -89,12 +93,32 @@ class FileStore:
             return None
         return FileEntry(self.xom, key, readonly=readonly)
 
+    def get_file_entries(self, relpaths, readonly=True):
+        """ return a list with the result of ``get_file_entry`` for each
+        of the relpaths, reading all existing entries at once. """
+        relpaths = list(relpaths)
+        keys = [self.keyfs.match_key(relpath) for relpath in relpaths]
+        self.keyfs.tx.exists_many(key for key in keys if key is not None)
+        return [self.get_file_entry(relpath, readonly=readonly)
+                for relpath in relpaths]
+
     def get_file_entry_raw(self, key, meta):
         return FileEntry(self.xom, key, meta=meta)
 
+    def new_spool(self):
+        """ return a ``Spool`` for content which gets a new file entry
+        with ``store``, like uploads. """
+        f = self.keyfs.tx.conn.io_file_new_open(
+            "%s/upload" % self.rel_storedir)
+        return Spool(f, [DEFAULT_HASH_TYPE])
+
     def store(self, user, index, basename, file_content, dir_hash_spec=None):
+        """ store the content given as bytes or as a ``Spool``. """
         if dir_hash_spec is None:
-            dir_hash_spec = get_default_hash_spec(file_content)
+            if isinstance(file_content, Spool):
+                dir_hash_spec = file_content.get_hash_spec(DEFAULT_HASH_TYPE)
+            else:
+                dir_hash_spec = get_default_hash_spec(file_content)
         hashdir_a, hashdir_b = make_splitdir(dir_hash_spec)
         key = self.keyfs.STAGEFILE(user=user, index=index,
                    hashdir_a=hashdir_a, hashdir_b=hashdir_b, filename=basename)
@@ -159,7 +183,11 @@ class FileEntry(object):
             return ValueError("%s: %s" %(self.relpath, err))
 
     def file_get_checksum(self, hash_type):
-        return getattr(hashlib, hash_type)(self.file_get_content()).hexdigest()
+        hasher = getattr(hashlib, hash_type)()
+        with self.file_open_read() as f:
+            for data in iter_file_chunks(f, 65536):
+                hasher.update(data)
+        return hasher.hexdigest()
 
     @property
     def tx(self):
@@ -192,21 +220,44 @@ class FileEntry(object):
     def file_os_path(self):
         return self.tx.conn.io_file_os_path(self._storepath)
 
+    def file_new_open(self):
+        """ return a new temporary file for a ``Spool`` of the content. """
+        try:
+            conn = self.tx.conn
+        except AttributeError:
+            # when streaming we won't be in a transaction anymore
+            with self.key.keyfs._storage.get_connection() as conn:
+                return conn.io_file_new_open(self._storepath)
+        return conn.io_file_new_open(self._storepath)
+
     def file_set_content(self, content, last_modified=None, hash_spec=None):
-        assert isinstance(content, bytes)
+        """ store the content given as bytes or as a ``Spool``. """
+        spool = None
+        if isinstance(content, Spool):
+            spool = content
+        else:
+            assert isinstance(content, bytes)
         if last_modified != -1:
             if last_modified is None:
                 last_modified = unicode_if_bytes(format_date_time(None))
             self.last_modified = last_modified
         #else we are called from replica thread and just write outside
         if hash_spec:
-            err = get_checksum_error(content, hash_spec)
+            if spool is not None:
+                err = spool.get_checksum_error(hash_spec)
+            else:
+                err = get_checksum_error(content, hash_spec)
             if err:
                 raise ValueError(err)
+        elif spool is not None:
+            hash_spec = spool.get_hash_spec(DEFAULT_HASH_TYPE)
         else:
             hash_spec = get_default_hash_spec(content)
         self.hash_spec = hash_spec
-        self.tx.conn.io_file_set(self._storepath, content)
+        if spool is not None:
+            spool.store(self.tx.conn, self._storepath)
+        else:
+            self.tx.conn.io_file_set(self._storepath, content)
         # we make sure we always refresh the meta information
         # when we set the file content. Otherwise we might
         # end up only committing file content without any keys
@@ -263,39 +314,73 @@ class FileEntry(object):
 
         yield self._headers_from_response(r)
 
-        content = b''
-        while 1:
-            data = r.raw.read(10240)
-            if not data:
-                break
-            content = content + data
-            yield data
-
-        filesize = len(content)
-        if content_size and int(content_size) != filesize:
-            err = ValueError(
-                      "%s: got %s bytes of %r from remote, expected %s" % (
-                      self.relpath, filesize, r.url, content_size))
-        if not err and not self.eggfragment:
-            err = self.check_checksum(content)
-
-        if err is not None:
-            log.error(str(err))
-            raise err
-
+        hash_types = [DEFAULT_HASH_TYPE]
+        if self.hash_spec and not self.eggfragment:
+            hash_types.append(self.hash_type)
+        spool = Spool(self.file_new_open(), hash_types)
+        try:
+            for data in spool.iter_write(r.raw):
+                yield data
+
+            if content_size and int(content_size) != spool.size:
+                err = ValueError(
+                          "%s: got %s bytes of %r from remote, expected %s" % (
+                          self.relpath, spool.size, r.url, content_size))
+            if not err and not self.eggfragment and self.hash_spec:
+                err = spool.get_checksum_error(self.hash_spec)
+                if err:
+                    err = ValueError("%s: %s" % (self.relpath, err))
+
+            if err is not None:
+                log.error(str(err))
+                raise err
+
+            self._store_spool(spool, r.headers.get("last-modified", None))
+        finally:
+            spool.discard()
+
+    def _store_spool(self, spool, last_modified):
         try:
             # when pushing from a mirror to an index, we are still in a
-            # transaction
+            # write transaction
             tx = self.tx
         except AttributeError:
-            # when streaming we won't be in a transaction anymore, so we need
-            # to open a new one below
+            # when streaming we won't be in a transaction anymore
             tx = None
+        if tx is not None and tx.write:
+            self.file_set_content(spool, last_modified)
+            return
+        # the download ran without holding the write lock, so we only
+        # need it for storing the file now
+        keyfs = self.key.keyfs
         if tx is not None:
-            self.file_set_content(content, r.headers.get("last-modified", None))
+            keyfs.restart_as_write_transaction()
+            self._store_fetched_content(spool, last_modified)
         else:
-            with self.key.keyfs.transaction(write=True):
-                self.file_set_content(content, r.headers.get("last-modified", None))
+            with keyfs.transaction(write=True):
+                self._store_fetched_content(spool, last_modified)
+
+    def _store_fetched_content(self, spool, last_modified):
+        # the entry might have changed while we were downloading
+        entry = self.xom.filestore.get_file_entry(
+            self.relpath, readonly=False)
+        if entry is None or not entry.meta:
+            threadlog.warn(
+                "not storing %s, the entry was deleted during download",
+                self.relpath)
+            return
+        if entry.file_exists() and not entry.eggfragment:
+            threadlog.debug(
+                "not storing %s, it was stored during download", self.relpath)
+            return
+        if entry.hash_spec != self.hash_spec and not entry.eggfragment:
+            err = spool.get_checksum_error(entry.hash_spec)
+            if err:
+                threadlog.warn(
+                    "not storing %s, the entry changed during download: %s",
+                    self.relpath, err)
+                return
+        entry.file_set_content(spool, last_modified)
 
     def iter_remote_file_replica(self):
         from .replica import H_REPLICA_FILEREPL, ReplicationErrors
@@ -323,36 +408,112 @@ class FileEntry(object):
 
         yield self._headers_from_response(r)
 
-        content = b''
+        hash_types = [self.hash_type] if self.hash_spec else []
+        spool = Spool(self.file_new_open(), hash_types)
+        try:
+            for data in spool.iter_write(r.raw):
+                yield data
+
+            if self.hash_spec:
+                err = spool.get_checksum_error(self.hash_spec)
+                if err:
+                    # the file we got is different, so we fail
+                    raise self.BadGateway("%s: %s" % (self.relpath, err))
+
+            try:
+                # there is no code path that still has a transaction at
+                # this point, but we handle that case just to be safe
+                tx = self.tx
+            except AttributeError:
+                # when streaming we won't be in a transaction anymore, so we
+                # need to open a new one below
+                tx = None
+            if tx is not None and tx.write:
+                spool.store(self.tx.conn, self._storepath)
+            else:
+                # we need a direct write connection to use the io_file_*
+                # methods
+                with self.key.keyfs._storage.get_connection(write=True) as conn:
+                    spool.store(conn, self._storepath)
+                    conn.commit()
+        finally:
+            spool.discard()
+        # in case there were errors before, we can now remove them
+        replication_errors.remove(self)
+
+
+class Spool:
+    """ writes content to a file from ``FileEntry.file_new_open`` while
+    computing its size and hashes, so it never has to be in memory. """
+    read_size = 65536
+
+    def __init__(self, f, hash_types):
+        self.f = f
+        self.size = 0
+        self.stored = False
+        self._hashers = dict((x, hashlib.new(x)) for x in hash_types)
+
+    def write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+        for hasher in self._hashers.values():
+            hasher.update(data)
+
+    def write_stream(self, stream):
+        """ write all content read from stream. """
+        for data in self.iter_write(stream):
+            pass
+
+    def iter_write(self, stream):
+        """ write the content read from stream and yield each part. """
         while 1:
-            data = r.raw.read(10240)
+            data = stream.read(self.read_size)
             if not data:
                 break
-            content = content + data
+            self.write(data)
             yield data
 
-        err = self.check_checksum(content)
-        if err:
-            # the file we got is different, so we fail
-            raise self.BadGateway(str(err))
-
-        try:
-            # there is no code path that still has a transaction at this point,
-            # but we handle that case just to be safe
-            tx = self.tx
-        except AttributeError:
-            # when streaming we won't be in a transaction anymore, so we need
-            # to open a new one below
-            tx = None
-        if tx is not None and tx.write:
-            self.tx.conn.io_file_set(self._storepath, content)
-        else:
-            # we need a direct write connection to use the io_file_* methods
-            with self.key.keyfs._storage.get_connection(write=True) as conn:
-                conn.io_file_set(self._storepath, content)
-                conn.commit()
-        # in case there were errors before, we can now remove them
-        replication_errors.remove(self)
+    def get_hexdigest(self, hash_type):
+        hasher = self._hashers.get(hash_type)
+        if hasher is None:
+            # not computed while writing, so we have to read it again
+            hasher = self._hashers[hash_type] = hashlib.new(hash_type)
+            self.f.flush()
+            self.f.seek(0)
+            for data in iter_file_chunks(self.f, self.read_size):
+                hasher.update(data)
+        return hasher.hexdigest()
+
+    def get_hash_spec(self, hash_type):
+        return "%s=%s" % (hash_type, self.get_hexdigest(hash_type))
+
+    def get_checksum_error(self, hash_spec):
+        hash_type, hash_value = hash_spec.split("=", 1)
+        digest = self.get_hexdigest(hash_type)
+        if digest != hash_value:
+            return "%s mismatch, got %s, expected %s" % (
+                hash_type, digest, hash_value)
+
+    def store(self, conn, path):
+        """ store the content at path with the io_file_* methods of conn. """
+        self.f.flush()
+        self.f.seek(0)
+        conn.io_file_set(path, self.f)
+        self.f.close()
+        self.stored = True
+
+    def discard(self):
+        """ remove the file unless the content was stored. """
+        if self.stored:
+            return
+        self.stored = True
+        name = getattr(self.f, "name", None)
+        self.f.close()
+        if isinstance(name, py.builtin._basestring):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
 
 
 def get_checksum_error(content, hash_spec):
@@ -1,7 +1,19 @@
+import io
+import marshal
 import os.path
+import struct
 import sys
+import zlib
 import py
 from execnet.gateway_base import Unserializer, _Serializer
+from .readonly import DictCopyOnWrite, DictViewReadonly
+from .readonly import ListCopyOnWrite, SeqViewReadonly
+from .readonly import SetViewReadonly, TupleViewReadonly
+from .readonly import get_mutable_deepcopy
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 _nodefault = object()
 
@@ -17,20 +29,208 @@ def rename(source, dest):
             os.remove(dest)
         os.rename(source, dest)
 
+class _ReadonlySerializer(_Serializer):
+    """ Serializes the frozen containers like the plain ones, so they
+    don't have to be copied first. """
+    _dispatch = dict(_Serializer._dispatch)
+
+    def save_copy_on_write(self, obj):
+        # a shallow copy, so nothing gets thawed
+        if isinstance(obj, dict):
+            self._save(dict(dict.items(obj)))
+        else:
+            self._save(list(list.__iter__(obj)))
+
+
+_ReadonlySerializer._dispatch.update({
+    DictViewReadonly: _Serializer.save_dict,
+    SeqViewReadonly: _Serializer.save_list,
+    TupleViewReadonly: _Serializer.save_tuple,
+    SetViewReadonly: _Serializer.save_set,
+    DictCopyOnWrite: _ReadonlySerializer.save_copy_on_write,
+    ListCopyOnWrite: _ReadonlySerializer.save_copy_on_write})
+
+
 def load(io):
     return Unserializer(io, strconfig=(False, False)).load(versioned=False)
 
 def dump(obj, io):
-    return _Serializer(io.write).save(obj)
+    return _ReadonlySerializer(io.write).save(obj)
 
-def loads(data):
+def _execnet_loads(data):
     return load(py.io.BytesIO(data))
 
-def dumps(obj):
+def _execnet_dumps(obj):
     io = py.io.BytesIO()
     dump(obj, io)
     return io.getvalue()
 
+_marshal_leaf_types = frozenset(
+    (py.builtin.text, py.builtin.bytes, int, float, bool, type(None)))
+_marshal_dict_types = frozenset((dict, DictViewReadonly, DictCopyOnWrite))
+_marshal_tuple_types = frozenset((tuple, TupleViewReadonly))
+
+
+def _marshallable(obj):
+    # marshal only writes the plain container types, this rebuilds
+    # them with less overhead than get_mutable_deepcopy
+    tp = type(obj)
+    if tp in _marshal_leaf_types:
+        return obj
+    leaves = _marshal_leaf_types
+    if tp in _marshal_dict_types:
+        return dict(
+            (k, v if type(v) in leaves else _marshallable(v))
+            for k, v in dict.items(obj))
+    if tp is list or tp is ListCopyOnWrite:
+        return [
+            v if type(v) in leaves else _marshallable(v)
+            for v in list.__iter__(obj)]
+    if tp is SeqViewReadonly:
+        return [v if type(v) in leaves else _marshallable(v) for v in obj]
+    if tp in _marshal_tuple_types:
+        return tuple([
+            v if type(v) in leaves else _marshallable(v) for v in obj])
+    if tp is SetViewReadonly:
+        return set(obj)
+    return get_mutable_deepcopy(obj)
+
+
+def _marshal_dumps(obj):
+    # version 2 is readable by all supported Python versions
+    return marshal.dumps(_marshallable(obj), 2)
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor().compress(data)
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# data in the versioned format starts with these bytes, which can't be
+# the start of data written by the execnet serializer, so data written
+# before the versioned format existed can still be read
+CODEC_MAGIC = b"\x00DV"
+CODEC_VERSION = 1
+CODEC_HEADER = struct.Struct("!3sBcc")
+
+# name -> (id, dumps, loads)
+encodings = {
+    "execnet": (b"e", _execnet_dumps, _execnet_loads),
+    "marshal": (b"m", _marshal_dumps, marshal.loads)}
+# name -> (id, compress, decompress)
+compressions = {
+    "none": (b"-", None, None),
+    "zlib": (b"z", zlib.compress, zlib.decompress),
+    "zstd": (b"s", _zstd_compress, _zstd_decompress)}
+_encodings_by_id = dict((v[0], (k,) + v[1:]) for k, v in encodings.items())
+_compressions_by_id = dict(
+    (v[0], (k,) + v[1:]) for k, v in compressions.items())
+
+
+class Codec:
+    """ Serializes the data stored in the changelog and the key/value
+    tables, which is also sent to replicas.
+
+    The encoding "legacy" writes execnet serialized data without a header,
+    as done before the versioned format existed. Data is only compressed
+    if it is at least compress_min_size bytes long. """
+
+    def __init__(self, encoding="marshal", compression="zlib",
+                 compress_min_size=16384):
+        if encoding != "legacy" and encoding not in encodings:
+            raise ValueError(
+                "Unknown codec %r, use one of: %s" % (
+                    encoding, ", ".join(["legacy"] + sorted(encodings))))
+        if compression is None or encoding == "legacy":
+            compression = "none"
+        if compression not in compressions:
+            raise ValueError(
+                "Unknown compression %r, use one of: %s" % (
+                    compression, ", ".join(sorted(compressions))))
+        if compression == "zstd" and zstandard is None:
+            raise ValueError(
+                "The 'zstandard' package is required for zstd compression.")
+        self.encoding = encoding
+        self.compression = compression
+        self.compress_min_size = int(compress_min_size)
+
+    def __repr__(self):
+        return "<Codec %s compression %s>" % (self.encoding, self.compression)
+
+    def dumps(self, obj):
+        if self.encoding == "legacy":
+            return _execnet_dumps(obj)
+        (encoding_id, encode, decode) = encodings[self.encoding]
+        data = encode(obj)
+        (compression_id, compress, decompress) = compressions["none"]
+        if self.compression != "none" and len(data) >= self.compress_min_size:
+            (compression_id, compress, decompress) = compressions[
+                self.compression]
+            data = compress(data)
+        return CODEC_HEADER.pack(
+            CODEC_MAGIC, CODEC_VERSION, encoding_id, compression_id) + data
+
+
+def get_codec(settings=None):
+    """ return the Codec configured in the storage settings. """
+    if settings is None:
+        settings = {}
+    kw = {}
+    if "codec" in settings:
+        kw["encoding"] = settings["codec"].lower()
+    if "compression" in settings:
+        kw["compression"] = settings["compression"].lower()
+    if "compress_min_size" in settings:
+        kw["compress_min_size"] = int(settings["compress_min_size"])
+    return Codec(**kw)
+
+
+def get_codec_info(data):
+    """ return (encoding, compression) names used for serialized data. """
+    if not data.startswith(CODEC_MAGIC):
+        return ("legacy", "none")
+    (magic, version, encoding_id, compression_id) = CODEC_HEADER.unpack_from(
+        data)
+    if version != CODEC_VERSION:
+        raise ValueError("Unknown serialization format version %s" % version)
+    return (
+        _encodings_by_id[encoding_id][0],
+        _compressions_by_id[compression_id][0])
+
+
+def get_supported_codecs():
+    """ return the names of encodings and compressions we can read. """
+    names = set(encodings)
+    names.update(compressions)
+    if zstandard is None:
+        names.discard("zstd")
+    return sorted(names)
+
+
+def loads(data):
+    if not data.startswith(CODEC_MAGIC):
+        return _execnet_loads(data)
+    (magic, version, encoding_id, compression_id) = CODEC_HEADER.unpack_from(
+        data)
+    if version != CODEC_VERSION:
+        raise ValueError("Unknown serialization format version %s" % version)
+    (name, encode, decode) = _encodings_by_id[encoding_id]
+    (name, compress, decompress) = _compressions_by_id[compression_id]
+    data = data[CODEC_HEADER.size:]
+    if decompress is not None:
+        if name == "zstd" and zstandard is None:
+            raise ValueError(
+                "The 'zstandard' package is required to read zstd "
+                "compressed data.")
+        data = decompress(data)
+    return decode(data)
+
+def dumps(obj):
+    # kept in the format readable by all versions,
+    # the storage backends use their configured Codec
+    return _execnet_dumps(obj)
+
 def read_int_from_file(path, default=0):
     try:
         with open(path, "rb") as f:
@@ -69,3 +269,86 @@ def get_write_file_ensure_dir(path):
         os.makedirs(dirname)
         return open(path, "wb")
 
+
+
+def iter_file_chunks(content, chunk_size):
+    """ yield the bytes or the content of the file like object
+    ``content`` in chunks of at most chunk_size bytes. """
+    if isinstance(content, bytes):
+        for start in range(0, len(content), chunk_size):
+            yield content[start:start + chunk_size]
+        return
+    while 1:
+        data = content.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+
+class ChunkedFile(io.RawIOBase):
+    """ seekable read only file of ``size`` bytes stored in chunks of
+    ``chunk_size`` bytes, which are fetched with ``read_chunk(index)``
+    only when needed.  At most one chunk is kept in memory. """
+
+    def __init__(self, size, chunk_size, read_chunk):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.read_chunk = read_chunk
+        self._pos = 0
+        self._chunk_index = None
+        self._chunk = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position %r" % offset)
+        self._pos = offset
+        return self._pos
+
+    def _get_chunk(self, index):
+        if index != self._chunk_index:
+            chunk = self.read_chunk(index)
+            if chunk is None:
+                raise IOError("missing chunk %s" % index)
+            self._chunk = chunk
+            self._chunk_index = index
+        return self._chunk
+
+    def readinto(self, b):
+        if self._pos >= self.size:
+            return 0
+        (index, offset) = divmod(self._pos, self.chunk_size)
+        data = self._get_chunk(index)[offset:offset + len(b)]
+        if not data:
+            raise IOError("truncated chunk %s" % index)
+        size = len(data)
+        b[:size] = data
+        self._pos += size
+        return size
+
+    def iter_chunks(self):
+        """ yield the remaining content chunk by chunk. """
+        while self._pos < self.size:
+            (index, offset) = divmod(self._pos, self.chunk_size)
+            data = self._get_chunk(index)[offset:]
+            if not data:
+                raise IOError("truncated chunk %s" % index)
+            self._pos += len(data)
+            yield data
+
+    def close(self):
+        self._chunk = b""
+        self._chunk_index = None
+        io.RawIOBase.close(self)
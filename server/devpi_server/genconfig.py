@@ -57,7 +57,20 @@ def gen_nginx(tw, config, writer):
         parts.append(80)
     outside_host, outside_port = parts
 
+    files_location = ""
+    if config.args.file_offload == "x-accel-redirect":
+        # release files are sent by nginx on X-Accel-Redirect from
+        # devpi-server and only reachable that way, ``^~`` keeps the
+        # regex locations from matching the ``+f`` in the storage path
+        files_location = (
+            "    # release files offloaded with X-Accel-Redirect\n"
+            "    location ^~ /+files/ {\n"
+            "        internal;\n"
+            "        expires max;\n"
+            "    }\n")
+
     nginxconf = render(tw, "nginx-devpi.conf", format=1,
+                       files_location=files_location,
                        outside_url=outside_url,
                        outside_host = outside_host,
                        outside_port = outside_port,
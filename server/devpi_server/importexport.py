@@ -154,9 +154,10 @@ class IndexDump:
             projects = self.stage.list_projects_perstage()
         for name in projects:
             data = {}
-            versions = self.stage.list_versions_perstage(name)
-            for version in versions:
-                v = self.stage.get_versiondata_perstage(name, version)
+            versions = list(self.stage.list_versions_perstage(name))
+            verdatas = self.stage.get_versiondata_many_perstage(
+                (name, version) for version in versions)
+            for version, v in zip(versions, verdatas):
                 data[version] = get_mutable_deepcopy(v)
             for val in data.values():
                 val.pop("+elinks", None)
@@ -176,8 +177,10 @@ class IndexDump:
         self.exporter.completed("index %r" % self.stage.name)
 
     def dump_releasefiles(self, linkstore):
-        for link in linkstore.get_links(rel="releasefile"):
-            entry = self.exporter.filestore.get_file_entry(link.entrypath)
+        links = linkstore.get_links(rel="releasefile")
+        entries = self.exporter.filestore.get_file_entries(
+            link.entrypath for link in links)
+        for link, entry in zip(links, entries):
             assert entry.file_exists(), entry.relpath
             relpath = self.exporter.copy_file(
                 entry,
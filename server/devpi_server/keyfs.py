@@ -7,13 +7,15 @@ view of key/values refering to the point in time it was started,
 independent from any future changes.
 """
 from __future__ import unicode_literals
+from collections import OrderedDict
 import re
 import contextlib
 import py
 from . import mythread
 from .log import threadlog, thread_push_log, thread_pop_log
-from .readonly import get_mutable_deepcopy, ensure_deeply_readonly, \
-                      is_deeply_readonly
+from .readonly import get_mutable_copy
+from .readonly import ensure_deeply_readonly, is_deeply_readonly
+from .readonly import ReadonlyView
 from .fileutil import read_int_from_file, write_int_to_file
 
 import time
@@ -22,6 +24,11 @@ from devpi_common.types import cached_property
 
 
 
+@contextlib.contextmanager
+def _nullcontext():
+    yield
+
+
 class TxNotificationThread:
     def __init__(self, keyfs):
         self.keyfs = keyfs
@@ -114,14 +121,212 @@ class TxNotificationThread:
         log.debug("finished calling all hooks for tx%s", event_serial)
 
 
+class ValueCache:
+    """ process wide cache of the latest state of keys which is shared
+    by all read transactions.
+
+    The entries map a relpath to (keyname, last_serial, value) like
+    ``db_read_typedkey_value`` returns, with a keyname of None for keys
+    which don't exist.  Each entry is the latest state as of ``serial``.
+    Before a lookup the changelog entries up to the serial of the
+    transaction are applied, commits of this process are in the changelog
+    cache already, so this also picks up commits of other processes.
+
+    The size limits the number of entries, not their memory use, which
+    depends on the size of the values. """
+    # catching up with more changelog entries is more work than refilling
+    max_catchup = 1000
+
+    def __init__(self, size):
+        self.size = size
+        self.serial = None
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = mythread.threading.Lock()
+
+    def _catchup(self, conn, serial):
+        """ apply the changelog entries up to serial.  They are read
+        without holding the lock, so other transactions can use the
+        cache meanwhile. """
+        with self._lock:
+            start_serial = self.serial
+        if start_serial is not None and start_serial >= serial:
+            return
+        changes = None
+        if start_serial is not None and (
+                serial - start_serial <= self.max_catchup):
+            snapshot_serial = conn.db_read_snapshot_serial()
+            # unless the changelog entries were pruned by a compaction
+            if snapshot_serial is None or start_serial + 1 >= snapshot_serial:
+                changes = [
+                    (x, conn.get_changes(x))
+                    for x in range(start_serial + 1, serial + 1)]
+        with self._lock:
+            if self.serial is not None and self.serial >= serial:
+                # another transaction caught up meanwhile
+                return
+            if changes is None:
+                self._data.clear()
+                self.serial = serial
+                return
+            for next_serial, entry_changes in changes:
+                if next_serial <= self.serial:
+                    # applied by another transaction meanwhile
+                    continue
+                for relpath, (keyname, back_serial, val) in \
+                        entry_changes.items():
+                    entry = self._data.get(relpath)
+                    if entry is not None and entry[1] < next_serial:
+                        self._data[relpath] = (keyname, next_serial, val)
+                self.serial = next_serial
+
+    def get_many(self, conn, relpaths, at_serial):
+        """ return (serial, entries) where entries is a dict of relpath to
+        the cached entries usable at at_serial.  The serial has to be
+        passed to ``put_many`` for the entries read from the database. """
+        entries = {}
+        serial = conn.last_changelog_serial
+        self._catchup(conn, serial)
+        with self._lock:
+            if self.serial < at_serial:
+                # the transaction is at a serial which isn't committed yet
+                self.misses += len(relpaths)
+                return (serial, entries)
+            for relpath in relpaths:
+                entry = self._data.pop(relpath, None)
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                # re-insert to mark as recently used
+                self._data[relpath] = entries[relpath] = entry
+        return (serial, entries)
+
+    def put_many(self, serial, entries):
+        """ add entries read from the database after the ``get_many``
+        which returned serial. """
+        with self._lock:
+            if serial != self.serial:
+                # the entries were read at an older serial or entries for
+                # serials in between might have been skipped, because the
+                # relpaths weren't cached yet
+                return
+            for relpath, entry in entries.items():
+                self._data.pop(relpath, None)
+                self._data[relpath] = entry
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "serial": self.serial,
+                "size": len(self._data),
+                "max-size": self.size,
+                "hits": self.hits,
+                "misses": self.misses}
+
+
+class ChangelogCompactor:
+    """ Periodically compacts the changelog, keeping the latest ``keep``
+    changelog entries and all entries the event hooks haven't
+    processed yet. """
+
+    def __init__(self, keyfs, interval, keep):
+        self.keyfs = keyfs
+        self.interval = interval
+        self.keep = keep
+
+    def thread_run(self):
+        threadlog.info(
+            "starting changelog compaction every %s seconds", self.interval)
+        while 1:
+            self.thread.sleep(self.interval)
+            try:
+                self.compact()
+            except mythread.Shutdown:
+                raise
+            except Exception:
+                threadlog.exception("changelog compaction failed")
+
+    def get_compact_serial(self):
+        """ return the serial up to which the changelog can be
+        compacted or None. """
+        serial = min(
+            self.keyfs.get_current_serial() - self.keep,
+            self.keyfs.notifier.read_event_serial())
+        if serial <= 0:
+            return None
+        snapshot_serial = self.keyfs.get_snapshot_serial()
+        if snapshot_serial is not None and serial <= snapshot_serial:
+            return None
+        return serial
+
+    def compact(self):
+        """ compact the changelog and return the number of deleted
+        changelog entries. """
+        serial = self.get_compact_serial()
+        if serial is None:
+            return 0
+        return self.keyfs.compact_changelog(serial)
+
+
+class SerialWatcher:
+    """ Keeps track of the last committed serial and wakes up the threads
+    waiting in ``KeyFS.wait_tx_serial``.  Commits of this process are
+    reported directly, commits of other processes sharing the storage are
+    detected by this single thread.  Storages can provide
+    ``wait_for_commit(timeout)`` to learn about them early, otherwise the
+    serial is queried every ``interval`` seconds. """
+    interval = 1.0
+
+    def __init__(self, keyfs):
+        self.keyfs = keyfs
+        self.cv = keyfs._cv_new_transaction
+        self.serial = keyfs.get_current_serial()
+
+    def update(self, serial):
+        with self.cv:
+            if serial > self.serial:
+                self.serial = serial
+            self.cv.notify_all()
+
+    def refresh(self):
+        with self.keyfs._storage.get_connection() as conn:
+            serial = conn.db_read_last_changelog_serial()
+        if serial != self.serial:
+            self.update(serial)
+
+    def thread_run(self):
+        wait_for_commit = getattr(
+            self.keyfs._storage, "wait_for_commit", None)
+        while 1:
+            try:
+                if wait_for_commit is None:
+                    self.thread.sleep(self.interval)
+                else:
+                    wait_for_commit(self.interval)
+                    self.thread.exit_if_shutdown()
+                self.refresh()
+            except mythread.Shutdown:
+                raise
+            except Exception:
+                threadlog.exception("checking for new commits failed")
+                self.thread.sleep(self.interval)
+
+
 class KeyFS(object):
     """ singleton storage object. """
     class ReadOnly(Exception):
         """ attempt to open write transaction while in readonly mode. """
 
-    def __init__(self, basedir, storage, readonly=False, cache_size=10000):
+    def __init__(self, basedir, storage, readonly=False, cache_size=10000,
+                 value_cache_size=10000):
         self.basedir = py.path.local(basedir).ensure(dir=1)
         self._keys = {}
+        self._router = KeyRouter(self)
+        self._value_cache = ValueCache(value_cache_size)
         self._threadlocal = mythread.threading.local()
         self._cv_new_transaction = mythread.threading.Condition()
         self._import_subscriber = {}
@@ -132,6 +337,7 @@ class KeyFS(object):
             cache_size=cache_size)
         self._readonly = readonly
         self._storage.perform_crash_recovery()
+        self.serial_watcher = SerialWatcher(self)
 
     def import_changes(self, serial, changes):
         with self._storage.get_connection(write=True) as conn:
@@ -141,19 +347,44 @@ class KeyFS(object):
                 for relpath, tup in changes.items():
                     keyname, back_serial, val = tup
                     typedkey = self.get_key_instance(keyname, relpath)
-                    fswriter.record_set(typedkey, get_mutable_deepcopy(val))
+                    fswriter.record_set(typedkey, val)
                     meth = self._import_subscriber.get(keyname)
                     if meth is not None:
                         threadlog.debug("calling import subscriber %r", meth)
                         with self.transaction(write=False, at_serial=serial):
                             meth(fswriter, typedkey, val, back_serial)
 
+    def import_changes_many(self, serial, entries):
+        """ import the changes of consecutive serials starting at serial.
+        Where the storage supports it, several serials are committed
+        together.  Each serial is still imported on its own and import
+        subscribers see all previous serials committed. """
+        hold_commits = getattr(self._storage, "hold_commits", None)
+        pending = []
+
+        def import_pending():
+            if not pending:
+                return
+            with (hold_commits() if hold_commits is not None
+                  else _nullcontext()):
+                for item in pending:
+                    self.import_changes(*item)
+            del pending[:]
+
+        for i, changes in enumerate(entries):
+            if any(x[0] in self._import_subscriber for x in changes.values()):
+                import_pending()
+                self.import_changes(serial + i, changes)
+            else:
+                pending.append((serial + i, changes))
+        import_pending()
+
     def subscribe_on_import(self, key, subscriber):
         assert key.name not in self._import_subscriber
         self._import_subscriber[key.name] = subscriber
 
     def _notify_on_commit(self, serial):
-        self.release_all_wait_tx()
+        self.serial_watcher.update(serial)
 
     def release_all_wait_tx(self):
         with self._cv_new_transaction:
@@ -162,15 +393,30 @@ class KeyFS(object):
     def wait_tx_serial(self, serial, timeout=None, recheck=1.0):
         """ Return True when the transaction with the serial has been commited.
         Return False if it hasn't happened within a specified timeout.
-        If timeout was not specified, we'll wait indefinitely.  In any case,
-        this method wakes up every "recheck" seconds to query the database
-        in case some other process has produced a commit (in-process commits
-        are recognized immediately).
+        If timeout was not specified, we'll wait indefinitely.  Commits of
+        other processes are detected by the ``serial_watcher`` thread.  If
+        it isn't running, this method wakes up every "recheck" seconds to
+        query the database itself (in-process commits are recognized
+        immediately).
         """
-        # we presume that even a few concurrent wait_tx_serial() calls
-        # won't cause much pressure on the database.  If that assumption
-        # is wrong we have to install a thread which does the
-        # db-querying and sets the local condition.
+        if not mythread.has_active_thread(self.serial_watcher):
+            return self._poll_tx_serial(serial, timeout, recheck)
+        watcher = self.serial_watcher
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with threadlog.around("debug", "waiting for tx-serial %s", serial):
+            with self._cv_new_transaction:
+                while serial > watcher.serial:
+                    if timeout is None:
+                        self._cv_new_transaction.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cv_new_transaction.wait(timeout=remaining)
+                return True
+
+    def _poll_tx_serial(self, serial, timeout, recheck):
         time_spent = 0
 
         # recheck time should never be higher than the timeout
@@ -196,6 +442,60 @@ class KeyFS(object):
     def get_last_commit_timestamp(self):
         return self._storage.last_commit_timestamp
 
+    def get_snapshot_serial(self):
+        """ return the serial of the latest snapshot or None. """
+        with self._storage.get_connection() as conn:
+            return conn.db_read_snapshot_serial()
+
+    def write_snapshot(self, serial):
+        """ store the state of all keys at serial in the history, so
+        reading the state at serial or later doesn't need changelog
+        entries before serial. """
+        with self._storage.get_connection(write=True) as conn:
+            # the writer lock is held, so the kv table is stable
+            entries = []
+            relpaths = conn.db_read_relpaths_without_history(serial)
+            if relpaths:
+                with self.transaction(write=False, at_serial=serial) as tx:
+                    for relpath in relpaths:
+                        try:
+                            (last_serial, val) = tx.get_change_at(
+                                relpath, serial)
+                        except KeyError:
+                            # didn't exist at serial
+                            continue
+                        entries.append((relpath, last_serial, val))
+            conn.db_write_snapshot(serial, entries)
+            conn.commit()
+        threadlog.info(
+            "wrote snapshot at serial %s with %s keys from the changelog",
+            serial, len(entries))
+
+    def import_snapshot(self, serial, changes, batches):
+        """ initialize the empty storage with the state at serial from
+        lists of (relpath, keyname, last_serial, value) entries like
+        ``Transaction.iter_snapshot`` returns.  The changes are those of
+        the changelog entry at serial.  Event hooks don't run for the
+        state before serial. """
+        self.notifier.write_event_serial(serial)
+        try:
+            return self._storage.import_snapshot(serial, changes, batches)
+        except BaseException:
+            self.notifier.write_event_serial(-1)
+            raise
+
+    def compact_changelog(self, serial):
+        """ write a snapshot at serial and delete the changelog entries and
+        history before it.  Returns the number of deleted changelog
+        entries.  Changes before serial can't be read afterwards. """
+        self.write_snapshot(serial)
+        with self._storage.get_connection(write=True) as conn:
+            count = conn.db_prune_changelog(serial)
+            conn.commit()
+        threadlog.info(
+            "pruned %s changelog entries before serial %s", count, serial)
+        return count
+
     @property
     def tx(self):
         return getattr(self._threadlocal, "tx")
@@ -207,12 +507,18 @@ class KeyFS(object):
         else:
             key = TypedKey(self, path, type, name)
         self._keys[name] = key
+        self._router.add(key)
         setattr(self, name, key)
         return key
 
     def get_key(self, name):
         return self._keys.get(name)
 
+    def match_key(self, relpath):
+        """ return the key instance of the first registered key whose
+        path matches relpath or None, without asking the database. """
+        return self._router.match(relpath)
+
     def get_key_instance(self, keyname, relpath):
         key = self.get_key(keyname)
         if isinstance(key, PTypedKey):
@@ -270,6 +576,58 @@ class KeyFS(object):
         self.commit_transaction_in_thread()
 
 
+class KeyRouter:
+    """ maps relpaths to key instances with a single compiled regular
+    expression over the paths of all registered keys.  If several paths
+    match, the key which was added first wins. """
+    def __init__(self, keyfs):
+        self.keyfs = keyfs
+        self._keys = []
+        self._rex = None
+        self._groups = None
+
+    def add(self, key):
+        self._keys = [x for x in self._keys if x.name != key.name]
+        self._keys.append(key)
+        self._rex = None
+
+    def _compile(self):
+        parts = []
+        groups = {}
+        index = 1
+        for key in self._keys:
+            if isinstance(key, PTypedKey):
+                pieces = PTypedKey.rex_braces.split(key.pattern)
+                # the odd pieces are the names of the parameters
+                names = pieces[1::2]
+                rex_pattern = "".join(
+                    "([^/]+)" if i % 2 else re.escape(piece)
+                    for i, piece in enumerate(pieces))
+            else:
+                names = []
+                rex_pattern = re.escape(key.relpath)
+            parts.append("(%s)" % rex_pattern)
+            groups[index] = (key, index + 1, names)
+            index += 1 + len(names)
+        self._groups = groups
+        self._rex = re.compile("^(?:%s)$" % "|".join(parts))
+
+    def match(self, relpath):
+        if self._rex is None:
+            self._compile()
+        m = self._rex.match(relpath)
+        if m is None:
+            return None
+        # the enclosing group of the alternative is the last one closed
+        (key, start, names) = self._groups[m.lastindex]
+        if isinstance(key, TypedKey):
+            return key
+        params = dict(
+            (name, m.group(start + i)) for i, name in enumerate(names))
+        return TypedKey(self.keyfs, relpath, key.type, key.name,
+                        params=params)
+
+
 class PTypedKey:
     rex_braces = re.compile(r'\{(.+?)\}')
     def __init__(self, keyfs, key, type, name):
@@ -373,49 +731,142 @@ class Transaction(object):
         self.at_serial = at_serial
         self.cache = {}
         self.dirty = set()
+        # typedkey -> mutable value passed to set, see _check_set_values
+        self.set_values = {}
+        # relpath to key instance of all keys known to the transaction
+        self.relpaths = {}
         self.closed = False
 
-    def get_value_at(self, typedkey, at_serial):
-        relpath = typedkey.relpath
-        keyname, last_serial = self.conn.db_read_typedkey(relpath)
+    def _read_typedkey_values(self, relpaths, at_serial):
+        """ return a dict of relpath to (keyname, last_serial, val) for
+        the latest state of the existing relpaths, using the shared value
+        cache in read transactions. """
+        relpaths = list(relpaths)
+        if self.write:
+            # a write transaction can see uncommitted changes
+            # of other writers in the same write group
+            return self.conn.db_read_typedkey_values(relpaths)
+        value_cache = self.keyfs._value_cache
+        (cache_serial, entries) = value_cache.get_many(
+            self.conn, relpaths, at_serial)
+        missing = [x for x in relpaths if x not in entries]
+        if missing:
+            rows = self.conn.db_read_typedkey_values(missing)
+            new_entries = dict((x, (None, -1, None)) for x in missing)
+            new_entries.update(rows)
+            value_cache.put_many(cache_serial, new_entries)
+            entries.update(new_entries)
+        return dict(
+            (relpath, entry) for relpath, entry in entries.items()
+            if entry[0] is not None)
+
+    def _read_typedkey_value(self, relpath, at_serial):
+        rows = self._read_typedkey_values([relpath], at_serial)
+        if relpath not in rows:
+            raise KeyError(relpath)
+        return rows[relpath]
+
+    def get_change_at(self, relpath, at_serial):
+        """ return (last_serial, val) of the last change of relpath at or
+        before at_serial, where val is None if the key was deleted.
+
+        Raises KeyError if the key didn't exist at at_serial and
+        ValueError if the changelog before at_serial was pruned. """
+        keyname, last_serial, val = self._read_typedkey_value(
+            relpath, at_serial)
+        if last_serial <= at_serial:
+            # the latest value is stored along with the key, so we
+            # don't need to look into the changelog at all
+            return (last_serial, val)
+        res = self.conn.db_read_typedkey_value_at(relpath, at_serial)
+        if res is not None:
+            return res
+        # the history doesn't reach back to at_serial,
+        # so we have to follow the changelog entries
+        snapshot_serial = self.conn.db_read_snapshot_serial()
         while last_serial >= 0:
+            if snapshot_serial is not None and last_serial < snapshot_serial:
+                raise ValueError(
+                    "the state of %s at serial %s was pruned by the "
+                    "compaction at serial %s" % (
+                        relpath, at_serial, snapshot_serial))
             tup = self.conn.get_changes(last_serial).get(relpath)
             assert tup, "no transaction entry at %s" %(last_serial)
             keyname, back_serial, val = tup
             if last_serial > at_serial:
                 last_serial = back_serial
                 continue
-            if val is not None:
-                return val
-            raise KeyError(relpath)  # was deleted
+            return (last_serial, val)
 
         # we could not find any change below at_serial which means
         # the key didn't exist at that point in time
         raise KeyError(relpath)
 
+    def iter_snapshot(self, batch_size=1000):
+        """ yield lists of (relpath, keyname, last_serial, value) entries
+        with the state of all existing keys at the serial of the
+        transaction. """
+        after_relpath = None
+        while 1:
+            rows = self.conn.db_read_typedkey_values_range(
+                after_relpath, batch_size)
+            if not rows:
+                return
+            after_relpath = rows[-1][0]
+            entries = []
+            for relpath, keyname, last_serial, val in rows:
+                if last_serial > self.at_serial:
+                    # changed after the transaction started
+                    try:
+                        (last_serial, val) = self.get_change_at(
+                            relpath, self.at_serial)
+                    except KeyError:
+                        continue
+                if val is None:
+                    # deleted
+                    continue
+                entries.append((relpath, keyname, last_serial, val))
+            if entries:
+                yield entries
+
+    def get_value_at(self, typedkey, at_serial):
+        relpath = typedkey.relpath
+        (last_serial, val) = self.get_change_at(relpath, at_serial)
+        if val is None:
+            raise KeyError(relpath)  # was deleted
+        return val
+
     def derive_key(self, relpath):
-        """ return key instance for a given key path."""
+        """ return key instance for a given key path.
+
+        Raises KeyError if the key never existed.  The latest value is
+        read along with the keyname, so a following ``get`` of the key
+        doesn't need another database query. """
         try:
             return self.get_key_in_transaction(relpath)
         except KeyError:
-            # XXX we could avoid asking the database
-            # if the relpath included the keyname
-            # but that's yet another refactoring (tm).
-            keyname, serial = self.conn.db_read_typedkey(relpath)
-        return self.keyfs.get_key_instance(keyname, relpath)
+            pass
+        keyname, last_serial, val = self._read_typedkey_value(
+            relpath, self.at_serial)
+        key = self.keyfs.match_key(relpath)
+        if key is None or key.name != keyname:
+            # several key paths match relpath
+            key = self.keyfs.get_key_instance(keyname, relpath)
+        self.relpaths[relpath] = key
+        if val is not None and last_serial <= self.at_serial:
+            if key not in self.dirty:
+                self.cache[key] = val
+        return key
 
     def get_key_in_transaction(self, relpath):
-        for key in self.cache:
-            if key.relpath == relpath:
-                return key
-        raise KeyError(relpath)
+        return self.relpaths[relpath]
 
     def is_dirty(self, typedkey):
         return typedkey in self.dirty
 
     def get(self, typedkey, readonly=True):
-        """ Return value referenced by typedkey, either as a readonly-view
-        or as a mutable deep copy. """
+        """ Return value referenced by typedkey, either as a frozen
+        readonly container or as a mutable copy-on-write copy. """
         try:
             val = self.cache[typedkey]
         except KeyError:
@@ -432,10 +883,65 @@ class Transaction(object):
             else:
                 assert is_deeply_readonly(val)
                 self.cache[typedkey] = val
+                self.relpaths[typedkey.relpath] = typedkey
         if readonly:
             return ensure_deeply_readonly(val)
         else:
-            return get_mutable_deepcopy(val)
+            return get_mutable_copy(val)
+
+    def _get_values(self, typedkeys):
+        """ return a dict of typedkey to value for all typedkeys which
+        exist, reading the uncached ones with one batch query. """
+        result = {}
+        missing = []
+        for typedkey in typedkeys:
+            if typedkey in self.cache:
+                result[typedkey] = self.cache[typedkey]
+            elif typedkey not in self.dirty:
+                missing.append(typedkey)
+        if not missing:
+            return result
+        rows = self._read_typedkey_values(
+            set(typedkey.relpath for typedkey in missing), self.at_serial)
+        for typedkey in missing:
+            if typedkey.relpath not in rows:
+                continue
+            (keyname, last_serial, val) = rows[typedkey.relpath]
+            if last_serial > self.at_serial:
+                try:
+                    val = self.get_value_at(typedkey, self.at_serial)
+                except KeyError:
+                    continue
+            elif val is None:
+                continue  # was deleted
+            self.cache[typedkey] = val
+            self.relpaths[typedkey.relpath] = typedkey
+            result[typedkey] = val
+        return result
+
+    def get_many(self, typedkeys, readonly=True):
+        """ Return list of the values referenced by typedkeys like
+        ``get`` does for each of them, but read with as few database
+        queries as possible. """
+        typedkeys = list(typedkeys)
+        values = self._get_values(typedkeys)
+        result = []
+        for typedkey in typedkeys:
+            try:
+                val = values[typedkey]
+            except KeyError:
+                val = typedkey.type()
+            if readonly:
+                result.append(ensure_deeply_readonly(val))
+            else:
+                result.append(get_mutable_copy(val))
+        return result
+
+    def exists_many(self, typedkeys):
+        """ Return list of booleans whether the typedkeys exist. """
+        typedkeys = list(typedkeys)
+        values = self._get_values(typedkeys)
+        return [typedkey in values for typedkey in typedkeys]
 
     def exists(self, typedkey):
         if typedkey in self.cache:
@@ -454,6 +960,7 @@ class Transaction(object):
         if not self.write:
             raise self.keyfs.ReadOnly()
         self.cache.pop(typedkey, None)
+        self.set_values.pop(typedkey, None)
         self.dirty.add(typedkey)
 
     def set(self, typedkey, val):
@@ -463,8 +970,16 @@ class Transaction(object):
         # keys, not bytes
         if typedkey.type == dict:
             check_unicode_keys(val)
-        self.cache[typedkey] = val
+        # frozen once here, so reads in this transaction don't have to,
+        # parts which are already frozen are shared and not copied
+        frozen = ensure_deeply_readonly(val)
+        self.cache[typedkey] = frozen
+        if frozen is val:
+            self.set_values.pop(typedkey, None)
+        else:
+            self.set_values[typedkey] = val
         self.dirty.add(typedkey)
+        self.relpaths[typedkey.relpath] = typedkey
 
     def commit(self):
         if not self.write:
@@ -473,6 +988,7 @@ class Transaction(object):
             threadlog.debug("nothing to commit, just closing tx")
             return self._close()
         try:
+            self._check_set_values()
             with self.conn.write_transaction() as fswriter:
                 for typedkey in self.dirty:
                     val = self.cache.get(typedkey)
@@ -484,6 +1000,17 @@ class Transaction(object):
         self.commit_serial = commit_serial
         return commit_serial
 
+    def _check_set_values(self):
+        """ Raise ValueError if a value was changed after it was set.
+
+        The frozen copy made by ``set`` is committed, so the change would
+        get lost silently otherwise. """
+        for typedkey, val in self.set_values.items():
+            if self.cache[typedkey] != val:
+                raise ValueError(
+                    "The value of %s was changed after it was set, "
+                    "it has to be set again." % typedkey.relpath)
+
     def _close(self):
         if self.closed:
             # We can reach this when the transaction is restarted and there
@@ -494,6 +1021,8 @@ class Transaction(object):
         threadlog.debug("closing transaction at %s", self.at_serial)
         del self.cache
         del self.dirty
+        del self.set_values
+        del self.relpaths
         self.conn.close()
         self.closed = True
         return self.at_serial
@@ -513,7 +1042,11 @@ class Transaction(object):
 
 
 def check_unicode_keys(d):
-    for key, val in d.items():
+    # frozen values were checked before they were stored and iterating
+    # over dict.items avoids copying values of copy-on-write dicts
+    if isinstance(d, ReadonlyView):
+        return
+    for key, val in dict.items(d):
         assert not isinstance(key, py.builtin.bytes), repr(key)
         # not allowing bytes seems ok for now, we might need to relax that
         # it certainly helps to get unicode clean
@@ -1,32 +1,79 @@
 from devpi_common.types import cached_property
-from .fileutil import dumps, loads
+from .fileutil import ChunkedFile, get_codec, iter_file_chunks, loads
 from .log import threadlog, thread_push_log, thread_pop_log
+from .mythread import has_active_thread
 from .readonly import ReadonlyView
-from .readonly import ensure_deeply_readonly, get_mutable_deepcopy
+from .readonly import ensure_deeply_readonly
+from functools import partial
 from repoze.lru import LRUCache
+import collections
 import contextlib
 import os
 import py
 import sqlite3
+import tempfile
+import threading
 import time
 
 
 class BaseConnection:
-    def __init__(self, sqlconn, basedir, storage):
+    # stays below the default limit of 999 variables per sqlite statement
+    max_batch_size = 500
+
+    def __init__(self, sqlconn, basedir, storage, pooled=False,
+                 write_group=None):
         self._sqlconn = sqlconn
         self._basedir = basedir
+        self._pooled = pooled
+        self._write_group = write_group
         self.dirty_files = {}
         self.storage = storage
         self._changelog_cache = storage._changelog_cache
 
     def close(self):
-        self._sqlconn.close()
+        if self._write_group is not None:
+            # nothing was committed, the database transaction
+            # may still be needed by other writers of the group
+            self.rollback()
+        elif not self._pooled and self._sqlconn is not None:
+            # pooled connections stay open for the next use in this thread
+            self._sqlconn.close()
 
     def commit(self):
-        self._sqlconn.commit()
+        if self._write_group is None:
+            self._sqlconn.commit()
+            return
+        group = self._write_group
+        self._write_group = None
+        group.end(self)
+        self.storage.writer_queue.commit(group)
 
     def rollback(self):
-        self._sqlconn.rollback()
+        if self._write_group is None:
+            self._sqlconn.rollback()
+            return
+        group = self._write_group
+        self._write_group = None
+        group.end(self, rollback=True)
+        self.storage.writer_queue.finish(group)
+
+    def commit_serial(self, serial, mergeable=True, after_commit=None,
+                      changes=None):
+        """ Commit the writes for serial, while holding commits possibly
+        together with the writes of following write transactions. Returns
+        when the database commit happened, unless commits are held by
+        ``hold_commits``. If mergeable is False, the database
+        commit happens right away and after_commit is called before the
+        commit notifications. The changes are put into the changelog
+        cache once they are committed. """
+        group = self._write_group
+        self._write_group = None
+        group.end(self, serial=serial, changes=changes)
+        if mergeable:
+            assert after_commit is None
+            self.storage.writer_queue.finish(group)
+        else:
+            self.storage.writer_queue.commit(group, after_commit=after_commit)
 
     @cached_property
     def last_changelog_serial(self):
@@ -45,13 +92,171 @@ class BaseConnection:
             raise KeyError(relpath)
         return tuple(row[:2])
 
-    def db_write_typedkey(self, relpath, name, next_serial):
-        q = "INSERT OR REPLACE INTO kv (key, keyname, serial) VALUES (?, ?, ?)"
-        self._sqlconn.execute(q, (relpath, name, next_serial))
+    def db_read_typedkey_value(self, relpath):
+        """ return (keyname, serial, value) for the latest state of relpath,
+        where value is None if the key was deleted at serial. """
+        q = "SELECT keyname, serial, value FROM kv WHERE key = ?"
+        c = self._sqlconn.cursor()
+        row = c.execute(q, (relpath,)).fetchone()
+        if row is None:
+            raise KeyError(relpath)
+        keyname, serial, data = row
+        if data is None:
+            # the key was last written before the value column existed
+            (keyname, back_serial, val) = self.get_changes(serial)[relpath]
+            return keyname, serial, val
+        return keyname, serial, ensure_deeply_readonly(loads(bytes(data)))
+
+    def db_read_typedkey_values(self, relpaths):
+        """ return a dict of relpath to (keyname, serial, value) like
+        ``db_read_typedkey_value`` for all existing relpaths, with one
+        query per ``max_batch_size`` relpaths. """
+        relpaths = list(relpaths)
+        result = {}
+        c = self._sqlconn.cursor()
+        for i in range(0, len(relpaths), self.max_batch_size):
+            batch = relpaths[i:i + self.max_batch_size]
+            q = "SELECT key, keyname, serial, value FROM kv WHERE key IN (%s)"
+            q = q % ",".join("?" * len(batch))
+            for relpath, keyname, serial, data in c.execute(q, batch).fetchall():
+                if data is None:
+                    # the key was last written before the value column existed
+                    (keyname, back_serial, val) = self.get_changes(
+                        serial)[relpath]
+                else:
+                    val = ensure_deeply_readonly(loads(bytes(data)))
+                result[relpath] = (keyname, serial, val)
+        return result
+
+    def db_read_typedkey_values_range(self, after_relpath, limit):
+        """ return a list of up to limit (relpath, keyname, serial, value)
+        tuples like ``db_read_typedkey_value`` for the relpaths sorted
+        after after_relpath, which can be None to start at the first. """
+        if after_relpath is None:
+            after_relpath = ""
+        q = """
+            SELECT key, keyname, serial, value FROM kv
+            WHERE key > ? ORDER BY key LIMIT ?"""
+        c = self._sqlconn.cursor()
+        result = []
+        for relpath, keyname, serial, data in c.execute(
+                q, (after_relpath, limit)).fetchall():
+            if data is None:
+                # the key was last written before the value column existed
+                (keyname, back_serial, val) = self.get_changes(
+                    serial)[relpath]
+            else:
+                val = ensure_deeply_readonly(loads(bytes(data)))
+            result.append((relpath, keyname, serial, val))
+        return result
+
+    def db_read_typedkey_value_at(self, relpath, at_serial):
+        """ return (serial, value) of the last change of relpath at or before
+        at_serial, where value is None if the key was deleted at serial.
+        Raise KeyError if relpath didn't exist at at_serial and return None
+        if the history doesn't reach back far enough to know. """
+        q = """
+            SELECT serial, value FROM kv_history
+            WHERE key = ? AND serial <= ?
+            ORDER BY serial DESC LIMIT 1"""
+        c = self._sqlconn.cursor()
+        row = c.execute(q, (relpath, at_serial)).fetchone()
+        if row is not None:
+            return row[0], ensure_deeply_readonly(loads(bytes(row[1])))
+        snapshot_serial = self.db_read_snapshot_serial()
+        if snapshot_serial is not None:
+            if at_serial >= snapshot_serial:
+                # the history is complete from the snapshot onwards
+                raise KeyError(relpath)
+            # a compaction may have pruned the history before the snapshot
+            return None
+        if self.db_read_history_start_serial() == 0:
+            raise KeyError(relpath)
+        return None
+
+    def db_read_history_start_serial(self):
+        """ return the first serial recorded in the history or None. """
+        start_serial = self.storage.history_start_serial
+        if start_serial is None:
+            q = "SELECT MIN(serial) FROM kv_history"
+            start_serial = self._sqlconn.execute(q).fetchone()[0]
+            # reset by pruning
+            self.storage.history_start_serial = start_serial
+        return start_serial
+
+    def db_read_snapshot_serial(self):
+        """ return the serial of the latest snapshot or None. """
+        q = "SELECT MAX(serial) FROM snapshot"
+        return self._sqlconn.execute(q).fetchone()[0]
+
+    def db_read_relpaths_without_history(self, serial):
+        """ return the relpaths whose state at serial is neither in
+        the kv table nor in the history. """
+        q = """
+            SELECT key FROM kv
+            WHERE (serial > ? OR value IS NULL) AND NOT EXISTS (
+                SELECT 1 FROM kv_history
+                WHERE kv_history.key = kv.key AND kv_history.serial <= ?)"""
+        return [x[0] for x in self._sqlconn.execute(q, (serial, serial))]
+
+    def db_write_snapshot(self, serial, entries):
+        """ make sure the state of all keys at serial is in the history
+        and record the snapshot.  The entries are (relpath, last_serial,
+        value) tuples for ``db_read_relpaths_without_history``. """
+        c = self._sqlconn.cursor()
+        c.execute("""
+            INSERT OR IGNORE INTO kv_history (key, serial, value)
+            SELECT key, serial, value FROM kv
+            WHERE serial <= ? AND value IS NOT NULL""", (serial,))
+        q = "INSERT OR IGNORE INTO kv_history (key, serial, value) VALUES (?, ?, ?)"
+        # keys last written before the value column existed need their
+        # value, as the changelog entry it is read from will be pruned
+        q_kv = "UPDATE kv SET value = ? WHERE key = ? AND serial = ? AND value IS NULL"
+        for relpath, last_serial, value in entries:
+            data = sqlite3.Binary(self.storage.codec.dumps(value))
+            c.execute(q, (relpath, last_serial, data))
+            c.execute(q_kv, (data, relpath, last_serial))
+        c.execute("INSERT OR REPLACE INTO snapshot (serial) VALUES (?)", (serial,))
+
+    def db_prune_changelog(self, serial):
+        """ delete the changelog entries before the snapshot at serial
+        and the history entries superseded at serial.  Returns the number
+        of deleted changelog entries. """
+        assert self.db_read_snapshot_serial() == serial
+        # the first serial of the history may change
+        self.storage.history_start_serial = None
+        c = self._sqlconn.cursor()
+        c.execute("DELETE FROM changelog WHERE serial < ?", (serial,))
+        count = c.rowcount
+        c.execute("""
+            DELETE FROM kv_history WHERE serial < ? AND EXISTS (
+                SELECT 1 FROM kv_history AS newer
+                WHERE newer.key = kv_history.key
+                AND newer.serial > kv_history.serial AND newer.serial <= ?)
+            """, (serial, serial))
+        c.execute("DELETE FROM snapshot WHERE serial < ?", (serial,))
+        return count
+
+    def db_write_typedkey_values(self, entries):
+        """ write the (relpath, keyname, serial, value) entries to the kv
+        table without history and changelog, used for importing a
+        snapshot. """
+        codec = self.storage.codec
+        q = "INSERT OR REPLACE INTO kv (key, keyname, serial, value) VALUES (?, ?, ?, ?)"
+        self._sqlconn.executemany(q, (
+            (relpath, keyname, serial, sqlite3.Binary(codec.dumps(value)))
+            for relpath, keyname, serial, value in entries))
+
+    def db_write_typedkey(self, relpath, name, next_serial, value):
+        data = sqlite3.Binary(self.storage.codec.dumps(value))
+        q = "INSERT OR REPLACE INTO kv (key, keyname, serial, value) VALUES (?, ?, ?, ?)"
+        self._sqlconn.execute(q, (relpath, name, next_serial, data))
+        q = "INSERT OR REPLACE INTO kv_history (key, serial, value) VALUES (?, ?, ?)"
+        self._sqlconn.execute(q, (relpath, next_serial, data))
 
     def write_changelog_entry(self, serial, entry):
         threadlog.debug("writing changelog for serial %s", serial)
-        data = dumps(entry)
+        data = self.storage.codec.dumps(entry)
         self._sqlconn.execute(
             "INSERT INTO changelog (serial, data) VALUES (?, ?)",
             (serial, sqlite3.Binary(data)))
@@ -72,7 +277,10 @@ class BaseConnection:
             # modifies data
             changes = ensure_deeply_readonly(changes)
             assert isinstance(changes, ReadonlyView)
-            self._changelog_cache.put(serial, changes)
+            group = self._write_group
+            if group is None or serial not in group.serials:
+                # entries of the group aren't committed yet
+                self._changelog_cache.put(serial, changes)
         return changes
 
 
@@ -89,16 +297,56 @@ class Connection(BaseConnection):
         c.close()
         return result is not None
 
+    def io_file_new_open(self, path):
+        """ return a new temporary file for spooling content which is then
+        passed to ``io_file_set``. """
+        return tempfile.TemporaryFile(dir=self.storage.basedir.strpath)
+
     def io_file_set(self, path, content):
+        """ store the bytes or the content of the file like object
+        ``content`` in chunks, so it never has to be in memory at once. """
         assert not os.path.isabs(path)
         assert not path.endswith("-tmp")
         c = self._sqlconn.cursor()
+        c.execute("DELETE FROM file_chunks WHERE path = ?", (path,))
+        q = "INSERT INTO file_chunks (path, idx, data) VALUES (?, ?, ?)"
+        size = 0
+        chunks = iter_file_chunks(content, self.storage.file_chunk_size)
+        for index, chunk in enumerate(chunks):
+            c.execute(q, (path, index, sqlite3.Binary(chunk)))
+            size += len(chunk)
+        # the data column is only used by files stored before chunking
         q = "INSERT OR REPLACE INTO files (path, size, data) VALUES (?, ?, ?)"
-        c.execute(q, (path, len(content), sqlite3.Binary(content)))
+        c.execute(q, (path, size, sqlite3.Binary(b"")))
         c.close()
 
+    def db_read_file_chunk(self, path, index):
+        q = "SELECT data FROM file_chunks WHERE path = ? AND idx = ?"
+        row = self._sqlconn.execute(q, (path, index)).fetchone()
+        if row is not None:
+            return bytes(row[0])
+
+    def _read_file_chunk(self, path, index):
+        if self._write_group is not None:
+            # the file might only be written in our uncommitted transaction
+            return self.db_read_file_chunk(path, index)
+        with self.storage.get_connection() as conn:
+            return conn.db_read_file_chunk(path, index)
+
     def io_file_open(self, path):
-        return py.io.BytesIO(self.io_file_get(path))
+        """ return a file like object which reads the chunks only when
+        needed, it can still be used after the transaction ended. """
+        assert not os.path.isabs(path)
+        q = "SELECT size, length(data) FROM files WHERE path = ?"
+        row = self._sqlconn.execute(q, (path,)).fetchone()
+        if row is None:
+            raise IOError()
+        (size, legacy_size) = row
+        if legacy_size:
+            return py.io.BytesIO(self.io_file_get(path))
+        return ChunkedFile(
+            size, self.storage.file_chunk_size,
+            partial(self._read_file_chunk, path))
 
     def io_file_get(self, path):
         assert not os.path.isabs(path)
@@ -106,10 +354,17 @@ class Connection(BaseConnection):
         q = "SELECT data FROM files WHERE path = ?"
         c.execute(q, (path,))
         content = c.fetchone()
-        c.close()
         if content is None:
+            c.close()
             raise IOError()
-        return bytes(content[0])
+        if len(content[0]):
+            c.close()
+            return bytes(content[0])
+        q = "SELECT data FROM file_chunks WHERE path = ? ORDER BY idx"
+        c.execute(q, (path,))
+        content = b"".join(bytes(row[0]) for row in c.fetchall())
+        c.close()
+        return content
 
     def io_file_size(self, path):
         assert not os.path.isabs(path)
@@ -124,6 +379,7 @@ class Connection(BaseConnection):
     def io_file_delete(self, path):
         assert not os.path.isabs(path)
         c = self._sqlconn.cursor()
+        c.execute("DELETE FROM file_chunks WHERE path = ?", (path,))
         q = "DELETE FROM files WHERE path = ?"
         c.execute(q, (path,))
         c.close()
@@ -132,26 +388,406 @@ class Connection(BaseConnection):
         return Writer(self.storage, self)
 
 
+class Checkpointer:
+    """ Periodically transfers the content of the write ahead log back
+    into the database, so commits don't have to do it themselves. """
+    interval = 30
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def thread_run(self):
+        threadlog.info("starting sqlite checkpoints every %s seconds",
+                       self.interval)
+        sqlconn = self.storage._get_sqlconn(self.storage._get_uri("rw"))
+        try:
+            while 1:
+                self.thread.sleep(self.interval)
+                self.checkpoint(sqlconn)
+        finally:
+            sqlconn.close()
+
+    def checkpoint(self, sqlconn):
+        # a passive checkpoint never blocks readers or the writer
+        (busy, log, checkpointed) = sqlconn.execute(
+            "PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        if log > 0:
+            threadlog.debug(
+                "checkpointed %s of %s pages from write ahead log",
+                checkpointed, log)
+
+
+class WriteGroup:
+    """ The database transaction of one or more write transactions
+    which are committed together. """
+
+    def __init__(self, storage, sqlconn):
+        self.storage = storage
+        self.sqlconn = sqlconn
+        self.serials = []
+        # (serial, changes) for the changelog cache after the commit
+        self.cache_entries = []
+        self.done = threading.Event()
+        self.error = None
+
+    def begin(self):
+        if self.serials:
+            # protect the writes of the previous writers in the group
+            # in case this one is rolled back
+            self.sqlconn.execute("SAVEPOINT writer")
+
+    def end(self, conn, serial=None, rollback=False, changes=None):
+        savepoint = bool(self.serials)
+        if rollback:
+            if savepoint:
+                self.sqlconn.execute("ROLLBACK TO writer")
+                self.sqlconn.execute("RELEASE writer")
+            else:
+                self.sqlconn.rollback()
+        else:
+            if savepoint:
+                self.sqlconn.execute("RELEASE writer")
+            if serial is not None:
+                self.serials.append(serial)
+                if changes is not None:
+                    self.cache_entries.append((serial, changes))
+        conn._sqlconn = None
+
+    def commit(self, after_commit=None):
+        try:
+            self.sqlconn.commit()
+        except Exception as e:
+            self.error = e
+            self.sqlconn.rollback()
+            raise
+        finally:
+            self.sqlconn.close()
+            self.done.set()
+        for serial, changes in self.cache_entries:
+            self.storage._changelog_cache.put(serial, changes)
+        if after_commit is not None:
+            after_commit()
+        if self.serials:
+            self.storage.last_commit_timestamp = time.time()
+        for serial in self.serials:
+            self.storage._notify_on_commit(serial)
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class WriterQueue:
+    """ Hands out the write lock to threads in the order they asked for it.
+
+    A finished write transaction is committed before the next writer gets
+    the lock, because the next writer may take long and the finished one
+    would have to wait for it. Only while holding, the uncommitted database
+    transaction is handed to the next writer, so the writes of several
+    transactions end up in one database commit. Each of them still gets
+    its own changelog serial and commit notification.
+    """
+    # maximum number of write transactions in one commit while holding
+    max_hold_size = 100
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiting = collections.deque()
+        self._busy = False
+        # the thread for which commits are held
+        self._holding = None
+        self._held = None
+        self.wait_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.commit_count = 0
+        self.held_count = 0
+
+    def acquire(self):
+        """ Block until it's our turn to write and return the write
+        group handed over by the previous writer or None. """
+        start_time = time.time()
+        with self._lock:
+            if not self._busy:
+                self._busy = True
+                waiter = None
+            else:
+                waiter = threading.Event()
+                self._waiting.append(waiter)
+        if waiter is not None:
+            waiter.wait()
+        wait_time = time.time() - start_time
+        with self._lock:
+            (group, self._held) = (self._held, None)
+            self.wait_count += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+        return group
+
+    def release(self):
+        """ Pass the write lock on to the next waiting writer. """
+        with self._lock:
+            if not self._waiting:
+                self._busy = False
+                return
+            waiter = self._waiting.popleft()
+        waiter.set()
+
+    def finish(self, group):
+        """ Called when a writer is done, keeps the group open for the
+        next writer while holding or commits it. """
+        if not group.serials:
+            # nothing to keep, the next writer starts afresh
+            group.sqlconn.close()
+            group.done.set()
+            self.release()
+            return
+        holding = self._holding is threading.current_thread()
+        if holding and len(group.serials) < self.max_hold_size:
+            # the next writer continues with the group
+            with self._lock:
+                self.held_count += 1
+                self._held = group
+            self.release()
+            return
+        self.commit(group)
+
+    @contextlib.contextmanager
+    def hold(self):
+        """ Keep the write group of finished writers in the current thread
+        open for the next writer, even if none is waiting yet, and commit
+        it at the end. These writers return before their writes are
+        committed, writers in other threads commit as usual. """
+        assert self._holding is None
+        self._holding = threading.current_thread()
+        try:
+            yield
+        finally:
+            self._holding = None
+            group = self.acquire()
+            if group is None:
+                self.release()
+            else:
+                self.commit(group)
+
+    def commit(self, group, after_commit=None):
+        try:
+            group.commit(after_commit=after_commit)
+        finally:
+            with self._lock:
+                self.commit_count += 1
+            self.release()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "waiting": len(self._waiting),
+                "wait-count": self.wait_count,
+                "wait-time-total": self.wait_time_total,
+                "wait-time-max": self.wait_time_max,
+                "commits": self.commit_count,
+                "held": self.held_count}
+
+
 class BaseStorage:
-    def __init__(self, basedir, notify_on_commit, cache_size):
+    # the pragmas which can be set with --storage NAME:key=value
+    int_pragmas = ("cache_size", "mmap_size")
+    synchronous_values = ("OFF", "NORMAL", "FULL", "EXTRA")
+    journal_mode_values = (
+        "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+    journal_mode = "wal"
+    # pages in the write ahead log before a commit does a checkpoint itself
+    # while the background checkpointer is running
+    wal_autocheckpoint = 10000
+    # seconds between checks for commits of other processes
+    files_check_interval = 0.05
+
+    def __init__(self, basedir, notify_on_commit, cache_size, settings=None):
+        if settings is None:
+            settings = {}
+        self.pragmas = []
+        for key in self.int_pragmas:
+            if key in settings:
+                self.pragmas.append((key, int(settings[key])))
+        if "synchronous" in settings:
+            synchronous = settings["synchronous"].upper()
+            if synchronous not in self.synchronous_values:
+                raise ValueError(
+                    "Invalid value %r for synchronous, use one of: %s" % (
+                        settings["synchronous"],
+                        ", ".join(self.synchronous_values)))
+            self.pragmas.append(("synchronous", synchronous))
+        if "journal_mode" in settings:
+            journal_mode = settings["journal_mode"].upper()
+            if journal_mode not in self.journal_mode_values:
+                raise ValueError(
+                    "Invalid value %r for journal_mode, use one of: %s" % (
+                        settings["journal_mode"],
+                        ", ".join(self.journal_mode_values)))
+            self.journal_mode = journal_mode.lower()
+        self.codec = get_codec(settings)
         self.basedir = basedir
         self.sqlpath = self.basedir.join(".sqlite")
         self._notify_on_commit = notify_on_commit
         self._changelog_cache = LRUCache(cache_size)  # is thread safe
+        self._read_connections = threading.local()
+        # the read connections of all threads, so they can be closed
+        self._read_sqlconns = []
+        self._read_sqlconns_lock = threading.Lock()
+        self.writer_queue = WriterQueue()
         self.last_commit_timestamp = time.time()
+        self.history_start_serial = None
+        self.checkpointer = None
+        self._files_state = None
         self.ensure_tables_exist()
+        self.ensure_journal_mode()
+
+    def ensure_journal_mode(self):
+        # changing the journal mode isn't possible inside a transaction
+        sqlconn = self._get_sqlconn(self._get_uri("rw"))
+        try:
+            (journal_mode,) = sqlconn.execute("PRAGMA journal_mode").fetchone()
+            if journal_mode.lower() != self.journal_mode:
+                (journal_mode,) = sqlconn.execute(
+                    "PRAGMA journal_mode = %s" % self.journal_mode).fetchone()
+                threadlog.info("DB: Switched to %s journal mode", journal_mode)
+                # read connections opened before don't know about the change
+                self._close_read_connections()
+        finally:
+            sqlconn.close()
+        if journal_mode.lower() == "wal":
+            self.checkpointer = Checkpointer(self)
+
+    def upgrade_tables(self):
+        with self.get_connection(write=True) as conn:
+            c = conn._sqlconn.cursor()
+            columns = set(row[1] for row in c.execute("PRAGMA table_info(kv)"))
+            if "value" not in columns:
+                threadlog.info("DB: Adding value column to kv table")
+                c.execute("ALTER TABLE kv ADD COLUMN value BLOB")
+            tables = set(row[0] for row in c.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"))
+            if "kv_history" not in tables:
+                threadlog.info("DB: Creating kv_history table")
+                c.execute("""
+                    CREATE TABLE kv_history (
+                        key TEXT NOT NULL,
+                        serial INTEGER NOT NULL,
+                        value BLOB NOT NULL,
+                        PRIMARY KEY (key, serial)
+                    )
+                """)
+                c.execute("""
+                    CREATE INDEX kv_history_serial_idx ON kv_history (serial)
+                """)
+            if "snapshot" not in tables:
+                threadlog.info("DB: Creating snapshot table")
+                c.execute("""
+                    CREATE TABLE snapshot (
+                        serial INTEGER NOT NULL PRIMARY KEY
+                    )
+                """)
+            conn.commit()
+
+    def recode(self, batch_size=1000):
+        """ re-encode all stored data with the configured codec,
+        yields (table, count) when done with a table. """
+        for table, column in (
+                ("changelog", "data"), ("kv", "value"),
+                ("kv_history", "value")):
+            count = 0
+            last_rowid = -1
+            while 1:
+                with self.get_connection(write=True) as conn:
+                    rows = conn._sqlconn.execute(
+                        "SELECT _ROWID_, %s FROM %s WHERE _ROWID_ > ? "
+                        "ORDER BY _ROWID_ LIMIT ?" % (column, table),
+                        (last_rowid, batch_size)).fetchall()
+                    for rowid, data in rows:
+                        last_rowid = rowid
+                        if data is None:
+                            continue
+                        data = bytes(data)
+                        new_data = self.codec.dumps(loads(data))
+                        if new_data == data:
+                            continue
+                        conn._sqlconn.execute(
+                            "UPDATE %s SET %s = ? WHERE _ROWID_ = ?" % (
+                                table, column),
+                            (sqlite3.Binary(new_data), rowid))
+                        count += 1
+                    conn.commit()
+                if len(rows) < batch_size:
+                    break
+            threadlog.info("DB: Recoded %s rows of %s table", count, table)
+            yield table, count
+
+    def _get_files_state(self):
+        state = []
+        for path in (self.sqlpath.strpath, self.sqlpath.strpath + "-wal"):
+            try:
+                st = os.stat(path)
+            except OSError:
+                state.append(None)
+            else:
+                state.append((st.st_ino, st.st_size, st.st_mtime))
+        return state
+
+    def wait_for_commit(self, timeout):
+        """ wait up to timeout seconds for a change of the database files,
+        which happens with every commit of any process.  Return True if
+        they changed since the last call. """
+        deadline = time.time() + timeout
+        while 1:
+            state = self._get_files_state()
+            if state != self._files_state:
+                self._files_state = state
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(self.files_check_interval)
+
+    def hold_commits(self):
+        """ Context manager to commit the writes of several write
+        transactions in the current thread together at the end. """
+        return self.writer_queue.hold()
+
+    def import_snapshot(self, serial, changes, batches):
+        """ initialize the empty database with the state at serial.
+
+        The batches are lists of (relpath, keyname, serial, value) entries
+        and changes is the changelog entry for serial.  Returns the number
+        of imported keys. """
+        count = 0
+        with self.get_connection(write=True) as conn:
+            if conn.last_changelog_serial != -1:
+                raise ValueError(
+                    "a snapshot can only be imported into an empty database")
+            for entries in batches:
+                conn.db_write_typedkey_values(entries)
+                count += len(entries)
+            conn.db_write_snapshot(serial, [])
+            conn.write_changelog_entry(serial, (changes, []))
+            conn.commit_serial(serial, mergeable=False)
+        self._changelog_cache.put(serial, ensure_deeply_readonly(changes))
+        threadlog.info(
+            "DB: Imported snapshot of %s keys at serial %s", count, serial)
+        return count
 
     def _get_sqlconn_uri_kw(self, uri):
         return sqlite3.connect(
-            uri, timeout=60, isolation_level=None, uri=True)
+            uri, timeout=60, isolation_level=None, uri=True,
+            check_same_thread=False)
 
     def _get_sqlconn_uri(self, uri):
         return sqlite3.connect(
-            uri, timeout=60, isolation_level=None)
+            uri, timeout=60, isolation_level=None, check_same_thread=False)
 
     def _get_sqlconn_path(self, uri):
         return sqlite3.connect(
-            self.sqlpath.strpath, timeout=60, isolation_level=None)
+            self.sqlpath.strpath, timeout=60, isolation_level=None,
+            check_same_thread=False)
 
     def _get_sqlconn(self, uri):
         # we will try different connection methods and overwrite _get_sqlconn
@@ -197,72 +833,147 @@ class BaseStorage:
             self._get_sqlconn = self._get_sqlconn_path
             return conn
 
-    def get_connection(self, closing=True, write=False):
-        # we let the database serialize all writers at connection time
-        # to play it very safe (we don't have massive amounts of writes).
-        mode = "ro"
-        if write:
-            mode = "rw"
-        if not self.sqlpath.exists():
-            mode = "rwc"
-        uri = "file:%s?mode=%s" % (self.sqlpath, mode)
+    def _get_uri(self, mode):
+        return "file:%s?mode=%s" % (self.sqlpath, mode)
+
+    def _new_sqlconn(self, uri):
         sqlconn = self._get_sqlconn(uri)
-        if write:
-            start_time = time.time()
-            while 1:
-                try:
-                    sqlconn.execute("begin immediate")
-                    break
-                except sqlite3.OperationalError:
-                    # another thread may be writing, give it a chance to finish
-                    time.sleep(0)
-                    if time.time() - start_time > 5:
-                        # if it takes this long, something is wrong
-                        raise
-        conn = self.Connection(sqlconn, self.basedir, self)
+        for name, value in self.pragmas:
+            sqlconn.execute("PRAGMA %s = %s" % (name, value))
+        return sqlconn
+
+    def _get_read_sqlconn(self):
+        # each thread keeps its read connection open, as opening one
+        # is more expensive than most of the queries done with it
+        sqlconn = getattr(self._read_connections, "sqlconn", None)
+        if sqlconn is None:
+            sqlconn = self._new_sqlconn(self._get_uri("ro"))
+            with self._read_sqlconns_lock:
+                self._read_connections.sqlconn = sqlconn
+                self._read_sqlconns.append(sqlconn)
+        return sqlconn
+
+    def _close_read_connections(self):
+        with self._read_sqlconns_lock:
+            sqlconns = self._read_sqlconns
+            self._read_sqlconns = []
+            # threads open new ones on their next read
+            self._read_connections = threading.local()
+        for sqlconn in sqlconns:
+            sqlconn.close()
+
+    def close(self):
+        """ close the read connections of all threads. """
+        self._close_read_connections()
+
+    def get_connection(self, closing=True, write=False):
+        if not write and self.sqlpath.exists():
+            conn = self.Connection(
+                self._get_read_sqlconn(), self.basedir, self, pooled=True)
+            if closing:
+                return contextlib.closing(conn)
+            return conn
+        if not write:
+            # the database doesn't exist yet
+            sqlconn = self._new_sqlconn(self._get_uri("rwc"))
+            conn = self.Connection(sqlconn, self.basedir, self)
+            if closing:
+                return contextlib.closing(conn)
+            return conn
+        # writers in this process are serialized by the queue, the
+        # database only has to serialize us with other processes
+        group = self.writer_queue.acquire()
+        if group is None:
+            try:
+                group = WriteGroup(self, self._new_write_sqlconn())
+            except BaseException:
+                self.writer_queue.release()
+                raise
+        group.begin()
+        conn = self.Connection(
+            group.sqlconn, self.basedir, self, write_group=group)
         if closing:
             return contextlib.closing(conn)
         return conn
 
+    def _new_write_sqlconn(self):
+        mode = "rw"
+        if not self.sqlpath.exists():
+            mode = "rwc"
+        sqlconn = self._new_sqlconn(self._get_uri(mode))
+        try:
+            if has_active_thread(self.checkpointer):
+                sqlconn.execute(
+                    "PRAGMA wal_autocheckpoint = %s" % self.wal_autocheckpoint)
+            sqlconn.execute("begin immediate")
+        except BaseException:
+            sqlconn.close()
+            raise
+        return sqlconn
+
 
 class Storage(BaseStorage):
     Connection = Connection
+    # files are stored in chunks of this many bytes
+    file_chunk_size = 1024 * 1024
 
     def perform_crash_recovery(self):
         pass
 
     def ensure_tables_exist(self):
-        if self.sqlpath.exists():
-            return
+        if not self.sqlpath.exists():
+            with self.get_connection(write=True) as conn:
+                threadlog.info("DB: Creating schema")
+                c = conn._sqlconn.cursor()
+                c.execute("""
+                    CREATE TABLE kv (
+                        key TEXT NOT NULL PRIMARY KEY,
+                        keyname TEXT,
+                        serial INTEGER,
+                        value BLOB
+                    )
+                """)
+                c.execute("""
+                    CREATE TABLE changelog (
+                        serial INTEGER PRIMARY KEY,
+                        data BLOB NOT NULL
+                    )
+                """)
+                c.execute("""
+                    CREATE TABLE files (
+                        path TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        data BLOB NOT NULL
+                    )
+                """)
+                conn.commit()
+        self.upgrade_tables()
+
+    def upgrade_tables(self):
+        BaseStorage.upgrade_tables(self)
         with self.get_connection(write=True) as conn:
-            threadlog.info("DB: Creating schema")
             c = conn._sqlconn.cursor()
-            c.execute("""
-                CREATE TABLE kv (
-                    key TEXT NOT NULL PRIMARY KEY,
-                    keyname TEXT,
-                    serial INTEGER
-                )
-            """)
-            c.execute("""
-                CREATE TABLE changelog (
-                    serial INTEGER PRIMARY KEY,
-                    data BLOB NOT NULL
-                )
-            """)
-            c.execute("""
-                CREATE TABLE files (
-                    path TEXT PRIMARY KEY,
-                    size INTEGER NOT NULL,
-                    data BLOB NOT NULL
-                )
-            """)
+            tables = set(row[0] for row in c.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"))
+            if "file_chunks" not in tables:
+                threadlog.info("DB: Creating file_chunks table")
+                c.execute("""
+                    CREATE TABLE file_chunks (
+                        path TEXT NOT NULL,
+                        idx INTEGER NOT NULL,
+                        data BLOB NOT NULL,
+                        PRIMARY KEY (path, idx)
+                    )
+                """)
             conn.commit()
 
 
 def devpiserver_storage_backend(settings):
+    storage = Storage
+    if settings:
+        storage = partial(Storage, settings=settings)
     return dict(
-        storage=Storage,
+        storage=storage,
         name="sqlite_db_files",
         description="SQLite backend with files in DB for testing only")
 
@@ -276,15 +987,16 @@ class Writer:
 
     def record_set(self, typedkey, value=None):
         """ record setting typedkey to value (None means it's deleted) """
-        assert not isinstance(value, ReadonlyView), value
         try:
             _, back_serial = self.conn.db_read_typedkey(typedkey.relpath)
         except KeyError:
             back_serial = -1
-        self.conn.db_write_typedkey(typedkey.relpath, typedkey.name, self.next_serial)
         # at __exit__ time we write out changes to the _changelog_cache
-        # so we protect here against the caller modifying the value later
-        value = get_mutable_deepcopy(value)
+        # so we protect here against the caller modifying the value later,
+        # parts which are already frozen are shared and not copied
+        value = ensure_deeply_readonly(value)
+        self.conn.db_write_typedkey(
+            typedkey.relpath, typedkey.name, self.next_serial, value)
         self.changes[typedkey.relpath] = (typedkey.name, back_serial, value)
 
     def __enter__(self):
@@ -296,13 +1008,16 @@ class Writer:
         if cls is None:
             entry = self.changes, []
             self.conn.write_changelog_entry(self.next_serial, entry)
-            self.conn.commit()
-            commit_serial = self.next_serial
+            # may be committed together with following imports while
+            # holding, which also takes care of the notification.
+            # The values are already frozen, so the decoding for the
+            # changelog cache can be skipped
+            self.conn.commit_serial(
+                self.next_serial,
+                changes=ensure_deeply_readonly(self.changes))
             message = "committed: keys: %s"
             args = [",".join(map(repr, list(self.changes)))]
             self.log.info(message, *args)
-
-            self.storage._notify_on_commit(commit_serial)
         else:
             self.conn.rollback()
             self.log.info("roll back at %s" %(self.next_serial))
@@ -1,12 +1,27 @@
 from .keyfs_sqlite import BaseConnection
 from .keyfs_sqlite import BaseStorage
 from .log import threadlog, thread_push_log, thread_pop_log
-from .readonly import ReadonlyView
-from .readonly import get_mutable_deepcopy
-from .fileutil import get_write_file_ensure_dir, rename, loads
+from .readonly import ensure_deeply_readonly
+from .fileutil import get_write_file_ensure_dir, iter_file_chunks
+from .fileutil import rename, loads
+from functools import partial
 import os
 import py
-import time
+import tempfile
+
+
+class SpooledFile:
+    """ content which was spooled to a temporary file next to its final
+    location by ``Connection.io_file_new_open``. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
 
 
 class Connection(BaseConnection):
@@ -23,18 +38,60 @@ class Connection(BaseConnection):
         except KeyError:
             return os.path.exists(path)
 
+    def io_file_new_open(self, path):
+        """ return a new temporary file next to the final location of path,
+        passing it to ``io_file_set`` for this or another path moves it
+        into place on commit. """
+        return self._new_spooled_file(self._basedir.join(path).strpath)
+
+    def _is_spooled_file(self, name):
+        # files from io_file_new_open can be renamed to any location
+        return isinstance(name, py.builtin._basestring) and (
+            name.endswith("-spool") and
+            name.startswith(self._basedir.strpath + os.sep))
+
+    def _new_spooled_file(self, path):
+        (dirname, basename) = os.path.split(path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        return tempfile.NamedTemporaryFile(
+            dir=dirname, prefix=basename + "-", suffix="-spool", delete=False)
+
+    def _set_dirty_file(self, path, content):
+        old = self.dirty_files.get(path)
+        if isinstance(old, SpooledFile) and old is not content:
+            old.remove()
+        self.dirty_files[path] = content
+
     def io_file_set(self, path, content):
         path = self._basedir.join(path).strpath
         assert not path.endswith("-tmp")
-        self.dirty_files[path] = content
+        if not isinstance(content, bytes):
+            name = getattr(content, "name", None)
+            if not self._is_spooled_file(name):
+                # not from io_file_new_open, so we copy it into one
+                f = self._new_spooled_file(path)
+                for data in iter_file_chunks(content, 65536):
+                    f.write(data)
+                name = f.name
+                content = f
+            content.close()
+            content = SpooledFile(name)
+        self._set_dirty_file(path, content)
 
     def io_file_open(self, path):
         path = self._basedir.join(path).strpath
         try:
-            f = py.io.BytesIO(self.dirty_files[path])
+            content = self.dirty_files[path]
         except KeyError:
-            f = open(path, "rb")
-        return f
+            return open(path, "rb")
+        if isinstance(content, SpooledFile):
+            return open(content.path, "rb")
+        return py.io.BytesIO(content)
 
     def io_file_get(self, path):
         path = self._basedir.join(path).strpath
@@ -45,6 +102,9 @@ class Connection(BaseConnection):
                 return f.read()
         if content is None:
             raise IOError()
+        if isinstance(content, SpooledFile):
+            with open(content.path, "rb") as f:
+                return f.read()
         return content
 
     def io_file_size(self, path):
@@ -56,12 +116,50 @@ class Connection(BaseConnection):
                 return os.path.getsize(path)
             except OSError:
                 return None
+        if isinstance(content, SpooledFile):
+            return os.path.getsize(content.path)
         if content is not None:
             return len(content)
 
     def io_file_delete(self, path):
         path = self._basedir.join(path).strpath
-        self.dirty_files[path] = None
+        self._set_dirty_file(path, None)
+
+    def _remove_spooled_files(self):
+        for content in self.dirty_files.values():
+            if isinstance(content, SpooledFile):
+                content.remove()
+
+    def commit(self):
+        # files set without a write transaction, like files replicated
+        # on demand, are written along with the commit
+        for path, content in self.dirty_files.items():
+            if content is None:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            elif isinstance(content, SpooledFile):
+                rename(content.path, path)
+            else:
+                tmppath = path + "-tmp"
+                with get_write_file_ensure_dir(tmppath) as f:
+                    f.write(content)
+                rename(tmppath, path)
+        self.dirty_files.clear()
+        BaseConnection.commit(self)
+
+    def rollback(self):
+        self._remove_spooled_files()
+        self.dirty_files.clear()
+        BaseConnection.rollback(self)
+
+    def close(self):
+        # spooled files of an unfinished transaction aren't needed anymore,
+        # the committed ones were already moved into place
+        self._remove_spooled_files()
+        self.dirty_files.clear()
+        BaseConnection.close(self)
 
     def write_transaction(self):
         return FSWriter(self.storage, self)
@@ -80,30 +178,34 @@ class Storage(BaseStorage):
         check_pending_renames(str(self.basedir), rel_renames)
 
     def ensure_tables_exist(self):
-        if self.sqlpath.exists():
-            return
-        with self.get_connection(write=True) as conn:
-            threadlog.info("DB: Creating schema")
-            c = conn._sqlconn.cursor()
-            c.execute("""
-                CREATE TABLE kv (
-                    key TEXT NOT NULL PRIMARY KEY,
-                    keyname TEXT,
-                    serial INTEGER
-                )
-            """)
-            c.execute("""
-                CREATE TABLE changelog (
-                    serial INTEGER PRIMARY KEY,
-                    data BLOB NOT NULL
-                )
-            """)
-            conn.commit()
+        if not self.sqlpath.exists():
+            with self.get_connection(write=True) as conn:
+                threadlog.info("DB: Creating schema")
+                c = conn._sqlconn.cursor()
+                c.execute("""
+                    CREATE TABLE kv (
+                        key TEXT NOT NULL PRIMARY KEY,
+                        keyname TEXT,
+                        serial INTEGER,
+                        value BLOB
+                    )
+                """)
+                c.execute("""
+                    CREATE TABLE changelog (
+                        serial INTEGER PRIMARY KEY,
+                        data BLOB NOT NULL
+                    )
+                """)
+                conn.commit()
+        self.upgrade_tables()
 
 
 def devpiserver_storage_backend(settings):
+    storage = Storage
+    if settings:
+        storage = partial(Storage, settings=settings)
     return dict(
-        storage=Storage,
+        storage=storage,
         name="sqlite",
         description="SQLite backend with files on the filesystem",
         _test_markers=["storage_with_filesystem"])
@@ -118,15 +220,16 @@ class FSWriter:
 
     def record_set(self, typedkey, value=None):
         """ record setting typedkey to value (None means it's deleted) """
-        assert not isinstance(value, ReadonlyView), value
         try:
             _, back_serial = self.conn.db_read_typedkey(typedkey.relpath)
         except KeyError:
             back_serial = -1
-        self.conn.db_write_typedkey(typedkey.relpath, typedkey.name, self.next_serial)
         # at __exit__ time we write out changes to the _changelog_cache
-        # so we protect here against the caller modifying the value later
-        value = get_mutable_deepcopy(value)
+        # so we protect here against the caller modifying the value later,
+        # parts which are already frozen are shared and not copied
+        value = ensure_deeply_readonly(value)
+        self.conn.db_write_typedkey(
+            typedkey.relpath, typedkey.name, self.next_serial, value)
         self.changes[typedkey.relpath] = (typedkey.name, back_serial, value)
 
     def __enter__(self):
@@ -141,6 +244,10 @@ class FSWriter:
                 if content is None:
                     assert os.path.exists(path)
                     pending_renames.append((None, path))
+                elif isinstance(content, SpooledFile):
+                    tmppath = path + "-tmp"
+                    rename(content.path, tmppath)
+                    pending_renames.append((tmppath, path))
                 else:
                     tmppath = path + "-tmp"
                     with get_write_file_ensure_dir(tmppath) as f:
@@ -149,7 +256,6 @@ class FSWriter:
 
             changed_keys, files_commit, files_del = \
                 self.commit_to_filesystem(pending_renames)
-            commit_serial = self.next_serial
 
             # write out a nice commit entry to logging
             message = "committed: keys: %s"
@@ -161,8 +267,6 @@ class FSWriter:
                 message += ", files_del: %s"
                 args.append(",".join(files_del))
             self.log.info(message, *args)
-
-            self.storage._notify_on_commit(commit_serial)
         else:
             self.conn.rollback()
             self.log.info("roll back at %s" %(self.next_serial))
@@ -174,14 +278,30 @@ class FSWriter:
         )
         entry = self.changes, rel_renames
         self.conn.write_changelog_entry(self.next_serial, entry)
-        self.conn.commit()
+        # the values are already frozen, so the decoding for the
+        # changelog cache can be skipped
+        changes = ensure_deeply_readonly(self.changes)
+        files_commit = []
+        files_del = []
+        if not rel_renames:
+            # may be committed together with following imports while holding
+            self.conn.commit_serial(self.next_serial, changes=changes)
+            return list(self.changes), files_commit, files_del
 
         # If we crash in the remainder, the next restart will
         # - call check_pending_renames which will replay any remaining
         #   renames from the changelog entry, and
         # - initialize next_serial from the max committed serial + 1
-        files_commit, files_del = commit_renames(basedir, rel_renames)
-        self.storage.last_commit_timestamp = time.time()
+        # Crash recovery only looks at the last changelog entry, so this
+        # one is committed right away and never merged with later ones.
+        def after_commit():
+            result = commit_renames(basedir, rel_renames)
+            files_commit.extend(result[0])
+            files_del.extend(result[1])
+
+        self.conn.commit_serial(
+            self.next_serial, mergeable=False, after_commit=after_commit,
+            changes=changes)
         return list(self.changes), files_commit, files_del
 
 
@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 import os, sys
 import py
 
+from repoze.lru import LRUCache
 from requests import Response
 from devpi_common.metadata import Version
 from devpi_common.types import cached_property
@@ -96,6 +97,23 @@ def _main(pluginmanager, argv=None):
             set_default_indexes(xom.model)
     check_compatible_version(xom)
 
+    if args.recode_changelog:
+        from devpi_server.recode import recode_changelog
+        return recode_changelog(xom)
+
+    if args.benchmark_codecs:
+        from devpi_server.recode import benchmark_codecs
+        return benchmark_codecs(xom)
+
+    if args.compact_changelog:
+        from devpi_server.keyfs import ChangelogCompactor
+        compactor = ChangelogCompactor(
+            xom.keyfs, interval=0, keep=args.compact_changelog_keep)
+        count = compactor.compact()
+        tw = py.io.TerminalWriter()
+        tw.line("deleted %s changelog entries" % count)
+        return 0
+
     if args.start or args.stop or args.log or args.status:
         xprocdir = config.serverdir.join(".xproc")
         from devpi_server.bgserver import BackgroundServer
@@ -171,6 +189,8 @@ class XOM:
             self.set_state_version(server_version)
         self.log = threadlog
         self.polling_replicas = {}
+        # changelog entries compressed for sending to replicas
+        self.replica_entry_cache = LRUCache(1000)  # is thread safe
         self._stagecache = {}
 
     def get_state_version(self):
@@ -256,10 +276,23 @@ class XOM:
             self.config.serverdir,
             self.config.storage,
             readonly=self.is_replica(),
-            cache_size=self.config.args.keyfs_cache_size)
+            cache_size=self.config.args.keyfs_cache_size,
+            value_cache_size=self.config.args.keyfs_value_cache_size)
         add_keys(self, keyfs)
+        # all processes need to learn about the commits of the others
+        self.thread_pool.register(keyfs.serial_watcher)
         if not self.config.args.requests_only:
             self.thread_pool.register(keyfs.notifier)
+            # only some storage backends need regular maintenance
+            checkpointer = getattr(keyfs._storage, "checkpointer", None)
+            if checkpointer is not None:
+                self.thread_pool.register(checkpointer)
+            if self.config.args.compact_changelog_interval > 0:
+                from devpi_server.keyfs import ChangelogCompactor
+                self.thread_pool.register(ChangelogCompactor(
+                    keyfs,
+                    interval=self.config.args.compact_changelog_interval,
+                    keep=self.config.args.compact_changelog_keep))
         return keyfs
 
     def new_http_session(self, component_name, max_retries=None):
@@ -320,8 +353,13 @@ class XOM:
 
         pyramid_config.add_view_predicate('content_type', ContentTypePredicate)
 
+        pyramid_config.add_route("/+changelog/{start}-",
+                                 r"/+changelog/{start:\d+}-")
+        pyramid_config.add_route("/+changelog/{start}-{end}",
+                                 r"/+changelog/{start:\d+}-{end:\d+}")
         pyramid_config.add_route("/+changelog/{serial}",
                                  "/+changelog/{serial}")
+        pyramid_config.add_route("/+snapshot", "/+snapshot")
         pyramid_config.add_route("/+status", "/+status")
         pyramid_config.add_route("/+api", "/+api", accept="application/json")
         pyramid_config.add_route("{path:.*}/+api", "{path:.*}/+api", accept="application/json")
@@ -374,6 +412,7 @@ class XOM:
         pyramid_config.registry['xom'] = self
         app = pyramid_config.make_wsgi_app()
         if self.is_replica():
+            from devpi_server.replica import FileReplicationWorker
             from devpi_server.replica import ReplicaThread, register_key_subscribers
             register_key_subscribers(self)
             self.replica_thread = ReplicaThread(self)
@@ -382,6 +421,10 @@ class XOM:
             # and replayed through the PypiProjectChange event
             if not self.config.args.requests_only:
                 self.thread_pool.register(self.replica_thread)
+                file_queue = self.replica_thread.file_queue
+                for i in range(self.config.args.replica_file_workers):
+                    self.thread_pool.register(FileReplicationWorker(
+                        self, file_queue, self.replica_thread.errors))
         return OutsideURLMiddleware(app, self)
 
     def is_master(self):
@@ -12,9 +12,9 @@ from devpi_common.validation import validate_metadata, normalize_name
 from devpi_common.types import ensure_unicode, cached_property, parse_hash_spec
 from time import gmtime
 from .auth import hash_password, verify_and_update_password_hash
-from .filestore import FileEntry
+from .filestore import FileEntry, Spool
 from .log import threadlog, thread_current_log
-from .readonly import get_mutable_deepcopy
+from .readonly import get_mutable_copy
 
 
 def run_passwd(root, username):
@@ -311,7 +311,7 @@ class User:
         return False
 
     def get(self, credentials=False):
-        d = get_mutable_deepcopy(self.key.get())
+        d = get_mutable_copy(self.key.get())
         if not d:
             return d
         if not credentials:
@@ -415,6 +415,16 @@ class BaseStage(object):
     def get_linkstore_perstage(self, name, version, readonly=True):
         return LinkStore(self, name, version, readonly=readonly)
 
+    def list_versions_many_perstage(self, projects):
+        """ return a list with the versions of each of the projects. """
+        return [self.list_versions_perstage(project) for project in projects]
+
+    def get_versiondata_many_perstage(self, project_versions):
+        """ return a list with the versiondata of each of the
+        (project, version) tuples. """
+        return [self.get_versiondata_perstage(project, version)
+                for project, version in project_versions]
+
     def get_link_from_entrypath(self, entrypath):
         entry = self.xom.filestore.get_file_entry(entrypath)
         if entry.project is None:
@@ -719,13 +729,26 @@ class PrivateStage(BaseStage):
         project = normalize_name(project)
         return self.key_projversion(project, version).get(readonly=readonly)
 
+    def list_versions_many_perstage(self, projects):
+        return self.keyfs.tx.get_many(
+            self.key_projversions(project) for project in projects)
+
+    def get_versiondata_many_perstage(self, project_versions):
+        return self.keyfs.tx.get_many(
+            self.key_projversion(project, version)
+            for project, version in project_versions)
+
     def get_simplelinks_perstage(self, project):
         return self.key_projsimplelinks(project).get().get("links", [])
 
     def _regen_simplelinks(self, project_input):
         project = normalize_name(project_input)
         links = []
-        for version in self.list_versions_perstage(project):
+        versions = self.list_versions_perstage(project)
+        # reads the versiondata for all linkstores at once
+        self.get_versiondata_many_perstage(
+            (project, version) for version in versions)
+        for version in versions:
             linkstore = self.get_linkstore_perstage(project, version)
             links.extend(map(make_key_and_href, linkstore.get_links("releasefile")))
         self.key_projsimplelinks(project).set({"links": links})
@@ -801,9 +824,10 @@ class PrivateStage(BaseStage):
 
 class ELink(object):
     """ model Link using entrypathes for referencing. """
-    def __init__(self, filestore, linkdict, project, version):
+    def __init__(self, filestore, linkdict, project, version, linkstore=None):
         self.filestore = filestore
         self.linkdict = linkdict
+        self.linkstore = linkstore
         self.basename = posixpath.basename(self.entrypath)
         self.project = project
         self.version = version
@@ -831,6 +855,8 @@ class ELink(object):
         hash_algo, hash_value = parse_hash_spec(self.hash_spec)
         if not hash_algo:
             return True
+        if isinstance(content, Spool):
+            return not content.get_checksum_error(self.hash_spec)
         return hash_algo(content).hexdigest() == hash_value
 
     def __getattr__(self, name):
@@ -855,9 +881,17 @@ class ELink(object):
             kw = dict((py.builtin.text(name), value) for name, value in kw.items())
         d.update(kw)
         self._log.append(d)
+        self._mark_dirty()
 
     def add_logs(self, logs):
         self._log.extend(logs)
+        self._mark_dirty()
+
+    def _mark_dirty(self):
+        # the versiondata is frozen when it's set, so it has to be set
+        # again with the changed log
+        if self.linkstore is not None:
+            self.linkstore._mark_dirty()
 
     def get_logs(self):
         return list(getattr(self, '_log', []))
@@ -878,7 +912,7 @@ class LinkStore:
         return self.filestore.get_file_entry(relpath)
 
     def create_linked_entry(self, rel, basename, file_content, last_modified=None):
-        assert isinstance(file_content, bytes)
+        assert isinstance(file_content, (bytes, Spool))
         overwrite = None
         for link in self.get_links(rel=rel, basename=basename):
             if not self.stage.ixconfig.get("volatile"):
@@ -934,7 +968,8 @@ class LinkStore:
                    (not basename or basename==link.basename) and \
                    (not entrypath or entrypath==link.entrypath) and \
                    (not for_entrypath or for_entrypath==link.for_entrypath)
-        return list(filter(fil, [ELink(self.filestore, linkdict, self.project, self.version)
+        return list(filter(fil, [ELink(self.filestore, linkdict, self.project,
+                                       self.version, linkstore=self)
                            for linkdict in self.verdata.get("+elinks", [])]))
 
     def _create_file_entry(self, basename, file_content, ref_hash_spec=None):
@@ -965,7 +1000,7 @@ class LinkStore:
         threadlog.info("added %r link %s", rel, file_entry.relpath)
         self._mark_dirty()
         return ELink(self.filestore, new_linkdict, self.project,
-                     self.version)
+                     self.version, linkstore=self)
 
 
 class SimplelinkMeta(CompareMixin):
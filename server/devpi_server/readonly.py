@@ -1,7 +1,8 @@
 """
 
 basic mechanics for turning a mutable dict/list/seq/tuple
-into a readonly view.
+into a frozen readonly container and for getting mutable
+copy-on-write copies back.
 """
 
 import py
@@ -9,102 +10,291 @@ import py
 _immutable = (py.builtin.text, type(None), int, py.builtin.bytes, float)
 
 def ensure_deeply_readonly(val):
-    """ return a recursive readonly-view wrapper around ``val`` in O(1) time.
+    """ return a recursively frozen readonly container for ``val``.
 
-    If the value is already a read-only view or if it is a deeply immutable
-    type return it verbatim.
+    If the value is already a read-only container or if it is a deeply
+    immutable type return it verbatim.
 
-    If the value is a basic container type return an appropriate
-    readonly-view of it.  Item accessing functions will maintain
-    the readonly property recursively.
+    If the value is a basic container type return an appropriate frozen
+    container with all contained values frozen as well.  Contained values
+    which are already frozen are reused, so freezing a copy-on-write copy
+    from ``get_mutable_copy`` only copies what was touched.  Accessing
+    items of the frozen containers doesn't allocate anything.
     """
     if isinstance(val, _immutable) or isinstance(val, ReadonlyView):
         return val
     if isinstance(val, dict):
         return DictViewReadonly(val)
-    elif isinstance(val, (tuple, list)):
+    elif isinstance(val, list):
         return SeqViewReadonly(val)
+    elif isinstance(val, tuple):
+        return TupleViewReadonly(val)
     elif isinstance(val, set):
         return SetViewReadonly(val)
     raise ValueError("don't know how to handle type %r" % type(val))
 
 
 def get_mutable_deepcopy(val):
-    """ return a deep copy of ``val`` so that there is no sharing
-    of mutable data between val and the returned copy."""
+    """ return a deep copy of ``val`` with plain containers so that there
+    is no sharing of mutable data between val and the returned copy."""
     if isinstance(val, _immutable):
         return val
-    if isinstance(val, ReadonlyView):
-        val = val._data
     if isinstance(val, dict):
-        return dict((k, get_mutable_deepcopy(v)) for k, v in val.items())
+        return dict(
+            (k, get_mutable_deepcopy(v)) for k, v in dict.items(val))
     elif isinstance(val, list):
+        # avoid the copy-on-write iteration of ListCopyOnWrite
+        return [get_mutable_deepcopy(item) for item in list.__iter__(val)]
+    elif isinstance(val, TupleViewReadonly):
+        return tuple(get_mutable_deepcopy(item) for item in val)
+    elif isinstance(val, SeqViewReadonly):
         return [get_mutable_deepcopy(item) for item in val]
     elif isinstance(val, tuple):
         return tuple(get_mutable_deepcopy(item) for item in val)
-    elif isinstance(val, set):
+    elif isinstance(val, (set, SetViewReadonly)):
         return set(item for item in val)
+    elif isinstance(val, frozenset):
+        return val
     raise ValueError("don't know how to handle type %r" % type(val))
 
 
+def get_mutable_copy(val):
+    """ return a mutable copy of ``val``.  For frozen containers only the
+    nested containers which are accessed get copied, values which are
+    never touched stay shared with ``val``.  Other values are deep copied
+    like with ``get_mutable_deepcopy``. """
+    if isinstance(val, DictViewReadonly):
+        if not _dict_copy_uses_getitem:
+            return get_mutable_deepcopy(val)
+        return DictCopyOnWrite(val)
+    elif isinstance(val, TupleViewReadonly):
+        return tuple(get_mutable_copy(item) for item in val)
+    elif isinstance(val, SeqViewReadonly):
+        return ListCopyOnWrite(val)
+    elif isinstance(val, SetViewReadonly):
+        return set(val)
+    return get_mutable_deepcopy(val)
+
+
 def is_deeply_readonly(val):
-    """ Return True if the value is either immutable or a readonly proxy
-    (which ensures only reading of data is possible). """
+    """ Return True if the value is either immutable or a frozen
+    container (which ensures only reading of data is possible). """
     return isinstance(val, ReadonlyView) or isinstance(val, _immutable)
 
 def is_sequence(val):
     """ Return True if the value is a readonly or normal sequence (list, tuple)"""
-    return isinstance(val, (ReadonlyView, list, tuple))
+    return isinstance(val, (ReadonlyView, list, tuple)) and not isinstance(
+        val, (dict, frozenset))
+
+
+def _readonly(self, *args, **kw):
+    raise AttributeError("%s is readonly" % self.__class__.__name__)
+
+
+def _no_item_assignment(self, *args):
+    raise TypeError(
+        "%s doesn't support item assignment" % self.__class__.__name__)
 
 
 class ReadonlyView(object):
-    def __init__(self, data):
-        self._data = data
+    """ Base class of all frozen containers. """
+    __slots__ = ()
+
+    @property
+    def _data(self):
+        # backward compatibility with the former wrapper classes
+        return self
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            self.__class__.__name__, repr(get_mutable_deepcopy(self)))
+
+
+class DictViewReadonly(ReadonlyView, dict):
+    __slots__ = ()
+
+    def __init__(self, data=()):
+        if isinstance(data, dict):
+            data = dict.items(data)
+        dict.__init__(self, (
+            (k, ensure_deeply_readonly(v)) for k, v in data))
+
+    __setitem__ = __delitem__ = _no_item_assignment
+    clear = pop = popitem = setdefault = update = _readonly
+    __ior__ = _readonly
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+class SeqViewReadonly(ReadonlyView, tuple):
+    """ frozen list """
+    __slots__ = ()
+
+    def __new__(cls, data=()):
+        if isinstance(data, list):
+            # avoid the copy-on-write iteration of ListCopyOnWrite
+            data = list.__iter__(data)
+        return tuple.__new__(cls, (ensure_deeply_readonly(x) for x in data))
+
+    # frozen lists only compare equal to lists, frozen tuples to tuples
+    _is_tuple = False
 
     def __eq__(self, other):
-        return self._data == other
+        if isinstance(other, SeqViewReadonly):
+            if self._is_tuple != other._is_tuple:
+                return False
+        elif isinstance(other, list):
+            if self._is_tuple:
+                return False
+            other = tuple(other)
+        elif isinstance(other, tuple):
+            if not self._is_tuple:
+                return False
+        else:
+            return NotImplemented
+        return tuple.__eq__(self, other)
 
     def __ne__(self, other):
-        return self._data != other
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
-    def __contains__(self, key):
-        return key in self._data
+    __hash__ = tuple.__hash__
 
-    def __len__(self):
-        return len(self._data)
+    def __reduce__(self):
+        return (self.__class__, (tuple(self),))
 
-    def __repr__(self):
-        return "%s(%s)" %(self.__class__.__name__, repr(self._data))
 
+class TupleViewReadonly(SeqViewReadonly):
+    """ frozen tuple """
+    __slots__ = ()
+    _is_tuple = True
 
-class DictViewReadonly(ReadonlyView):
-    def __iter__(self):
-        return iter(self._data)
 
-    def __getitem__(self, key):
-        return ensure_deeply_readonly(self._data[key])
+class SetViewReadonly(ReadonlyView, frozenset):
+    __slots__ = ()
+
+    def __reduce__(self):
+        return (self.__class__, (frozenset(self),))
 
-    def items(self):
-        for x, y in self._data.items():
-            yield x, ensure_deeply_readonly(y)
 
-    def keys(self):
-        return self._data.keys()
+class DictCopyOnWrite(dict):
+    """ mutable dict whose frozen values are replaced by mutable
+    copy-on-write copies when they are accessed. """
+
+    def _thaw(self, key, val):
+        if isinstance(val, ReadonlyView):
+            val = get_mutable_copy(val)
+            dict.__setitem__(self, key, val)
+        return val
+
+    def __getitem__(self, key):
+        return self._thaw(key, dict.__getitem__(self, key))
 
     def get(self, key, default=None):
-        val = self._data.get(key, default)
-        return ensure_deeply_readonly(val)
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        dict.__setitem__(self, key, default)
+        return default
+
+    def pop(self, key, *args):
+        val = dict.pop(self, key, *args)
+        if isinstance(val, ReadonlyView):
+            val = get_mutable_copy(val)
+        return val
+
+    def popitem(self):
+        key, val = dict.popitem(self)
+        if isinstance(val, ReadonlyView):
+            val = get_mutable_copy(val)
+        return key, val
 
+    def _thaw_all(self):
+        for key, val in list(dict.items(self)):
+            self._thaw(key, val)
+
+    def items(self):
+        self._thaw_all()
+        return dict.items(self)
+
+    def values(self):
+        self._thaw_all()
+        return dict.values(self)
 
-class SeqViewReadonly(ReadonlyView):
     def __iter__(self):
-        for x in self._data:
-            yield ensure_deeply_readonly(x)
+        # with its own __iter__ the dict is copied by ``dict()``,
+        # ``update`` and ``**`` through keys() and __getitem__ instead
+        # of the internal fast path, so the frozen values get thawed
+        return dict.__iter__(self)
 
-    def __getitem__(self, key):
-        return ensure_deeply_readonly(self._data[key])
+    def copy(self):
+        return DictCopyOnWrite(dict.items(self))
+
+
+def _dict_copy_uses_getitem():
+    # older Pythons copy all dict subclasses without calling __getitem__,
+    # which would hand out the frozen values of DictCopyOnWrite
+    class Check(dict):
+        __iter__ = DictCopyOnWrite.__iter__
+
+        def __getitem__(self, key):
+            return True
+    return dict(Check(x=False)) == dict(x=True)
 
 
-class SetViewReadonly(ReadonlyView):
+_dict_copy_uses_getitem = _dict_copy_uses_getitem()
+
+
+class ListCopyOnWrite(list):
+    """ mutable list whose frozen items are replaced by mutable
+    copy-on-write copies when they are accessed. """
+
+    def _thaw(self, index, val):
+        if isinstance(val, ReadonlyView):
+            val = get_mutable_copy(val)
+            list.__setitem__(self, index, val)
+        return val
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._thaw(index, list.__getitem__(self, index))
+
     def __iter__(self):
-        return iter(self._data)
+        for index in range(len(self)):
+            yield self[index]
+
+    # the list operations creating new lists don't use __getitem__
+
+    def __add__(self, other):
+        return list(self) + other
+
+    def __radd__(self, other):
+        return other + list(self)
+
+    def __mul__(self, count):
+        return list(self) * count
+
+    __rmul__ = __mul__
+
+    def copy(self):
+        return ListCopyOnWrite(list.__iter__(self))
+
+    def pop(self, *args):
+        val = list.pop(self, *args)
+        if isinstance(val, ReadonlyView):
+            val = get_mutable_copy(val)
+        return val
@@ -0,0 +1,74 @@
+"""
+re-encoding of stored changelog entries and values with the codec
+configured for the storage backend and a benchmark of the codecs.
+"""
+from __future__ import unicode_literals
+import time
+import py
+from .fileutil import Codec, loads, zstandard
+
+
+def recode_changelog(xom):
+    """ re-encode all stored data with the configured codec. """
+    tw = py.io.TerminalWriter()
+    storage = xom.keyfs._storage
+    recode = getattr(storage, "recode", None)
+    if recode is None:
+        tw.line("the storage backend doesn't support recoding", red=True)
+        return 1
+    tw.line("recoding with %r" % storage.codec, bold=True)
+    for table, count in recode():
+        tw.line("%s: recoded %s rows" % (table, count))
+    return 0
+
+
+def get_benchmark_codecs():
+    codecs = [
+        Codec("legacy"),
+        Codec("marshal", compression=None),
+        Codec("marshal", compression="zlib"),
+        Codec("marshal", compression="zlib", compress_min_size=0)]
+    if zstandard is not None:
+        codecs.extend([
+            Codec("marshal", compression="zstd"),
+            Codec("marshal", compression="zstd", compress_min_size=0)])
+    return codecs
+
+
+def benchmark_codecs(xom, max_entries=5000, rounds=3):
+    """ compare decode speed and size of the codecs using the
+    latest changelog entries. """
+    tw = py.io.TerminalWriter()
+    keyfs = xom.keyfs
+    with keyfs._storage.get_connection() as conn:
+        last_serial = conn.last_changelog_serial
+        first_serial = max(0, last_serial - max_entries + 1)
+        raw_entries = [
+            conn.get_raw_changelog_entry(serial)
+            for serial in range(first_serial, last_serial + 1)]
+    if not raw_entries:
+        tw.line("no changelog entries to benchmark with", red=True)
+        return 1
+    entries = [loads(x) for x in raw_entries]
+    tw.line("benchmarking with serials %s to %s" % (first_serial, last_serial))
+    results = [("stored", raw_entries)]
+    for codec in get_benchmark_codecs():
+        name = "%s/%s>=%s" % (
+            codec.encoding, codec.compression, codec.compress_min_size)
+        results.append((name, [codec.dumps(x) for x in entries]))
+    # throughput is measured on the size in the legacy format
+    legacy_size = sum(len(x) for x in results[1][1])
+    tw.line("%-30s %14s %14s" % ("codec", "size (bytes)", "decode (MB/s)"))
+    for name, datas in results:
+        size = sum(len(x) for x in datas)
+        duration = None
+        for i in range(rounds):
+            start = time.time()
+            for data in datas:
+                loads(data)
+            elapsed = time.time() - start
+            if duration is None or elapsed < duration:
+                duration = elapsed
+        throughput = legacy_size / max(duration, 1e-9) / 1e6
+        tw.line("%-30s %14d %14.1f" % (name, size, throughput))
+    return 0
@@ -1,16 +1,22 @@
 import os
 import json
 import contextlib
+import sqlite3
+import struct
+import threading
 import time
+import py
 from pyramid.httpexceptions import HTTPNotFound, HTTPAccepted, HTTPBadRequest
-from pyramid.httpexceptions import HTTPForbidden
+from pyramid.httpexceptions import HTTPForbidden, HTTPGone
 from pyramid.view import view_config
 from pyramid.response import Response
 from devpi_common.validation import normalize_name
 from webob.headers import EnvironHeaders, ResponseHeaders
 
 from . import mythread
-from .fileutil import loads, rename
+from .filestore import Spool
+from .fileutil import dumps, loads, rename
+from .fileutil import Codec, get_codec_info, get_supported_codecs
 from .log import thread_push_log, threadlog
 from .views import is_mutating_http_method, H_MASTER_UUID, make_uuid_headers
 from .model import UpstreamError
@@ -19,12 +25,70 @@ H_REPLICA_UUID = str("X-DEVPI-REPLICA-UUID")
 H_REPLICA_OUTSIDE_URL = str("X-DEVPI-REPLICA-OUTSIDE-URL")
 H_REPLICA_FILEREPL = str("X-DEVPI-REPLICA-FILEREPL")
 H_EXPECTED_MASTER_ID = str("X-DEVPI-EXPECTED-MASTER-ID")
+H_REPLICA_CODECS = str("X-DEVPI-REPLICA-CODECS")
+H_UPSTREAM_SERIALS = str("X-DEVPI-UPSTREAM-SERIALS")
 
 MAX_REPLICA_BLOCK_TIME = 30.0
 
+# seconds between empty frames on an idle changelog stream
+STREAM_HEARTBEAT_INTERVAL = 10.0
+
+# bytes relayed at once between the master and clients of a replica
+PROXY_CHUNK_SIZE = 65536
+
+# maximum number of changelog entries sent in one response
+MAX_CHANGELOG_RANGE = 1000
+
+# the snapshot is only read by replicas of the same version,
+# so it doesn't need to be readable by older ones
+SNAPSHOT_CODEC = Codec("marshal", compression="zlib", compress_min_size=0)
+
+# uncompressed changelog entries of at least this size are compressed
+# before they are sent to replicas which can read compressed entries
+REPLICA_COMPRESS_MIN_SIZE = 1024
+FRAME_HEADER = struct.Struct("!I")
+
+
+def dump_frame(data):
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def dump_snapshot_frame(kind, data, codec=SNAPSHOT_CODEC):
+    return dump_frame(codec.dumps((kind, data)))
+
+
+def _read_exactly(f, size):
+    data = b""
+    while len(data) < size:
+        chunk = f.read(size - len(data))
+        if not chunk:
+            raise ValueError("response is truncated")
+        data += chunk
+    return data
+
+
+def iter_frames(f):
+    """ yield the length prefixed frames read from the file like
+    object f. """
+    while 1:
+        header = f.read(FRAME_HEADER.size)
+        if not header:
+            return
+        header += _read_exactly(f, FRAME_HEADER.size - len(header))
+        (size,) = FRAME_HEADER.unpack(header)
+        yield _read_exactly(f, size)
+
+
+def iter_snapshot_frames(f):
+    """ yield the (kind, data) frames of a snapshot read from the file
+    like object f. """
+    for data in iter_frames(f):
+        yield loads(data)
+
 
 class MasterChangelogRequest:
     MAX_REPLICA_BLOCK_TIME = MAX_REPLICA_BLOCK_TIME
+    STREAM_HEARTBEAT_INTERVAL = STREAM_HEARTBEAT_INTERVAL
 
     def __init__(self, request):
         self.request = request
@@ -36,7 +100,7 @@ class MasterChangelogRequest:
         uuid = headers.get(H_REPLICA_UUID)
         if uuid:
             polling_replicas = self.xom.polling_replicas
-            polling_replicas[uuid] = {
+            status = polling_replicas[uuid] = {
                 "remote-ip": self.request.get_remote_ip(),
                 # the replica always polls its own serial+1
                 # and we want to show where the replica serial is at
@@ -46,12 +110,12 @@ class MasterChangelogRequest:
                 "outside-url": headers.get(H_REPLICA_OUTSIDE_URL),
             }
             try:
-                yield
+                yield status
             finally:
-                polling_replicas[uuid]["last-request"] = time.time()
-                polling_replicas[uuid]["in-request"] = False
+                status["last-request"] = time.time()
+                status["in-request"] = False
         else:  # just a regular request
-            yield
+            yield None
 
     @view_config(route_name="/+changelog/{serial}")
     def get_changes(self):
@@ -66,23 +130,7 @@ class MasterChangelogRequest:
         #   never time out here, leading to more and more threads
         # if no commits happen.
 
-        if not self.xom.is_master():
-            raise HTTPForbidden("Replication protocol disabled")
-        expected_uuid = self.request.headers.get(H_EXPECTED_MASTER_ID, None)
-        master_uuid = self.xom.config.get_master_uuid()
-        # we require the header but it is allowed to be empty
-        # (during initialization)
-        if expected_uuid is None:
-            msg = "replica sent no %s header" % H_EXPECTED_MASTER_ID
-            threadlog.error(msg)
-            raise HTTPBadRequest(msg)
-
-        if expected_uuid and expected_uuid != master_uuid:
-            threadlog.error("expected %r as master_uuid, replica sent %r", master_uuid,
-                      expected_uuid)
-            raise HTTPBadRequest("expected %s as master_uuid, replica sent %s" %
-                                 (master_uuid, expected_uuid))
-
+        self._check_replica_request()
         serial = self.request.matchdict["serial"]
 
         with self.update_replica_status(serial):
@@ -95,6 +143,7 @@ class MasterChangelogRequest:
                 except ValueError:
                     raise HTTPNotFound("serial needs to be int")
                 raw_entry = self._wait_for_entry(serial)
+                raw_entry = self._encode_for_replica(raw_entry, serial)
 
             devpi_serial = keyfs.get_current_serial()
             r = Response(body=raw_entry, status=200, headers={
@@ -103,6 +152,174 @@ class MasterChangelogRequest:
             })
             return r
 
+    @view_config(route_name="/+changelog/{start}-{end}")
+    def get_changes_range(self):
+        # like get_changes, but returns all available changelog entries
+        # from {start} to {end}, each prefixed with its length, so a
+        # replica which is behind doesn't need a request per serial
+        self._check_replica_request()
+        # the route only matches digits
+        start = int(self.request.matchdict["start"])
+        end = int(self.request.matchdict["end"])
+        if end < start:
+            raise HTTPBadRequest("end serial is before start serial")
+        with self.update_replica_status(start):
+            keyfs = self.xom.keyfs
+            # waits for start if it is the next serial
+            first_entry = self._encode_for_replica(
+                self._wait_for_entry(start), start)
+            devpi_serial = keyfs.get_current_serial()
+            end = min(end, devpi_serial, start + MAX_CHANGELOG_RANGE - 1)
+            return Response(
+                app_iter=self._iter_changes(first_entry, start + 1, end),
+                status=200, headers={
+                    str("Content-Type"): str("application/octet-stream"),
+                    str("X-DEVPI-SERIAL"): str(devpi_serial)})
+
+    def _iter_changes(self, first_entry, start, end):
+        # called after the transaction of the request is finished
+        yield dump_frame(first_entry)
+        with self.xom.keyfs._storage.get_connection() as conn:
+            for serial in range(start, end + 1):
+                raw_entry = conn.get_raw_changelog_entry(serial)
+                if raw_entry is None:
+                    # pruned meanwhile, the replica asks again
+                    return
+                yield dump_frame(self._encode_for_replica(raw_entry, serial))
+
+    @view_config(route_name="/+changelog/{start}-")
+    def get_changes_stream(self):
+        # keeps the response open and sends the changelog entries from
+        # {start} on as they are committed, each prefixed with its
+        # length.  While there are no new entries an empty frame is sent
+        # every STREAM_HEARTBEAT_INTERVAL seconds, so the replica knows
+        # it is in sync and we notice when the replica went away.
+        self._check_replica_request()
+        # the route only matches digits
+        start = int(self.request.matchdict["start"])
+        keyfs = self.xom.keyfs
+        devpi_serial = keyfs.get_current_serial()
+        if start > devpi_serial + 1:
+            raise HTTPNotFound("can only stream from the next serial")
+        if start <= devpi_serial:
+            if keyfs.tx.conn.get_raw_changelog_entry(start) is None:
+                raise HTTPGone(
+                    "changelog entry was removed by a changelog compaction")
+        return Response(
+            app_iter=self._iter_stream(start),
+            status=200, headers={
+                str("Content-Type"): str("application/octet-stream"),
+                str("X-DEVPI-SERIAL"): str(devpi_serial)})
+
+    def _iter_stream(self, serial):
+        # called after the transaction of the request is finished,
+        # runs until the replica disconnects or the server shuts down
+        keyfs = self.xom.keyfs
+        thread_pool = self.xom.thread_pool
+        with self.update_replica_status(serial) as status:
+            while 1:
+                try:
+                    thread_pool.exit_if_shutdown()
+                except mythread.Shutdown:
+                    return
+                arrived = keyfs.wait_tx_serial(
+                    serial, timeout=self.STREAM_HEARTBEAT_INTERVAL)
+                if not arrived:
+                    yield dump_frame(b"")
+                    continue
+                end = min(
+                    keyfs.get_current_serial(),
+                    serial + MAX_CHANGELOG_RANGE - 1)
+                with keyfs._storage.get_connection() as conn:
+                    raw_entries = [
+                        conn.get_raw_changelog_entry(x)
+                        for x in range(serial, end + 1)]
+                for raw_entry in raw_entries:
+                    if raw_entry is None:
+                        # pruned meanwhile, the replica reconnects
+                        return
+                    yield dump_frame(
+                        self._encode_for_replica(raw_entry, serial))
+                    serial += 1
+                if status is not None:
+                    status["serial"] = serial - 1
+                    status["last-request"] = time.time()
+
+    def _check_replica_request(self):
+        xom = self.xom
+        if xom.is_replica() and xom.config.args.replica_cascade:
+            # downstream replicas get the serials known upstream of us
+            # with every response, so they can report the lag per hop
+            self.request.add_response_callback(self._add_upstream_serials)
+        elif not xom.is_master():
+            raise HTTPForbidden("Replication protocol disabled")
+        expected_uuid = self.request.headers.get(H_EXPECTED_MASTER_ID, None)
+        master_uuid = self.xom.config.get_master_uuid()
+        # we require the header but it is allowed to be empty
+        # (during initialization)
+        if expected_uuid is None:
+            msg = "replica sent no %s header" % H_EXPECTED_MASTER_ID
+            threadlog.error(msg)
+            raise HTTPBadRequest(msg)
+
+        if expected_uuid and expected_uuid != master_uuid:
+            threadlog.error("expected %r as master_uuid, replica sent %r", master_uuid,
+                      expected_uuid)
+            raise HTTPBadRequest("expected %s as master_uuid, replica sent %s" %
+                                 (master_uuid, expected_uuid))
+
+    @view_config(route_name="/+snapshot")
+    def get_snapshot(self):
+        # this method is called from new replicas which initialize from
+        # the state at the current serial instead of fetching all
+        # changelog entries.  The response is a stream of frames, a
+        # "header" with the serial and its changelog entry, "keys" with
+        # lists of (relpath, keyname, last_serial, value), "files" with
+        # the relpaths of files to replicate and "end" with the counts.
+        self._check_replica_request()
+        keyfs = self.xom.keyfs
+        serial = keyfs.tx.at_serial
+        if serial < 0:
+            raise HTTPNotFound("no changes to make a snapshot of")
+        raw_entry = self._encode_for_replica(
+            keyfs.tx.conn.get_raw_changelog_entry(serial), serial)
+        return Response(
+            app_iter=self._iter_snapshot(
+                serial, raw_entry, self._get_snapshot_codec()),
+            status=200, headers={
+                str("Content-Type"): str("application/octet-stream"),
+                str("X-DEVPI-SERIAL"): str(serial)})
+
+    def _iter_snapshot(self, serial, raw_entry, codec):
+        # called after the transaction of the request is finished
+        keyfs = self.xom.keyfs
+        filestore = self.xom.filestore
+        file_keynames = (keyfs.STAGEFILE.name, keyfs.PYPIFILE_NOMD5.name)
+        key_count = 0
+        files = []
+        yield dump_snapshot_frame("header", dict(
+            serial=serial, changelog_entry=raw_entry), codec)
+        with keyfs.transaction(write=False, at_serial=serial) as tx:
+            for entries in tx.iter_snapshot():
+                key_count += len(entries)
+                yield dump_snapshot_frame("keys", entries, codec)
+                for relpath, keyname, last_serial, val in entries:
+                    if keyname not in file_keynames:
+                        continue
+                    key = keyfs.get_key_instance(keyname, relpath)
+                    entry = filestore.get_file_entry_raw(key, val)
+                    if entry.last_modified is not None:
+                        files.append(relpath)
+        yield dump_snapshot_frame("files", files, codec)
+        yield dump_snapshot_frame("end", dict(
+            keys=key_count, files=len(files)), codec)
+
+    def _add_upstream_serials(self, request, response):
+        serials = self.xom.replica_thread.get_upstream_serials()
+        if serials:
+            response.headers[H_UPSTREAM_SERIALS] = str(
+                ",".join(str(x) for x in serials))
+
     def _wait_for_entry(self, serial):
         keyfs = self.xom.keyfs
         next_serial = keyfs.get_next_serial()
@@ -114,7 +331,57 @@ class MasterChangelogRequest:
                 raise HTTPAccepted("no new transaction yet",
                     headers={str("X-DEVPI-SERIAL"):
                              str(keyfs.get_current_serial())})
-        return keyfs.tx.conn.get_raw_changelog_entry(serial)
+        raw_entry = keyfs.tx.conn.get_raw_changelog_entry(serial)
+        if raw_entry is None:
+            raise HTTPGone(
+                "changelog entry was removed by a changelog compaction")
+        return raw_entry
+
+    def _get_accepted_codecs(self):
+        # replicas tell us which encodings and compressions they can
+        # read, older ones only know the legacy format
+        accepted = set(
+            x.strip() for x in
+            self.request.headers.get(H_REPLICA_CODECS, "").split(","))
+        accepted.update(("legacy", "none"))
+        return accepted
+
+    def _get_wire_compression(self, accepted):
+        for compression in ("zstd", "zlib"):
+            if compression in accepted and compression in get_supported_codecs():
+                return compression
+
+    def _get_snapshot_codec(self):
+        compression = self._get_wire_compression(self._get_accepted_codecs())
+        if compression in (None, "zlib"):
+            return SNAPSHOT_CODEC
+        return Codec("marshal", compression=compression, compress_min_size=0)
+
+    def _encode_for_replica(self, raw_entry, serial):
+        accepted = self._get_accepted_codecs()
+        (encoding, compression) = get_codec_info(raw_entry)
+        if encoding not in accepted or compression not in accepted:
+            return dumps(loads(raw_entry))
+        if compression != "none" or len(raw_entry) < REPLICA_COMPRESS_MIN_SIZE:
+            return raw_entry
+        if "marshal" not in accepted:
+            return raw_entry
+        compression = self._get_wire_compression(accepted)
+        if compression is None:
+            return raw_entry
+        # compress each serial only once for all replicas, the entry
+        # of a serial never changes
+        cache = self.xom.replica_entry_cache
+        cache_key = (serial, compression)
+        data = cache.get(cache_key)
+        if data is None:
+            codec = Codec(
+                "marshal", compression=compression, compress_min_size=0)
+            data = codec.dumps(loads(raw_entry))
+            if len(data) >= len(raw_entry):
+                data = raw_entry
+            cache.put(cache_key, data)
+        return data
 
 
 class ReplicaThread:
@@ -124,8 +391,19 @@ class ReplicaThread:
     def __init__(self, xom):
         self.xom = xom
         self.master_url = xom.config.master_url
+        # whether the master supports fetching ranges of changelog entries
+        self.use_range = True
+        # whether to get new changelog entries from a stream
+        self.use_stream = bool(xom.config.args.replica_stream)
+        self.errors = ReplicationErrors(xom.config.serverdir)
+        # files are downloaded by FileReplicationWorker threads if enabled
+        self.file_queue = None
+        if xom.config.args.replica_file_workers > 0:
+            self.file_queue = FileReplicationQueue(xom.config.serverdir)
         self._master_serial = None
         self._master_serial_timestamp = None
+        # serials further upstream if our master is a replica itself
+        self._upstream_serials = []
         self.started_at = None
         # updated whenever we try to connect to the master
         self.master_contacted_at = None
@@ -140,6 +418,29 @@ class ReplicaThread:
     def get_master_serial_timestamp(self):
         return self._master_serial_timestamp
 
+    def get_upstream_serials(self):
+        """ return the serials of all servers upstream of us, starting
+        with our master and ending with the master of the cascade. """
+        if self._master_serial is None:
+            return []
+        serials = [self._master_serial]
+        for serial in self._upstream_serials:
+            # the header is only updated with each request, so with a
+            # stream it can be older than what we already got through it
+            serials.append(max(serial, serials[-1]))
+        return serials
+
+    def update_upstream_serials(self, headers):
+        value = headers.get(H_UPSTREAM_SERIALS)
+        if value:
+            try:
+                self._upstream_serials = [int(x) for x in value.split(",")]
+            except ValueError:
+                self.log.error(
+                    "invalid %s header: %r", H_UPSTREAM_SERIALS, value)
+        else:
+            self._upstream_serials = []
+
     def update_master_serial(self, serial):
         now = time.time()
         # record that we got a reply from the master, so we can produce status
@@ -162,7 +463,19 @@ class ReplicaThread:
         config = self.xom.config
         self.thread.exit_if_shutdown()
         serial = keyfs.get_next_serial()
-        url = self.master_url.joinpath("+changelog", str(serial)).url
+        master_serial = self._master_serial
+        is_range = bool(
+            self.use_range and master_serial is not None and
+            master_serial > serial)
+        is_stream = not is_range and self.use_stream
+        if is_range:
+            end = min(master_serial, serial + MAX_CHANGELOG_RANGE - 1)
+            url = self.master_url.joinpath(
+                "+changelog", "%s-%s" % (serial, end)).url
+        elif is_stream:
+            url = self.master_url.joinpath("+changelog", "%s-" % serial).url
+        else:
+            url = self.master_url.joinpath("+changelog", str(serial)).url
         log.info("fetching %s", url)
         uuid, master_uuid = make_uuid_headers(config.nodeinfo)
         assert uuid != master_uuid
@@ -172,11 +485,25 @@ class ReplicaThread:
                 H_REPLICA_UUID: uuid,
                 H_EXPECTED_MASTER_ID: master_uuid,
                 H_REPLICA_OUTSIDE_URL: config.args.outside_url,
-            }, timeout=self.REPLICA_REQUEST_TIMEOUT)
+                H_REPLICA_CODECS: ",".join(get_supported_codecs()),
+            }, stream=is_stream, timeout=self.REPLICA_REQUEST_TIMEOUT)
+            if is_range and r.status_code == 404:
+                log.warn(
+                    "master doesn't support fetching ranges of changelog "
+                    "entries, fetching one entry per request")
+                self.use_range = False
+                return
+            if is_stream and r.status_code == 404:
+                log.warn(
+                    "master doesn't support streaming changelog entries, "
+                    "polling instead")
+                self.use_stream = False
+                return
             remote_serial = int(r.headers["X-DEVPI-SERIAL"])
         except Exception as e:
             log.error("error fetching %s: %s", url, str(e))
         else:
+            self.update_upstream_serials(r.headers)
             # we check that the remote instance
             # has the same UUID we saw last time
             master_uuid = config.get_master_uuid()
@@ -202,8 +529,19 @@ class ReplicaThread:
 
             if r.status_code == 200:
                 try:
-                    changes, rel_renames = loads(r.content)
-                    keyfs.import_changes(serial, changes)
+                    if is_stream:
+                        # the stream can stay open for a long time
+                        if not master_uuid:
+                            self.xom.config.set_master_uuid(remote_master_uuid)
+                        self.import_stream(serial, r, remote_serial)
+                    elif is_range:
+                        entries = [
+                            loads(x)[0]
+                            for x in iter_frames(py.io.BytesIO(r.content))]
+                        keyfs.import_changes_many(serial, entries)
+                    else:
+                        changes, rel_renames = loads(r.content)
+                        keyfs.import_changes(serial, changes)
                 except Exception:
                     log.exception("could not process: %s", r.url)
                 else:
@@ -211,28 +549,150 @@ class ReplicaThread:
                     # record the master_uuid for future consistency checks
                     if not master_uuid:
                         self.xom.config.set_master_uuid(remote_master_uuid)
-                    # also record the current master serial for status info
-                    self.update_master_serial(remote_serial)
+                    if not is_stream:
+                        # also record the current master serial for status info
+                        self.update_master_serial(remote_serial)
                     return
             elif r.status_code == 202:
                 log.debug("%s: trying again %s\n", r.status_code, url)
                 # also record the current master serial for status info
                 self.update_master_serial(remote_serial)
                 return
+            elif r.status_code == 410:
+                log.error(
+                    "%s: the master compacted its changelog beyond %s, "
+                    "this replica has to be set up again", r.status_code, url)
             else:
                 log.error("%s: failed fetching %s", r.status_code, url)
         # we got an error, let's wait a bit
         self.thread.sleep(5.0)
 
+    def import_stream(self, serial, r, master_serial):
+        """ import the changelog entries from serial on which the master
+        sends on the streamed response r until the connection ends. """
+        keyfs = self.xom.keyfs
+        self.update_master_serial(master_serial)
+        try:
+            for data in iter_frames(r.raw):
+                self.thread.exit_if_shutdown()
+                if data:
+                    changes, rel_renames = loads(data)
+                    keyfs.import_changes(serial, changes)
+                    master_serial = max(master_serial, serial)
+                    serial += 1
+                # empty frames are heartbeats while we are in sync
+                self.update_master_serial(master_serial)
+        finally:
+            r.close()
+        self.log.info("changelog stream from master ended at %s", serial)
+
+    def fetch_snapshot(self):
+        """ import a snapshot of the master state into the empty replica.
+        Returns the relpaths of the files to replicate or None if the
+        master can't provide a snapshot. """
+        log = self.log
+        keyfs = self.xom.keyfs
+        config = self.xom.config
+        url = self.master_url.joinpath("+snapshot").url
+        log.info("fetching %s", url)
+        uuid, master_uuid = make_uuid_headers(config.nodeinfo)
+        assert uuid != master_uuid
+        self.master_contacted_at = time.time()
+        r = self.session.get(url, headers={
+            H_REPLICA_UUID: uuid,
+            H_EXPECTED_MASTER_ID: master_uuid,
+            H_REPLICA_OUTSIDE_URL: config.args.outside_url,
+            H_REPLICA_CODECS: ",".join(get_supported_codecs()),
+        }, stream=True, timeout=self.REPLICA_REQUEST_TIMEOUT)
+        if r.status_code != 200:
+            log.error(
+                "%s: no snapshot available from %s, replaying the changelog "
+                "instead", r.status_code, url)
+            return None
+        remote_master_uuid = r.headers.get(H_MASTER_UUID)
+        if master_uuid and remote_master_uuid != master_uuid:
+            raise ValueError(
+                "master UUID %r does not match expected master UUID %r" % (
+                    remote_master_uuid, master_uuid))
+        frames = iter_snapshot_frames(r.raw)
+        (kind, header) = next(frames)
+        if kind != "header":
+            raise ValueError("snapshot doesn't start with a header")
+        serial = header["serial"]
+        changes, rel_renames = loads(header["changelog_entry"])
+        files = []
+        counts = {}
+
+        def iter_key_batches():
+            for kind, data in frames:
+                if kind == "keys":
+                    yield data
+                elif kind == "files":
+                    files.extend(data)
+                elif kind == "end":
+                    counts.update(data)
+                    return
+            raise ValueError("snapshot is incomplete")
+
+        count = keyfs.import_snapshot(serial, changes, iter_key_batches())
+        if not master_uuid:
+            config.set_master_uuid(remote_master_uuid)
+        log.info(
+            "imported snapshot of %s keys and %s files at serial %s",
+            count, counts["files"], serial)
+        self.update_master_serial(int(r.headers["X-DEVPI-SERIAL"]))
+        return files
+
+    def replicate_files(self, relpaths):
+        """ fetch the files from the snapshot which aren't stored yet,
+        files which fail here are fetched again on first access. """
+        keyfs = self.xom.keyfs
+        filestore = self.xom.filestore
+        if self.file_queue is not None:
+            for relpath in relpaths:
+                self.file_queue.add(relpath)
+            return
+        for relpath in relpaths:
+            self.thread.exit_if_shutdown()
+            with keyfs.transaction(write=False):
+                entry = filestore.get_file_entry(relpath)
+                if entry is None or entry.file_exists():
+                    continue
+                try:
+                    for part in entry.iter_remote_file_replica():
+                        pass
+                except entry.BadGateway as e:
+                    self.log.error("could not replicate %s: %s", relpath, e)
+
+    def bootstrap(self):
+        """ initialize the empty replica from a snapshot of the master,
+        retrying on errors. """
+        while 1:
+            self.thread.exit_if_shutdown()
+            try:
+                files = self.fetch_snapshot()
+            except mythread.Shutdown:
+                raise
+            except Exception:
+                self.log.exception("could not import snapshot from master")
+                self.thread.sleep(5.0)
+                continue
+            if files:
+                self.replicate_files(files)
+            return
+
     def thread_run(self):
         # within a devpi replica server this thread is the only writer
         self.started_at = time.time()
         self.log = thread_push_log("[REP]")
         self.session = self.xom.new_http_session("replica")
         keyfs = self.xom.keyfs
-        errors = ReplicationErrors(self.xom.config.serverdir)
         for key in (keyfs.STAGEFILE, keyfs.PYPIFILE_NOMD5):
-            keyfs.subscribe_on_import(key, ImportFileReplica(self.xom, errors))
+            keyfs.subscribe_on_import(key, ImportFileReplica(
+                self.xom, self.errors, queue=self.file_queue))
+        if self.xom.config.args.replica_bootstrap:
+            if keyfs.get_current_serial() == -1:
+                self.bootstrap()
         while 1:
             try:
                 self.tick()
@@ -321,15 +781,35 @@ def clean_response_headers(response):
     return headers
 
 
+class RequestBodyReader:
+    """ file like access to the body of a request, so it can be streamed
+    to the master without reading all of it into memory first. """
+
+    def __init__(self, request):
+        self.length = request.content_length
+        self.f = request.body_file
+
+    def __len__(self):
+        # tells requests the size, otherwise it uses chunked encoding
+        return self.length or 0
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+
 def proxy_request_to_master(xom, request, stream=False):
     master_url = xom.config.master_url
     url = master_url.joinpath(request.path).url
     assert url.startswith(master_url.url)
     http = xom._httpsession
+    if request.content_length:
+        data = RequestBodyReader(request)
+    else:
+        data = request.body
     with threadlog.around("info", "relaying: %s %s", request.method, url):
         try:
             return http.request(request.method, url,
-                                data=request.body,
+                                data=data,
                                 headers=clean_request_headers(request),
                                 stream=stream,
                                 allow_redirects=False)
@@ -337,20 +817,34 @@ def proxy_request_to_master(xom, request, stream=False):
             raise UpstreamError("proxy-write-to-master %s: %s" % (url, e))
 
 
+def iter_proxied_response(xom, r, commit_serial):
+    """ yield the body of the master response r in chunks, the last one
+    only after the change with commit_serial is replicated back. """
+    try:
+        last = None
+        while 1:
+            data = r.raw.read(PROXY_CHUNK_SIZE)
+            if not data:
+                break
+            if last is not None:
+                yield last
+            last = data
+        if commit_serial is not None:
+            xom.keyfs.wait_tx_serial(commit_serial)
+        if last is not None:
+            yield last
+    finally:
+        r.close()
+
+
 def proxy_write_to_master(xom, request):
     """ relay modifying http requests to master and wait until
     the change is replicated back.
     """
     r = proxy_request_to_master(xom, request, stream=True)
-    # for redirects, the body is already read and stored in the ``next``
-    # attribute (see requests.sessions.send)
-    if r.raw.closed and r.next:
-        body = r.next.body
-    else:
-        body = r.raw.read()
+    commit_serial = None
     if r.status_code < 400:
         commit_serial = int(r.headers["X-DEVPI-SERIAL"])
-        xom.keyfs.wait_tx_serial(commit_serial)
     headers = clean_response_headers(r)
     headers[str("X-DEVPI-PROXY")] = str("replica")
     if r.status_code == 302:  # REDIRECT
@@ -359,15 +853,24 @@ def proxy_write_to_master(xom, request):
         outside_url = request.application_url
         headers[str("location")] = str(
             master_location.replace(xom.config.master_url.url, outside_url))
-    return Response(status="%s %s" %(r.status_code, r.reason),
-                    body=body,
-                    headers=headers)
+    status = "%s %s" % (r.status_code, r.reason)
+    # for redirects, the body is already read and stored in the ``next``
+    # attribute (see requests.sessions.send)
+    if r.raw.closed and r.next:
+        if commit_serial is not None:
+            xom.keyfs.wait_tx_serial(commit_serial)
+        return Response(status=status, body=r.next.body, headers=headers)
+    return Response(
+        status=status, headers=headers,
+        app_iter=iter_proxied_response(xom, r, commit_serial))
 
 
 class ReplicationErrors:
     def __init__(self, serverdir):
         self.errorsfn = serverdir.join(".replicationerrors")
         self.errors = dict()
+        # the file replication workers share one instance
+        self._lock = threading.Lock()
         self._read()
 
     def _read(self):
@@ -386,18 +889,178 @@ class ReplicationErrors:
         rename(tmppath, self.errorsfn.strpath)
 
     def remove(self, entry):
-        if self.errors.pop(entry.relpath, None) is not None:
-            self._write()
+        with self._lock:
+            if self.errors.pop(entry.relpath, None) is not None:
+                self._write()
 
     def add(self, error):
-        self.errors[error['relpath']] = error
-        self._write()
+        with self._lock:
+            self.errors[error['relpath']] = error
+            self._write()
+
+
+class FileReplicationQueue:
+    """ Persistent queue of the relpaths of release files which still
+    have to be downloaded from the master.  It is kept in a sqlite
+    database in the serverdir, so downloads which didn't happen before
+    a restart are picked up again. """
+    # seconds before the first retry of a failed download,
+    # doubled for every further failure
+    retry_delay = 5.0
+    max_retry_delay = 3600.0
+
+    def __init__(self, serverdir):
+        self.path = serverdir.join(".replicationqueue.sqlite")
+        self._cv = threading.Condition()
+        # relpath -> rowid of the queue entries being downloaded
+        self._in_flight = {}
+        self._sqlconn = sqlite3.connect(
+            self.path.strpath, check_same_thread=False)
+        self._sqlconn.execute("""
+            CREATE TABLE IF NOT EXISTS queue (
+                relpath TEXT NOT NULL PRIMARY KEY,
+                tries INTEGER NOT NULL,
+                next_try REAL NOT NULL)
+        """)
+        self._sqlconn.commit()
+
+    def add(self, relpath):
+        """ queue relpath for downloading, replacing an existing entry. """
+        with self._cv:
+            self._sqlconn.execute(
+                "INSERT OR REPLACE INTO queue (relpath, tries, next_try) "
+                "VALUES (?, 0, 0)", (relpath,))
+            self._sqlconn.commit()
+            self._cv.notify()
+
+    def discard(self, relpath):
+        with self._cv:
+            self._sqlconn.execute(
+                "DELETE FROM queue WHERE relpath = ?", (relpath,))
+            self._sqlconn.commit()
+
+    def get(self, timeout=None):
+        """ return the next relpath which is due for downloading and
+        mark it as in flight, or None if there was none within timeout. """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cv:
+            while 1:
+                now = time.time()
+                in_flight = list(self._in_flight)
+                q = (
+                    "SELECT _ROWID_, relpath, next_try FROM queue "
+                    "WHERE relpath NOT IN (%s) ORDER BY next_try LIMIT 1" %
+                    ",".join("?" * len(in_flight)))
+                row = self._sqlconn.execute(q, in_flight).fetchone()
+                wait = None if deadline is None else deadline - now
+                if row is not None:
+                    (rowid, relpath, next_try) = row
+                    if next_try <= now:
+                        self._in_flight[relpath] = rowid
+                        return relpath
+                    if wait is None or next_try - now < wait:
+                        wait = next_try - now
+                if wait is not None and wait <= 0:
+                    return None
+                self._cv.wait(wait)
+
+    def done(self, relpath):
+        """ remove relpath after it was handled, unless it was queued
+        again in the meantime. """
+        with self._cv:
+            rowid = self._in_flight.pop(relpath)
+            self._sqlconn.execute(
+                "DELETE FROM queue WHERE _ROWID_ = ?", (rowid,))
+            self._sqlconn.commit()
+            self._cv.notify()
+
+    def retry(self, relpath):
+        """ schedule another try of relpath with exponential backoff
+        and return the number of failed tries. """
+        with self._cv:
+            rowid = self._in_flight.pop(relpath)
+            row = self._sqlconn.execute(
+                "SELECT tries FROM queue WHERE _ROWID_ = ?",
+                (rowid,)).fetchone()
+            if row is None:
+                # queued again in the meantime
+                self._cv.notify()
+                return 0
+            tries = row[0] + 1
+            delay = min(
+                self.retry_delay * 2 ** (tries - 1), self.max_retry_delay)
+            self._sqlconn.execute(
+                "UPDATE queue SET tries = ?, next_try = ? WHERE _ROWID_ = ?",
+                (tries, time.time() + delay, rowid))
+            self._sqlconn.commit()
+            self._cv.notify()
+            return tries
+
+    def wakeup(self):
+        with self._cv:
+            self._cv.notify_all()
+
+    def get_stats(self):
+        with self._cv:
+            (queued,) = self._sqlconn.execute(
+                "SELECT COUNT(*) FROM queue").fetchone()
+            return {
+                "queued": queued,
+                "in-flight": len(self._in_flight)}
+
+
+def download_replica_file(xom, entry, errors, spool):
+    """ download the file of entry from the master into spool and return
+    whether its content should be stored.  The checksum is updated while
+    writing to the spool.  Raises FileReplicationError on failures. """
+    relpath = entry.relpath
+    threadlog.info("retrieving file from master: %s", relpath)
+    url = xom.config.master_url.joinpath(relpath).url
+    # we perform the request with a special header so that
+    # the master can avoid -getting "volatile" links
+    r = xom.httpget(url, allow_redirects=True, extra_headers=
+                    {H_REPLICA_FILEREPL: str("YES")})
+    if r.status_code == 410:
+        # master indicates Gone for files which were later deleted
+        threadlog.warn("ignoring because of later deletion: %s",
+                       relpath)
+        return False
+    if r.status_code != 200:
+        raise FileReplicationError(r, relpath)
+    spool.write_stream(r.raw)
+    if entry.hash_spec:
+        err = spool.get_checksum_error(entry.hash_spec)
+        if err:
+            # the file we got is different, it may have changed later.
+            # we remember the error and move on
+            errors.add(dict(
+                url=r.url,
+                message="%s: %s" % (relpath, err),
+                relpath=relpath))
+            return False
+    # in case there were errors before, we can now remove them
+    errors.remove(entry)
+    return True
+
+
+def new_replica_spool(f, entry):
+    """ return a Spool writing to f which computes the hash of entry. """
+    hash_types = [entry.hash_type] if entry.hash_spec else []
+    return Spool(f, hash_types)
+
+
+def is_mirror_file(xom, relpath):
+    """ return True if relpath is on a mirror index, needs a transaction. """
+    stagename = '/'.join(relpath.split('/')[:2])
+    stage = xom.model.getstage(stagename)
+    return stage is not None and stage.ixconfig['type'] == 'mirror'
 
 
 class ImportFileReplica:
-    def __init__(self, xom, errors):
+    def __init__(self, xom, errors, queue=None):
         self.xom = xom
         self.errors = errors
+        self.queue = queue
 
     def __call__(self, fswriter, key, val, back_serial):
         threadlog.debug("ImportFileReplica for %s, %s", key, val)
@@ -405,6 +1068,8 @@ class ImportFileReplica:
         entry = self.xom.filestore.get_file_entry_raw(key, val)
         file_exists = fswriter.conn.io_file_exists(entry._storepath)
         if val is None:
+            if self.queue is not None:
+                self.queue.discard(relpath)
             if back_serial >= 0:
                 # file was deleted, still might never have been replicated
                 if file_exists:
@@ -415,48 +1080,115 @@ class ImportFileReplica:
             # we have a file or there is no remote file
             return
 
-        threadlog.info("retrieving file from master: %s", relpath)
-        url = self.xom.config.master_url.joinpath(relpath).url
-        # we perform the request with a special header so that
-        # the master can avoid -getting "volatile" links
-        r = self.xom.httpget(url, allow_redirects=True, extra_headers=
-                             {H_REPLICA_FILEREPL: str("YES")})
-        if r.status_code == 410:
-            # master indicates Gone for files which were later deleted
-            threadlog.warn("ignoring because of later deletion: %s",
-                           relpath)
+        if self.queue is not None:
+            # the file replication workers download it
+            self.queue.add(relpath)
             return
+        spool = new_replica_spool(
+            fswriter.conn.io_file_new_open(entry._storepath), entry)
+        try:
+            try:
+                store = download_replica_file(
+                    self.xom, entry, self.errors, spool)
+            except FileReplicationError as e:
+                if e.status_code in (404, 502) and is_mirror_file(self.xom, relpath):
+                    threadlog.warn(
+                        "ignoring file which couldn't be retrieved from mirror "
+                        "index: %s" % relpath)
+                    return
+                raise
+            if store:
+                spool.store(fswriter.conn, entry._storepath)
+        finally:
+            spool.discard()
 
-        if r.status_code in (404, 502):
-            stagename = '/'.join(relpath.split('/')[:2])
-            stage = self.xom.model.getstage(stagename)
-            if stage.ixconfig['type'] == 'mirror':
-                threadlog.warn(
-                    "ignoring file which couldn't be retrieved from mirror index '%s': %s" % (
-                        stagename, relpath))
-                return
 
-        if r.status_code != 200:
-            raise FileReplicationError(r, relpath)
+class FileReplicationWorker:
+    """ Downloads the files from the FileReplicationQueue, so the
+    changelog import doesn't wait for them. """
+    # seconds between checks for a shutdown while the queue is empty
+    idle_timeout = 5.0
 
-        err = entry.check_checksum(r.content)
-        if err:
-            # the file we got is different, it may have changed later.
-            # we remember the error and move on
-            self.errors.add(dict(
-                url=r.url,
-                message=str(err),
-                relpath=entry.relpath))
-            return
-        # in case there were errors before, we can now remove them
-        self.errors.remove(entry)
-        fswriter.conn.io_file_set(entry._storepath, r.content)
+    def __init__(self, xom, queue, errors):
+        self.xom = xom
+        self.queue = queue
+        self.errors = errors
+
+    def thread_shutdown(self):
+        self.queue.wakeup()
+
+    def thread_run(self):
+        thread_push_log("[FREP]")
+        while 1:
+            self.thread.exit_if_shutdown()
+            relpath = self.queue.get(timeout=self.idle_timeout)
+            if relpath is None:
+                continue
+            try:
+                self.replicate(relpath)
+            except Exception as e:
+                tries = self.queue.retry(relpath)
+                threadlog.error(
+                    "could not replicate %s (try %s): %s", relpath, tries, e)
+            else:
+                self.queue.done(relpath)
+
+    def _get_entry(self, conn, relpath):
+        try:
+            (keyname, serial, meta) = conn.db_read_typedkey_value(relpath)
+        except KeyError:
+            return None
+        if meta is None:
+            return None
+        key = self.xom.keyfs.get_key_instance(keyname, relpath)
+        return self.xom.filestore.get_file_entry_raw(key, meta)
+
+    def replicate(self, relpath):
+        """ download the file of relpath if it is still needed and
+        store it without a new serial. """
+        storage = self.xom.keyfs._storage
+        with storage.get_connection() as conn:
+            entry = self._get_entry(conn, relpath)
+            if entry is None or entry.last_modified is None:
+                # deleted meanwhile or there is no remote file
+                return
+            if conn.io_file_exists(entry._storepath):
+                return
+        spool = new_replica_spool(entry.file_new_open(), entry)
+        try:
+            try:
+                store = download_replica_file(
+                    self.xom, entry, self.errors, spool)
+            except FileReplicationError as e:
+                if e.status_code in (404, 502):
+                    with self.xom.keyfs.transaction(write=False):
+                        is_mirror = is_mirror_file(self.xom, relpath)
+                    if is_mirror:
+                        threadlog.warn(
+                            "ignoring file which couldn't be retrieved from "
+                            "mirror index: %s" % relpath)
+                        return
+                raise
+            if not store:
+                return
+            with storage.get_connection(write=True) as conn:
+                # the writer queue serializes us with the changelog import,
+                # so the file can't be deleted between the check and the
+                # write
+                current = self._get_entry(conn, relpath)
+                if current is None or current.hash_spec != entry.hash_spec:
+                    return
+                spool.store(conn, entry._storepath)
+                conn.commit()
+        finally:
+            spool.discard()
 
 
 class FileReplicationError(Exception):
     """ raised when replicating a file from the master failed. """
     def __init__(self, response, relpath, message=None):
-        self.url = response.url
+        # FatalResponse for connection errors has no url
+        self.url = getattr(response, "url", None)
         self.status_code = response.status_code
         self.relpath = relpath
         self.message = message or "failed"
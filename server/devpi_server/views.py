@@ -14,7 +14,7 @@ from pyramid.interfaces import IAuthenticationPolicy
 from pyramid.httpexceptions import HTTPException, HTTPFound, HTTPSuccessful
 from pyramid.httpexceptions import HTTPUnauthorized
 from pyramid.httpexceptions import exception_response
-from pyramid.response import Response
+from pyramid.response import FileIter, Response
 from pyramid.security import forget
 from pyramid.view import view_config
 import itertools
@@ -26,7 +26,7 @@ from .filestore import BadGateway
 from .model import InvalidIndex, InvalidIndexconfig, InvalidUser
 from .model import UpstreamError
 from .model import get_ixconfigattrs
-from .readonly import get_mutable_deepcopy
+from .readonly import get_mutable_copy
 from .log import thread_push_log, thread_pop_log, threadlog
 
 from .auth import Auth
@@ -39,6 +39,9 @@ H_MASTER_UUID = str("X-DEVPI-MASTER-UUID")
 
 API_VERSION = "2"
 
+# bytes read at once when sending release files
+FILE_BLOCK_SIZE = 65536
+
 # we use str() here so that Python 2 gets bytes, Python 3 gets string
 # so that wsgiref's parsing does not choke
 
@@ -209,6 +212,9 @@ def tween_keyfs_transaction(handler, registry):
 def set_header_devpi_serial(response, tx):
     if isinstance(response._app_iter, collections.Iterator):
         return
+    if "X-DEVPI-SERIAL" in response.headers:
+        # views which wait for newer serials know better
+        return
     if tx.commit_serial is not None:
         serial = tx.commit_serial
     else:
@@ -256,11 +262,31 @@ class StatusView:
             status["master-contacted-at"] = self.xom.replica_thread.master_contacted_at
             status["update-from-master-at"] = self.xom.replica_thread.update_from_master_at
             status["replica-in-sync-at"] = self.xom.replica_thread.replica_in_sync_at
+            # with cascading replicas the serials of all hops up to the
+            # master, the lag is the difference to the next hop downstream
+            upstream_serials = self.xom.replica_thread.get_upstream_serials()
+            status["upstream-serials"] = upstream_serials
+            downstream_serials = [status["serial"]] + upstream_serials[:-1]
+            status["upstream-lag"] = [
+                upstream - downstream for upstream, downstream
+                in zip(upstream_serials, downstream_serials)]
             replication_errors = ReplicationErrors(self.xom.config.serverdir)
             status["replication-errors"] = replication_errors.errors
+            file_queue = self.xom.replica_thread.file_queue
+            if file_queue is not None:
+                status["file-replication"] = file_queue.get_stats()
         else:
             status["role"] = "MASTER"
         status["polling_replicas"] = self.xom.polling_replicas
+        # only some storage backends queue their writers
+        writer_queue = getattr(self.xom.keyfs._storage, "writer_queue", None)
+        if writer_queue is not None:
+            status["writer-queue"] = writer_queue.get_stats()
+        # and some pool their database connections
+        get_pool_stats = getattr(self.xom.keyfs._storage, "get_pool_stats", None)
+        if get_pool_stats is not None:
+            status["storage-pools"] = get_pool_stats()
+        status["value-cache"] = self.xom.keyfs._value_cache.get_stats()
         return status
 
     @view_config(route_name="/+status", accept="application/json")
@@ -803,13 +829,15 @@ class PyPIView:
                     if not metadata:
                         abort_submit(
                             request, 400, "could not process form metadata")
-                file_content = content.file.read()
+                # the file is hashed while it is copied to the storage
+                spool = self.xom.filestore.new_spool()
                 try:
+                    spool.write_stream(content.file)
                     link = stage.store_releasefile(
                         project, version,
-                        content.filename, file_content)
+                        content.filename, spool)
                 except stage.NonVolatile as e:
-                    if e.link.matches_checksum(file_content):
+                    if e.link.matches_checksum(spool):
                         abort_submit(
                             request, 200,
                             "Upload of identical file to non volatile index.",
@@ -818,6 +846,8 @@ class PyPIView:
                         request, 409,
                         "%s already exists in non-volatile index" % (
                             content.filename,))
+                finally:
+                    spool.discard()
                 link.add_log(
                     'upload', request.authenticated_userid, dst=stage.name)
                 try:
@@ -829,8 +859,9 @@ class PyPIView:
                         request, 200,
                         "OK, but a trigger plugin failed: %s" % e, level="warn")
             else:
-                doczip = content.file.read()
+                doczip = self.xom.filestore.new_spool()
                 try:
+                    doczip.write_stream(content.file)
                     link = stage.store_doczip(project, version, doczip)
                 except stage.MissesVersion as e:
                     abort_submit(
@@ -850,6 +881,8 @@ class PyPIView:
                         request, 409,
                         "%s already exists in non-volatile index" % (
                             content.filename,))
+                finally:
+                    doczip.discard()
                 link.add_log(
                     'upload', request.authenticated_userid, dst=stage.name)
         else:
@@ -934,7 +967,7 @@ class PyPIView:
         apireturn(200, type="versiondata", result=view_verdata)
 
     def _make_view_verdata(self, verdata):
-        view_verdata = get_mutable_deepcopy(verdata)
+        view_verdata = get_mutable_copy(verdata)
         elinks = view_verdata.pop("+elinks", None)
         if elinks is not None:
             view_verdata["+links"] = links = []
@@ -982,7 +1015,7 @@ class PyPIView:
         if json_preferred(request):
             if not entry or not entry.meta:
                 apireturn(404, "no such release file")
-            entry_data = get_mutable_deepcopy(entry.meta)
+            entry_data = get_mutable_copy(entry.meta)
             apireturn(200, type="releasefilemeta", result=entry_data)
         if not entry or not entry.meta:
             if entry is None:
@@ -1001,11 +1034,25 @@ class PyPIView:
             return apireturn(502, e.args[0])
 
         headers = entry.gethttpheaders()
-        if self.request.method == "HEAD":
+        if entry.hash_spec:
+            # the content for a hash never changes
+            headers[str("ETag")] = str('"%s"' % entry.hash_spec)
+        headers[str("Accept-Ranges")] = str("bytes")
+        # the file is read while the response is sent, so we add the
+        # serial ourselves
+        headers[str("X-DEVPI-SERIAL")] = str(self.xom.keyfs.tx.at_serial)
+        offload_headers = get_file_offload_headers(request, entry)
+        if offload_headers is not None:
+            # the web server sends the content and answers range requests
+            del headers[str("content-length")]
+            headers.update(offload_headers)
             return Response(headers=headers)
-        else:
-            content = entry.file_get_content()
-            return Response(body=content, headers=headers)
+        app_iter = None
+        if self.request.method != "HEAD":
+            app_iter = get_file_app_iter(request, entry)
+        # webob answers If-None-Match, If-Modified-Since and Range
+        return Response(
+            app_iter=app_iter, headers=headers, conditional_response=True)
 
     @view_config(route_name="/{user}/{index}", accept="application/json", request_method="GET")
     def index_get(self):
@@ -1123,8 +1170,11 @@ def iter_fetch_remote_file(xom, entry):
     filestore = xom.filestore
     keyfs = xom.keyfs
     if not xom.is_replica():
-        keyfs.restart_as_write_transaction()
-        entry = filestore.get_file_entry(entry.relpath, readonly=False)
+        if keyfs.tx.write:
+            # the file is stored in the running transaction
+            entry = filestore.get_file_entry(entry.relpath, readonly=False)
+        # otherwise the file is downloaded without holding the write lock
+        # and stored with a short write transaction at the end
         for part in entry.iter_cache_remote_file():
             yield part
     else:
@@ -1132,6 +1182,67 @@ def iter_fetch_remote_file(xom, entry):
             yield part
 
 
+class RangeFileIter(FileIter):
+    """ app_iter of a seekable file, which webob uses for range requests
+    without reading the skipped part of the file. """
+
+    def __init__(self, file, block_size=FILE_BLOCK_SIZE, length=None):
+        FileIter.__init__(self, file, block_size=block_size)
+        self.remaining = length
+
+    def next(self):
+        size = self.block_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+            if not size:
+                raise StopIteration
+        val = self.file.read(size)
+        if not val:
+            raise StopIteration
+        if self.remaining is not None:
+            self.remaining -= len(val)
+        return val
+
+    __next__ = next
+
+    def app_iter_range(self, start, stop):
+        self.file.seek(start)
+        return RangeFileIter(self.file, self.block_size, stop - start)
+
+
+def get_file_app_iter(request, entry):
+    """ return an app_iter for the content of entry, files on the local
+    filesystem are passed to the ``wsgi.file_wrapper`` of the server if
+    the whole file is requested. """
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None and not request.range:
+        path = entry.file_os_path()
+        if path is not None:
+            return file_wrapper(open(path, "rb"), FILE_BLOCK_SIZE)
+    return RangeFileIter(entry.file_open_read())
+
+
+def get_file_offload_headers(request, entry):
+    """ return the headers to let the web server in front of us send the
+    content of entry with ``--file-offload`` or None if we have to send
+    it ourselves. """
+    xom = request.registry["xom"]
+    offload = xom.config.args.file_offload
+    if offload is None or request.method != "GET":
+        return None
+    # conditional requests are answered by webob without reading the file
+    if request.if_none_match or request.if_modified_since is not None:
+        return None
+    path = entry.file_os_path()
+    if path is None:
+        return None
+    if offload == "x-sendfile":
+        return {str("X-Sendfile"): str(path)}
+    # the +files directory is below the root of the generated nginx config
+    relpath = py.path.local(path).relto(xom.keyfs.basedir)
+    return {str("X-Accel-Redirect"): str("/" + relpath.replace(os.sep, "/"))}
+
+
 def url_for_entrypath(request, entrypath):
     parts = entrypath.split("/")
     user, index = parts[:2]
@@ -0,0 +1,5 @@
+add ``Transaction.get_many`` and ``Transaction.exists_many`` to read many keys
+with one query per batch, and the ``list_versions_many_perstage`` and
+``get_versiondata_many_perstage`` stage methods using them. Regenerating the
+simple links of a project and exporting an index use them instead of reading
+every version separately.
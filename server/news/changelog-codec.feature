@@ -0,0 +1,7 @@
+changelog entries and stored values are now written in a versioned format,
+encoded with ``marshal`` and compressed with ``zlib`` when they are at least
+16KiB big. Existing data stays readable. The format can be chosen with the
+``codec``, ``compression`` and ``compress_min_size`` storage settings, existing
+data can be converted with ``--recode-changelog`` and the codecs can be compared
+with ``--benchmark-codecs``. Replicas which don't announce support for the new
+format get the entries in the old format.
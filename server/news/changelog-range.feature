@@ -0,0 +1,3 @@
+replicas which are behind fetch up to 1000 changelog entries per request from
+the new ``/+changelog/START-END`` endpoint and commit the entries of serials
+without import hooks in batches, which makes catching up a lot faster.
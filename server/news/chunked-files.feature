@@ -0,0 +1 @@
+the ``sqlite_db_files`` backend stores release files in chunks of 1MiB and file downloads are streamed from the storage, so serving big files needs bounded memory with the chunked storage backends.
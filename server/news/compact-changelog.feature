@@ -0,0 +1,5 @@
+the changelog can be compacted with ``--compact-changelog``, or periodically
+with ``--compact-changelog-interval``. This writes a snapshot of the state at
+an older serial into the history and deletes the changelog entries before it,
+keeping the latest ``--compact-changelog-keep`` entries. Replicas which need
+a deleted entry get a ``410 Gone`` response.
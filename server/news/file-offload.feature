@@ -0,0 +1 @@
+new ``--file-offload`` option to let the web server send release files which are stored on the local filesystem. With ``x-accel-redirect`` devpi-server answers with an ``X-Accel-Redirect`` header to the ``+files`` path and ``--gen-config`` adds the matching internal nginx location, ``x-sendfile`` sets an ``X-Sendfile`` header with the absolute path for Apache with mod_xsendfile or lighttpd.
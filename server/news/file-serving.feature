@@ -0,0 +1 @@
+release files are served with a strong ``ETag`` derived from their hash, ``If-None-Match``, ``If-Modified-Since`` and ``Range`` requests are answered with ``304`` and ``206`` responses. Whole files on the local filesystem are passed to the ``wsgi.file_wrapper`` of the web server.
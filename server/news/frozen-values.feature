@@ -0,0 +1,5 @@
+values read from the database are now frozen dict, list, tuple and set
+subclasses instead of wrappers created on every item access, and they are put
+into the changelog cache directly on commit. Getting a mutable value, for
+example with ``key.update()``, returns a copy-on-write copy which only copies
+the nested parts that are accessed.
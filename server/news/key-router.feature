@@ -0,0 +1,4 @@
+keys are now derived from relpaths with a single compiled regular expression
+over all registered key paths and a per transaction relpath index. Serving
+files needs one database query less, because the value is read together
+with the key name.
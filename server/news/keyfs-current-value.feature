@@ -0,0 +1,4 @@
+store the latest value of each key along with the key in the ``kv`` table,
+so reading the current state of a key doesn't need to deserialize the
+whole changelog entry it was written with. Existing databases get the new
+column on startup and fall back to the changelog until a key is written again.
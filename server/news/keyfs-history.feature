@@ -0,0 +1,4 @@
+record every change of a key in a new ``kv_history`` table, so looking up the
+value of a key at an earlier serial is a single indexed query instead of
+following the ``back_serial`` chain through full changelog entries. For
+serials from before the upgrade the changelog is still used.
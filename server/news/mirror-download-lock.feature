@@ -0,0 +1 @@
+files which aren't cached yet are downloaded from the mirror without holding the write lock, so uploads and other changes aren't blocked by slow downloads. The file is stored with a short write transaction at the end, unless the entry was deleted, changed or already stored in the meantime.
@@ -0,0 +1,3 @@
+an empty replica started with ``--replica-bootstrap`` initializes from a
+snapshot of the master state, streamed from the new ``/+snapshot`` endpoint,
+instead of fetching every changelog entry since the master was created.
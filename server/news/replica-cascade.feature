@@ -0,0 +1,3 @@
+replicas started with ``--replica-cascade`` serve the changelog and files to
+other replicas, so replicas can be chained. The lag of each hop is shown in
+``upstream-lag`` of ``/+status``.
@@ -0,0 +1,4 @@
+the master compresses changelog entries of at least 1KiB which are stored
+uncompressed with zstd or zlib before sending them to replicas which can read
+that. Each entry is only compressed once for all replicas. Snapshots are
+compressed with zstd if the replica supports it.
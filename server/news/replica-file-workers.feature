@@ -0,0 +1,7 @@
+new ``--replica-file-workers NUM`` option to let replicas download release
+files from the master in background threads, so large or slow files don't hold
+up the import of the changelog. Pending downloads are kept in a persistent
+queue, failed ones are retried with a growing delay, and the queue is shown in
+``/+status``. This is opt-in, by default files are still downloaded during the
+import. With workers a file may not exist yet when its serial is imported,
+requests for it are then fetched from the master like before.
@@ -0,0 +1,3 @@
+replicas started with ``--replica-stream`` keep one connection to the master
+open, on which the master sends new changelog entries as they are committed,
+instead of polling for every serial.
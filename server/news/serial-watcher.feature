@@ -0,0 +1 @@
+a single thread per process watches for new commits and wakes up all requests and threads waiting for a serial, instead of each of them querying the database every second. With the sqlite backends commits of other processes sharing the ``--serverdir`` are detected through changes of the database files.
@@ -0,0 +1 @@
+files downloaded from mirrors or by replicas are spooled to a temporary file next to their final location while their size and hashes are computed, and moved into place on commit. Memory use no longer grows with the file size and copying is linear.
@@ -0,0 +1 @@
+uploaded release files and documentation zips are hashed while they are copied into a spooled file in the storage, which is moved into place on commit, instead of being read into memory and carried through the transaction.
@@ -0,0 +1,4 @@
+The sqlite storage backends now use write ahead log mode with checkpoints done
+in a background thread and keep one read connection per thread open. The
+``cache_size``, ``mmap_size``, ``synchronous`` and ``journal_mode`` pragmas can
+be set with ``--storage sqlite:key=value,...``.
@@ -0,0 +1 @@
+``/+status`` shows the connection pool statistics of storage backends which provide ``get_pool_stats``.
@@ -0,0 +1 @@
+replicas stream uploads to the master and the response of the master back to the client in chunks, instead of keeping both in memory.
@@ -0,0 +1,5 @@
+read transactions share a cache of the latest key values, so user and index
+configurations aren't read from the database on every request anymore. The
+cache follows all commits through the changelog and its size can be set with
+``--keyfs-value-cache-size``, which limits the number of values, not their
+memory use. Its hits and misses are shown in ``/+status``.
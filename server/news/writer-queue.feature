@@ -0,0 +1,5 @@
+write transactions of the sqlite storage backends now wait in an in-process
+queue in the order they arrived instead of retrying ``begin immediate``. While
+a replica imports a batch of changelog entries, they are committed together in
+one database commit, each still with its own serial. The queue wait times are
+reported as ``writer-queue`` in ``/+status``.
@@ -169,6 +169,28 @@ class TestConfig:
         xom = makexom(opts=opts)
         assert xom.keyfs._storage._changelog_cache.size == 200
 
+    def test_keyfs_value_cache_size(self, makexom):
+        opts = ("--keyfs-value-cache-size", "200")
+        config = make_config(("devpi-server",) + opts)
+        assert config.args.keyfs_value_cache_size == 200
+        xom = makexom(opts=opts)
+        assert xom.keyfs._value_cache.size == 200
+
+    def test_compact_changelog_interval(self, makexom):
+        from devpi_server.keyfs import ChangelogCompactor
+        xom = makexom()
+        assert not any(
+            isinstance(x, ChangelogCompactor) for x in xom.thread_pool._objects)
+        opts = ("--compact-changelog-interval", "60",
+                "--compact-changelog-keep", "100")
+        xom = makexom(opts=opts)
+        xom.keyfs
+        (compactor,) = [
+            x for x in xom.thread_pool._objects
+            if isinstance(x, ChangelogCompactor)]
+        assert compactor.interval == 60
+        assert compactor.keep == 100
+
     @pytest.mark.no_storage_option
     def test_storage_backend_default(self, makexom):
         from devpi_server import keyfs_sqlite
@@ -211,3 +233,12 @@ class TestConfig:
         plugin = Plugin()
         makexom(plugins=(plugin,), opts=options)
         assert plugin.settings == {"bar": "ham"}
+
+    @pytest.mark.no_storage_option
+    def test_storage_backend_sqlite_settings(self, makexom):
+        options = ("--storage", "sqlite:synchronous=normal,mmap_size=0")
+        xom = makexom(opts=options)
+        storage = xom.keyfs._storage
+        assert sorted(storage.pragmas) == [
+            ("mmap_size", 0), ("synchronous", "NORMAL")]
+        assert storage.checkpointer in xom.thread_pool._objects
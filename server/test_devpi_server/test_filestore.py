@@ -162,6 +162,52 @@ class TestFileStore:
         rheaders = entry.gethttpheaders()
         assert entry.file_get_content() == b"123"
 
+    @pytest.mark.notransaction
+    def test_fetch_remote_file_without_write_lock(self, xom, filestore,
+                                                  httpget, gen):
+        from devpi_server.views import iter_fetch_remote_file
+        keyfs = filestore.keyfs
+        link = gen.pypi_package_link("pytest-1.8.zip", md5=False)
+        with keyfs.transaction(write=True):
+            relpath = filestore.maplink(link, "root", "pypi").relpath
+        httpget.url2response[link.url] = dict(status_code=200,
+                headers={"content-length": "3"}, raw=BytesIO(b"123"))
+        with keyfs.transaction(write=False) as tx:
+            parts = iter_fetch_remote_file(
+                xom, filestore.get_file_entry(relpath))
+            next(parts)
+            assert not tx.write
+        # other writers aren't blocked by the running download
+        with keyfs.transaction(write=True):
+            assert not filestore.get_file_entry(relpath).file_exists()
+        assert b"".join(parts) == b"123"
+        with keyfs.transaction(write=False):
+            entry = filestore.get_file_entry(relpath)
+            assert entry.file_get_content() == b"123"
+            assert entry.hash_spec
+
+    @pytest.mark.notransaction
+    def test_fetch_remote_file_deleted_during_download(self, xom, filestore,
+                                                       httpget, gen):
+        from devpi_server.views import iter_fetch_remote_file
+        keyfs = filestore.keyfs
+        link = gen.pypi_package_link("pytest-1.8.zip", md5=False)
+        with keyfs.transaction(write=True):
+            relpath = filestore.maplink(link, "root", "pypi").relpath
+        httpget.url2response[link.url] = dict(status_code=200,
+                headers={"content-length": "3"}, raw=BytesIO(b"123"))
+        with keyfs.transaction(write=False):
+            parts = iter_fetch_remote_file(
+                xom, filestore.get_file_entry(relpath))
+            next(parts)
+        with keyfs.transaction(write=True):
+            filestore.get_file_entry(relpath, readonly=False).key.delete()
+        assert b"".join(parts) == b"123"
+        with keyfs.transaction(write=False):
+            entry = filestore.get_file_entry(relpath)
+            assert not entry.meta
+            assert not entry.file_exists()
+
     @pytest.mark.storage_with_filesystem
     @pytest.mark.parametrize("mode", ("commit", "rollback"))
     def test_file_tx(self, filestore, gen, mode):
@@ -245,6 +291,19 @@ class TestFileStore:
         assert link.md5 in str(excinfo.value)
         assert not entry.file_exists()
 
+    @pytest.mark.storage_with_filesystem
+    def test_iterfile_remote_error_removes_spool(self, filestore, httpget,
+                                                 gen):
+        link = gen.pypi_package_link("pytest-3.0.zip")
+        entry = filestore.maplink(link, "root", "pypi")
+        httpget.url2response[link.url_nofrag] = dict(status_code=200,
+                headers={}, raw=BytesIO(b"123"))
+        with pytest.raises(ValueError):
+            for part in entry.iter_cache_remote_file():
+                pass
+        dirpath = filestore.keyfs.basedir.join(entry._storepath).dirpath()
+        assert not dirpath.exists() or dirpath.listdir() == []
+
     def test_iterfile_eggfragment(self, filestore, httpget, gen):
         link = gen.pypi_package_link("master#egg=pytest-dev", md5=False)
         entry = filestore.maplink(link, "root", "pypi")
@@ -264,6 +323,16 @@ class TestFileStore:
             pass
         assert entry.file_get_content() == b"3333"
 
+    def test_store_spool(self, filestore):
+        spool = filestore.new_spool()
+        spool.write_stream(BytesIO(b"hello"))
+        entry = filestore.store("user", "index", "something-1.0.zip", spool)
+        assert entry.hash_spec == "sha256=" + getdigest(b"hello", "sha256")
+        assert entry.file_get_content() == b"hello"
+        filestore.keyfs.restart_as_write_transaction()
+        entry = filestore.get_file_entry(entry.relpath)
+        assert entry.file_get_content() == b"hello"
+
     def test_store_and_iter(self, filestore):
         content = b"hello"
         entry = filestore.store("user", "index", "something-1.0.zip", content)
@@ -292,3 +361,18 @@ def test_maplink_nochange(filestore, gen):
     assert py.builtin._istext(entry1.hash_spec)
     filestore.keyfs.commit_transaction_in_thread()
     assert filestore.keyfs.get_current_serial() == last_serial
+
+
+def test_spool(tmpdir):
+    path = tmpdir.join("spool")
+    spool = Spool(path.open("w+b"), ["sha256"])
+    assert b"".join(spool.iter_write(BytesIO(b"hello"))) == b"hello"
+    assert spool.size == 5
+    assert spool.get_hash_spec("sha256") == (
+        "sha256=" + getdigest(b"hello", "sha256"))
+    # hashes which weren't computed while writing are read from the file
+    assert spool.get_checksum_error(
+        "md5=" + getdigest(b"hello", "md5")) is None
+    assert "md5 mismatch" in spool.get_checksum_error("md5=123")
+    spool.discard()
+    assert not path.exists()
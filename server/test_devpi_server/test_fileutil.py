@@ -0,0 +1,137 @@
+import pytest
+from devpi_server.fileutil import Codec, dumps, get_codec, get_codec_info
+from devpi_server.fileutil import get_supported_codecs, loads
+from devpi_server.fileutil import ChunkedFile, iter_file_chunks
+import io
+
+
+value = {
+    "text": u"€", "bytes": b"\x00\xff", "int": 2 ** 70, "float": 1.5,
+    "list": [1, None, True, False], "tuple": (1, (2,)),
+    "set": set([1, 2]), "frozenset": frozenset([u"a"]), 1: {}}
+
+
+class TestCodec:
+    @pytest.mark.parametrize("kw", [
+        dict(encoding="legacy"),
+        dict(encoding="execnet", compression=None),
+        dict(encoding="marshal", compression=None),
+        dict(encoding="marshal", compression="zlib", compress_min_size=0),
+        dict(encoding="execnet", compression="zlib", compress_min_size=0)])
+    def test_roundtrip(self, kw):
+        codec = Codec(**kw)
+        data = codec.dumps(value)
+        assert loads(data) == value
+        assert type(loads(data)["tuple"]) is tuple
+        assert get_codec_info(data) == (codec.encoding, codec.compression)
+
+    @pytest.mark.parametrize("encoding", ["legacy", "execnet", "marshal"])
+    def test_readonly_values(self, encoding):
+        from devpi_server.readonly import ensure_deeply_readonly
+        from devpi_server.readonly import get_mutable_copy
+        codec = Codec(encoding=encoding, compression=None)
+        # ensure_deeply_readonly doesn't handle frozensets
+        plain = dict((k, v) for k, v in value.items() if k != "frozenset")
+        frozen = ensure_deeply_readonly(plain)
+        assert codec.dumps(frozen) == codec.dumps(plain)
+        copy = get_mutable_copy(frozen)
+        assert codec.dumps(copy) == codec.dumps(plain)
+        # nothing was thawed
+        assert type(dict.__getitem__(copy, "list")) is type(frozen["list"])
+        data = codec.dumps(("key", 1, frozen))
+        assert loads(data) == ("key", 1, plain)
+        assert type(loads(data)[2]["list"]) is list
+
+    def test_legacy_format(self):
+        data = dumps(value)
+        assert Codec("legacy").dumps(value) == data
+        assert get_codec_info(data) == ("legacy", "none")
+        assert loads(data) == value
+
+    def test_compress_min_size(self):
+        codec = Codec(compress_min_size=100)
+        assert get_codec_info(codec.dumps([1])) == ("marshal", "none")
+        data = codec.dumps(["x" * 100] * 10)
+        assert get_codec_info(data) == ("marshal", "zlib")
+        assert len(data) < 200
+
+    def test_zstd(self):
+        pytest.importorskip("zstandard")
+        data = Codec(compression="zstd", compress_min_size=0).dumps(value)
+        assert get_codec_info(data) == ("marshal", "zstd")
+        assert loads(data) == value
+        assert "zstd" in get_supported_codecs()
+
+    def test_unknown_version(self):
+        data = bytearray(Codec().dumps(value))
+        data[3] = 99
+        with pytest.raises(ValueError):
+            loads(bytes(data))
+
+    def test_get_codec(self):
+        codec = get_codec()
+        assert (codec.encoding, codec.compression) == ("marshal", "zlib")
+        codec = get_codec(dict(
+            codec="LEGACY", compression="zlib", compress_min_size="10"))
+        assert (codec.encoding, codec.compression) == ("legacy", "none")
+        with pytest.raises(ValueError):
+            get_codec(dict(codec="pickle"))
+        with pytest.raises(ValueError):
+            get_codec(dict(compression="lzma"))
+
+
+def test_iter_file_chunks():
+    assert list(iter_file_chunks(b"", 3)) == []
+    assert list(iter_file_chunks(b"abcdefg", 3)) == [b"abc", b"def", b"g"]
+    f = io.BytesIO(b"abcdef")
+    assert list(iter_file_chunks(f, 3)) == [b"abc", b"def"]
+
+
+class TestChunkedFile:
+    @pytest.fixture
+    def reads(self):
+        return []
+
+    @pytest.fixture
+    def chunked(self, reads):
+        chunks = [b"abc", b"def", b"g"]
+
+        def read_chunk(index):
+            reads.append(index)
+            if index < len(chunks):
+                return chunks[index]
+
+        return ChunkedFile(7, 3, read_chunk)
+
+    def test_read(self, chunked, reads):
+        assert chunked.read(2) == b"ab"
+        assert chunked.read(2) == b"c"
+        assert chunked.read() == b"defg"
+        assert chunked.read() == b""
+        assert reads == [0, 1, 2]
+
+    def test_seek(self, chunked, reads):
+        assert chunked.seek(4) == 4
+        assert chunked.read(1) == b"e"
+        assert chunked.seek(-2, io.SEEK_END) == 5
+        assert chunked.tell() == 5
+        assert chunked.seek(-1, io.SEEK_CUR) == 4
+        assert chunked.read() == b"efg"
+        assert reads == [1, 2]
+        with pytest.raises(ValueError):
+            chunked.seek(-1)
+
+    def test_iter_chunks(self, chunked, reads):
+        chunked.seek(1)
+        assert list(chunked.iter_chunks()) == [b"bc", b"def", b"g"]
+        assert reads == [0, 1, 2]
+
+    def test_context_manager(self, chunked):
+        with chunked as f:
+            assert f.read() == b"abcdefg"
+        assert chunked.closed
+
+    def test_missing_chunk(self, reads):
+        f = ChunkedFile(7, 3, lambda index: None)
+        with pytest.raises(IOError):
+            f.read()
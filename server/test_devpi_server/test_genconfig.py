@@ -13,3 +13,20 @@ def test_gen_config_all(tmpdir):
     assert b.join("crontab").check()
     assert b.join("net.devpi.plist").check()
 
+
+
+@pytest.mark.parametrize("offload", [None, "x-accel-redirect", "x-sendfile"])
+def test_gen_nginx_file_offload(tmpdir, offload):
+    import py
+    from devpi_server.config import get_pluginmanager, parseoptions
+    from devpi_server.genconfig import gen_nginx
+    argv = ["devpi-server", "--serverdir", str(tmpdir)]
+    if offload is not None:
+        argv.extend(["--file-offload", offload])
+    config = parseoptions(get_pluginmanager(), argv)
+    written = {}
+    gen_nginx(py.io.TerminalWriter(), config, written.__setitem__)
+    content = written["nginx-devpi.conf"]
+    assert "root %s;" % tmpdir in content
+    has_location = "location ^~ /+files/ {\n        internal;" in content
+    assert has_location == (offload == "x-accel-redirect")
@@ -1,9 +1,12 @@
 import contextlib
+import threading
+import time
 import py
 import pytest
 from devpi_server.mythread import ThreadPool
 
 from devpi_server.keyfs import *  # noqa
+from devpi_server.keyfs_sqlite import WriteGroup
 from devpi_server.readonly import is_deeply_readonly
 
 notransaction = pytest.mark.notransaction
@@ -80,6 +83,33 @@ class TestGetKey:
         key = pkey(hello="cat", this="dog")
         assert key.name == "NAME"
 
+    def test_match_key(self, keyfs):
+        keyfs.add_key("NAME1", "{user}/.config", dict)
+        keyfs.add_key("NAME2", "{user}/{index}/+f/{a}/{b}/{filename}", dict)
+        keyfs.add_key("NAME3", "{user}/{index}/{project}/.simple", dict)
+        keyfs.add_key("NAME4", "hello.world", int)
+        key = keyfs.match_key("root/pypi/+f/1/2/py-1.0.tar.gz")
+        assert key.name == "NAME2"
+        assert key.relpath == "root/pypi/+f/1/2/py-1.0.tar.gz"
+        assert key.params == dict(
+            user="root", index="pypi", a="1", b="2", filename="py-1.0.tar.gz")
+        key = keyfs.match_key("root/.config")
+        assert key.name == "NAME1"
+        assert key.params == dict(user="root")
+        assert keyfs.match_key("root/pypi/+f/.simple").name == "NAME3"
+        assert keyfs.match_key("hello.world") == keyfs.NAME4
+        assert keyfs.match_key("helloxworld") is None
+        assert keyfs.match_key("root/pypi/.config") is None
+        assert keyfs.match_key("root/pypi/+f/1/2") is None
+
+    def test_match_key_replaced(self, keyfs):
+        keyfs.add_key("NAME", "{hello}/{this}", dict)
+        keyfs.add_key("NAME", "{hello}/{this}/.config", set)
+        assert keyfs.match_key("cat/dog") is None
+        key = keyfs.match_key("cat/dog/.config")
+        assert key.type == set
+        assert key.params == dict(hello="cat", this="dog")
+
 
 @pytest.mark.parametrize(("type", "val"),
         [(dict, {1:2}),
@@ -170,6 +200,46 @@ class TestKey:
         d2[3] = 4
         assert d2 != d
 
+    def test_set_then_readonly(self, keyfs):
+        key1 = keyfs.add_key("NAME", "some1", dict)
+        keyfs.restart_as_write_transaction()
+        d = {1: [1, 2, 3]}
+        key1.set(d)
+        # the value is frozen once and not again for each read
+        val = key1.get()
+        assert is_deeply_readonly(val)
+        assert key1.get() is val
+        assert key1.get()[1] is val[1]
+        d2 = key1.get(readonly=False)
+        d2[1].append(5)
+        assert key1.get() == {1: [1, 2, 3]}
+        # later changes to the value passed to set don't leak through,
+        # but they aren't lost silently either
+        d[1].append(4)
+        assert key1.get() == {1: [1, 2, 3]}
+        with pytest.raises(ValueError):
+            keyfs.commit_transaction_in_thread()
+        # the write lock was released
+        with keyfs.transaction(write=True):
+            key1.set({2: 2})
+
+    def test_set_again_after_change(self, keyfs):
+        key1 = keyfs.add_key("NAME", "some1", dict)
+        key2 = keyfs.add_key("NAME2", "some2", dict)
+        keyfs.restart_as_write_transaction()
+        d = {1: [1]}
+        key1.set(d)
+        d[1].append(2)
+        key1.set(d)
+        d2 = {2: [2]}
+        key2.set(d2)
+        d2[2].append(3)
+        key2.delete()
+        keyfs.commit_transaction_in_thread()
+        with keyfs.transaction(write=False):
+            assert key1.get() == {1: [1, 2]}
+            assert not key2.exists()
+
     def test_update(self, keyfs):
         key1 = keyfs.add_key("NAME", "some1", dict)
         key2 = keyfs.add_key("NAME", "some2", list)
@@ -373,6 +443,54 @@ class TestTransactionIsolation:
                 d2[3].append(6)
             assert tx.get_value_at(D, 0) == d_orig
 
+    def test_get_value_at_current_without_changelog(self, keyfs, monkeypatch):
+        D = keyfs.add_key("NAME", "hello", dict)
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        with keyfs.transaction(write=True):
+            D.set({2: 2})
+        with keyfs.transaction() as tx:
+            monkeypatch.setattr(tx.conn, "get_changes", lambda serial: 0/0)
+            assert tx.get_value_at(D, 1) == {2: 2}
+            monkeypatch.undo()
+            assert tx.get_value_at(D, 0) == {1: 1}
+
+    def test_get_value_at_current_deleted(self, keyfs, monkeypatch):
+        D = keyfs.add_key("NAME", "hello", dict)
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        with keyfs.transaction(write=True):
+            D.delete()
+        with keyfs.transaction() as tx:
+            monkeypatch.setattr(tx.conn, "get_changes", lambda serial: 0/0)
+            with pytest.raises(KeyError):
+                tx.get_value_at(D, 1)
+
+    def test_get_value_at_history_without_changelog(self, keyfs, monkeypatch):
+        D = keyfs.add_key("NAME", "hello", dict)
+        E = keyfs.add_key("NAME", "other", dict)
+        with keyfs.transaction(write=True):
+            E.set({0: 0})
+        for i in range(1, 5):
+            with keyfs.transaction(write=True):
+                if i == 3:
+                    D.delete()
+                else:
+                    D.set({i: i})
+        with keyfs.transaction(write=True):
+            E.set({5: 5})
+        with keyfs.transaction() as tx:
+            monkeypatch.setattr(tx.conn, "get_changes", lambda serial: 0/0)
+            with pytest.raises(KeyError):
+                tx.get_value_at(D, 0)
+            assert tx.get_value_at(D, 1) == {1: 1}
+            assert tx.get_value_at(D, 2) == {2: 2}
+            with pytest.raises(KeyError):
+                tx.get_value_at(D, 3)
+            assert tx.get_value_at(D, 4) == {4: 4}
+            assert tx.get_value_at(D, 5) == {4: 4}
+            assert tx.get_value_at(E, 4) == {0: 0}
+
     def test_is_dirty(self, keyfs):
         D = keyfs.add_key("NAME", "hello", dict)
         with keyfs.transaction():
@@ -419,6 +537,36 @@ class TestTransactionIsolation:
         new_keyfs.import_changes(0, changes)
         assert l[0][1:] == (new_keyfs.NAME(name="world"), {1:1}, -1)
 
+    def test_import_changes_many(self, keyfs, storage, tmpdir):
+        pkey = keyfs.add_key("NAME", "hello/{name}", dict)
+        other = keyfs.add_key("OTHER", "other/{name}", dict)
+        for i in range(4):
+            with keyfs.transaction(write=True):
+                pkey(name="world").set({i: i})
+                other(name="x%s" % i).set({})
+        with keyfs.transaction(write=True):
+            pkey(name="world").set({1: 1})
+        entries = []
+        with keyfs.transaction() as tx:
+            for serial in range(5):
+                entries.append(tx.conn.get_changes(serial))
+        new_keyfs = KeyFS(tmpdir.join("newkeyfs"), storage)
+        new_keyfs.add_key("NAME", "hello/{name}", dict)
+        other = new_keyfs.add_key("OTHER", "other/{name}", dict)
+        l = []
+
+        def subscriber(fswriter, typedkey, val, back_serial):
+            # all previous serials are committed
+            l.append((new_keyfs.get_current_serial(), val))
+        new_keyfs.subscribe_on_import(other, subscriber)
+        new_keyfs.import_changes_many(0, entries)
+        assert new_keyfs.get_current_serial() == 4
+        assert l == [(-1, {}), (0, {}), (1, {}), (2, {})]
+        with new_keyfs.transaction() as tx:
+            assert tx.get_value_at(new_keyfs.NAME(name="world"), 2) == {2: 2}
+            assert tx.get(new_keyfs.NAME(name="world")) == {1: 1}
+            assert tx.get(new_keyfs.OTHER(name="x3")) == {}
+
     def test_import_changes_subscriber_error(self, keyfs, storage, tmpdir):
         pkey = keyfs.add_key("NAME", "hello/{name}", dict)
         D = pkey(name="world")
@@ -479,6 +627,428 @@ class TestDeriveKey:
             assert key == D
             assert key.params == params
 
+    def test_not_existing(self, keyfs):
+        pkey = keyfs.add_key("NAME", "{name}/{index}", dict)
+        with keyfs.transaction() as tx:
+            with pytest.raises(KeyError):
+                tx.derive_key("hello/world")
+            with pytest.raises(KeyError):
+                tx.derive_key("hello")
+            assert not pkey(name="hello", index="world").exists()
+            with pytest.raises(KeyError):
+                tx.derive_key("hello/world")
+
+    def test_deleted(self, keyfs):
+        pkey = keyfs.add_key("NAME", "{name}/{index}", dict)
+        D = pkey(name="hello", index="world")
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        with keyfs.transaction(write=True):
+            D.delete()
+        with keyfs.transaction() as tx:
+            key = tx.derive_key(D.relpath)
+            assert key == D
+            assert not key.exists()
+
+    def test_deleted_in_transaction(self, keyfs):
+        D = keyfs.add_key("NAME", "hello", dict)
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        with keyfs.transaction(write=True) as tx:
+            D.delete()
+            assert tx.derive_key(D.relpath) == D
+            assert not D.exists()
+
+    def test_value_read_along(self, keyfs, monkeypatch):
+        pkey = keyfs.add_key("NAME", "{name}/{index}", dict)
+        D = pkey(name="hello", index="world")
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        with keyfs.transaction() as tx:
+            key = tx.derive_key(D.relpath)
+            monkeypatch.setattr(tx.conn, "db_read_typedkey_value", None)
+            assert tx.derive_key(D.relpath) is key
+            assert key.get() == {1: 1}
+
+    def test_ambiguous_pattern(self, keyfs):
+        keyfs.add_key("NAME1", "{name}/{index}", dict)
+        pkey = keyfs.add_key("NAME2", "{name}/{index}", set)
+        D = pkey(name="hello", index="world")
+        with keyfs.transaction(write=True):
+            D.set(set([1]))
+        with keyfs.transaction() as tx:
+            key = tx.derive_key(D.relpath)
+            assert key.name == "NAME2"
+            assert key.get() == set([1])
+
+
+@notransaction
+class TestGetMany:
+    def test_get_many(self, keyfs, monkeypatch):
+        pkey = keyfs.add_key("NAME", "{name}", dict)
+        with keyfs.transaction(write=True):
+            for i in range(3):
+                pkey(name=str(i)).set({"i": i})
+        with keyfs.transaction() as tx:
+            keys = [pkey(name=str(i)) for i in range(4)]
+            assert tx.get_many(keys) == [{"i": 0}, {"i": 1}, {"i": 2}, {}]
+            assert tx.exists_many(keys) == [True, True, True, False]
+            # the existing values are in the transaction cache now
+            monkeypatch.setattr(tx.conn, "db_read_typedkey_value", None)
+            assert keys[1].get() == {"i": 1}
+            assert tx.derive_key(keys[2].relpath) == keys[2]
+
+    def test_get_many_batches(self, keyfs, monkeypatch):
+        pkey = keyfs.add_key("NAME", "{name}", int)
+        with keyfs.transaction(write=True):
+            for i in range(10):
+                pkey(name=str(i)).set(i)
+        with keyfs.transaction() as tx:
+            monkeypatch.setattr(tx.conn, "max_batch_size", 3)
+            keys = [pkey(name=str(i)) for i in range(10)]
+            assert tx.get_many(keys) == list(range(10))
+
+    def test_get_many_mutable(self, keyfs):
+        pkey = keyfs.add_key("NAME", "{name}", dict)
+        with keyfs.transaction(write=True):
+            pkey(name="a").set({"a": [1]})
+        with keyfs.transaction(write=True) as tx:
+            (a, b) = tx.get_many([pkey(name="a"), pkey(name="b")],
+                                 readonly=False)
+            a["a"].append(2)
+            b["b"] = 1
+            assert pkey(name="a").get() == {"a": [1]}
+
+    def test_get_many_at_serial(self, keyfs):
+        pkey = keyfs.add_key("NAME", "{name}", int)
+        with keyfs.transaction(write=True):
+            pkey(name="a").set(1)
+        with keyfs.transaction(write=True):
+            pkey(name="a").set(2)
+            pkey(name="b").set(2)
+        with keyfs.transaction(write=True):
+            pkey(name="a").delete()
+        keys = [pkey(name="a"), pkey(name="b")]
+        with keyfs.transaction(at_serial=0) as tx:
+            assert tx.get_many(keys) == [1, 0]
+            assert tx.exists_many(keys) == [True, False]
+        with keyfs.transaction(at_serial=1) as tx:
+            assert tx.get_many(keys) == [2, 2]
+        with keyfs.transaction() as tx:
+            assert tx.get_many(keys) == [0, 2]
+            assert tx.exists_many(keys) == [False, True]
+
+    def test_get_many_in_write_transaction(self, keyfs):
+        pkey = keyfs.add_key("NAME", "{name}", int)
+        with keyfs.transaction(write=True):
+            pkey(name="a").set(1)
+            pkey(name="b").set(1)
+        with keyfs.transaction(write=True) as tx:
+            pkey(name="a").delete()
+            pkey(name="c").set(3)
+            keys = [pkey(name="a"), pkey(name="b"), pkey(name="c")]
+            assert tx.get_many(keys) == [0, 1, 3]
+            assert tx.exists_many(keys) == [False, True, True]
+
+
+
+@notransaction
+class TestValueCache:
+    def _forbid_reads(self, monkeypatch, tx):
+        monkeypatch.setattr(tx.conn, "db_read_typedkey_values", None)
+
+    def test_shared_between_transactions(self, keyfs, monkeypatch):
+        D = keyfs.add_key("NAME", "hello", dict)
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        with keyfs.transaction():
+            assert D.get() == {1: 1}
+        with keyfs.transaction() as tx:
+            self._forbid_reads(monkeypatch, tx)
+            assert D.get() == {1: 1}
+            assert tx.derive_key(D.relpath) == D
+        stats = keyfs._value_cache.get_stats()
+        assert stats["size"] == 1
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+
+    def test_updated_by_commits(self, keyfs, monkeypatch):
+        D = keyfs.add_key("NAME", "hello", dict)
+        E = keyfs.add_key("NAME2", "world", dict)
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        with keyfs.transaction():
+            assert D.get() == {1: 1}
+            assert not E.exists()
+        with keyfs.transaction(write=True):
+            D.set({2: 2})
+            E.set({3: 3})
+        with keyfs.transaction() as tx:
+            self._forbid_reads(monkeypatch, tx)
+            assert D.get() == {2: 2}
+            assert E.get() == {3: 3}
+        with keyfs.transaction(write=True):
+            D.delete()
+        with keyfs.transaction() as tx:
+            self._forbid_reads(monkeypatch, tx)
+            assert not D.exists()
+
+    def test_old_serial(self, keyfs):
+        D = keyfs.add_key("NAME", "hello", dict)
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        with keyfs.transaction(write=True):
+            D.set({2: 2})
+        with keyfs.transaction():
+            assert D.get() == {2: 2}
+        with keyfs.transaction(at_serial=0):
+            assert D.get() == {1: 1}
+        with keyfs.transaction(at_serial=1):
+            assert D.get() == {2: 2}
+
+    def test_commit_of_other_process(self, keyfs, storage, monkeypatch):
+        D = keyfs.add_key("NAME", "hello", dict)
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        with keyfs.transaction():
+            assert D.get() == {1: 1}
+        other = KeyFS(keyfs.basedir, storage)
+        D2 = other.add_key("NAME", "hello", dict)
+        with other.transaction(write=True):
+            D2.set({2: 2})
+        with keyfs.transaction() as tx:
+            self._forbid_reads(monkeypatch, tx)
+            assert D.get() == {2: 2}
+
+    def test_bounded(self, keyfs):
+        pkey = keyfs.add_key("NAME", "{name}", int)
+        keyfs._value_cache.size = 3
+        with keyfs.transaction(write=True):
+            for i in range(5):
+                pkey(name=str(i)).set(i)
+        with keyfs.transaction() as tx:
+            assert tx.get_many(pkey(name=str(i)) for i in range(5)) == [
+                0, 1, 2, 3, 4]
+        assert len(keyfs._value_cache._data) == 3
+
+    def test_put_after_catchup_ignored(self, keyfs):
+        D = keyfs.add_key("NAME", "hello", dict)
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        value_cache = keyfs._value_cache
+        with keyfs.transaction() as tx:
+            (serial, entries) = value_cache.get_many(tx.conn, ["hello"], 0)
+            assert entries == {}
+        with keyfs.transaction(write=True):
+            D.set({2: 2})
+        with keyfs.transaction() as tx:
+            value_cache.get_many(tx.conn, [], tx.at_serial)
+        value_cache.put_many(serial, {"hello": ("NAME", 0, {1: 1})})
+        assert "hello" not in value_cache._data
+        with keyfs.transaction():
+            assert D.get() == {2: 2}
+
+    def test_put_from_older_connection_ignored(self, keyfs):
+        D = keyfs.add_key("NAME", "hello", dict)
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        value_cache = keyfs._value_cache
+        with keyfs._storage.get_connection() as conn:
+            assert conn.last_changelog_serial == 0
+            with keyfs.transaction(write=True):
+                D.set({2: 2})
+            with keyfs.transaction():
+                assert D.get() == {2: 2}
+            (serial, entries) = value_cache.get_many(conn, ["other"], 0)
+            assert serial == 0
+            assert value_cache.serial == 1
+        value_cache.put_many(serial, {"other": (None, -1, None)})
+        assert "other" not in value_cache._data
+
+    def test_catchup_without_lock(self, keyfs, monkeypatch):
+        D = keyfs.add_key("NAME", "hello", dict)
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+        with keyfs.transaction():
+            assert D.get() == {1: 1}
+        with keyfs.transaction(write=True):
+            D.set({2: 2})
+        value_cache = keyfs._value_cache
+        locked = []
+        with keyfs.transaction() as tx:
+            get_changes = tx.conn.get_changes
+            monkeypatch.setattr(
+                tx.conn, "get_changes",
+                lambda serial: locked.append(value_cache._lock.locked()) or
+                get_changes(serial))
+            self._forbid_reads(monkeypatch, tx)
+            assert D.get() == {2: 2}
+        assert locked == [False]
+        assert value_cache.serial == 1
+
+    def test_write_transaction_bypasses(self, keyfs):
+        D = keyfs.add_key("NAME", "hello", dict)
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+            assert D.get() == {1: 1}
+        with keyfs.transaction(write=True):
+            assert D.get() == {1: 1}
+        assert keyfs._value_cache.get_stats()["size"] == 0
+
+
+@notransaction
+class TestCompaction:
+    def _make_changes(self, keyfs):
+        D = keyfs.add_key("NAME", "hello", dict)
+        E = keyfs.add_key("NAME2", "world", dict)
+        F = keyfs.add_key("NAME3", "deleted", dict)
+        with keyfs.transaction(write=True):
+            D.set({0: 0})
+            E.set({0: 0})
+            F.set({0: 0})
+        with keyfs.transaction(write=True):
+            D.set({1: 1})
+            F.delete()
+        with keyfs.transaction(write=True):
+            D.set({2: 2})
+        with keyfs.transaction(write=True):
+            E.set({3: 3})
+        return D, E, F
+
+    def test_compact_changelog(self, keyfs):
+        D, E, F = self._make_changes(keyfs)
+        assert keyfs.get_snapshot_serial() is None
+        assert keyfs.compact_changelog(2) == 2
+        assert keyfs.get_snapshot_serial() == 2
+        with keyfs.transaction() as tx:
+            assert tx.conn.get_raw_changelog_entry(1) is None
+            assert tx.conn.get_raw_changelog_entry(2) is not None
+            assert tx.get_value_at(D, 2) == {2: 2}
+            assert tx.get_value_at(E, 2) == {0: 0}
+            assert tx.get_value_at(E, 3) == {3: 3}
+            with pytest.raises(KeyError):
+                tx.get_value_at(F, 2)
+            assert D.get() == {2: 2}
+            assert E.get() == {3: 3}
+            assert not F.exists()
+        with keyfs.transaction(at_serial=2) as tx:
+            assert E.get() == {0: 0}
+            assert tx.derive_key(E.relpath) == E
+
+    def test_value_at_before_compaction(self, keyfs):
+        G = keyfs.add_key("NAME4", "unchanged", dict)
+        with keyfs.transaction(write=True):
+            G.set({0: 0})
+        D, E, F = self._make_changes(keyfs)
+        keyfs.compact_changelog(4)
+        with keyfs.transaction() as tx:
+            # G keeps its entry at serial 0 in the history, but the
+            # entry of E at serial 1 was pruned
+            assert tx.conn.db_read_history_start_serial() == 0
+            assert tx.conn.db_read_typedkey_value_at(E.relpath, 2) is None
+            with pytest.raises(KeyError):
+                tx.conn.db_read_typedkey_value_at("world/missing", 4)
+            # not known anymore, which isn't the same as not existing
+            with pytest.raises(ValueError):
+                tx.get_value_at(E, 2)
+            assert tx.get_value_at(G, 2) == {0: 0}
+            assert tx.get_value_at(E, 4) == {3: 3}
+
+    def test_history_start_after_compaction(self, keyfs):
+        D, E, F = self._make_changes(keyfs)
+        with keyfs.transaction() as tx:
+            assert tx.conn.db_read_history_start_serial() == 0
+        keyfs.compact_changelog(3)
+        with keyfs.transaction() as tx:
+            assert tx.conn.db_read_history_start_serial() > 0
+
+    def test_write_snapshot_keeps_changelog(self, keyfs):
+        D, E, F = self._make_changes(keyfs)
+        keyfs.write_snapshot(2)
+        with keyfs.transaction() as tx:
+            assert tx.conn.get_raw_changelog_entry(0) is not None
+            assert tx.conn.db_read_relpaths_without_history(2) == []
+
+    def test_changes_after_compaction(self, keyfs):
+        D, E, F = self._make_changes(keyfs)
+        keyfs.compact_changelog(3)
+        with keyfs.transaction(write=True):
+            D.set({4: 4})
+            F.set({4: 4})
+        with keyfs.transaction() as tx:
+            assert tx.get_value_at(D, 3) == {2: 2}
+            assert D.get() == {4: 4}
+            assert F.get() == {4: 4}
+        assert keyfs.compact_changelog(4) == 1
+
+    def test_value_cache_behind_compaction(self, keyfs):
+        D, E, F = self._make_changes(keyfs)
+        with keyfs.transaction(at_serial=0):
+            assert D.get() == {0: 0}
+        keyfs._value_cache.serial = 0
+        keyfs.compact_changelog(3)
+        with keyfs.transaction():
+            assert D.get() == {2: 2}
+        assert keyfs._value_cache.serial == 3
+
+    def test_compactor(self, keyfs):
+        self._make_changes(keyfs)
+        compactor = ChangelogCompactor(keyfs, interval=10, keep=1)
+        # the event hooks didn't run yet
+        assert compactor.compact() == 0
+        keyfs.notifier.write_event_serial(1)
+        assert compactor.compact() == 1
+        assert keyfs.get_snapshot_serial() == 1
+        assert compactor.compact() == 0
+        keyfs.notifier.write_event_serial(3)
+        assert compactor.compact() == 1
+        assert keyfs.get_snapshot_serial() == 2
+
+
+@notransaction
+class TestSnapshot:
+    def test_iter_snapshot(self, keyfs):
+        pkey = keyfs.add_key("NAME", "{name}", dict)
+        with keyfs.transaction(write=True):
+            pkey(name="a").set({0: 0})
+            pkey(name="b").set({0: 0})
+        with keyfs.transaction(write=True):
+            pkey(name="a").set({1: 1})
+            pkey(name="b").delete()
+            pkey(name="c").set({1: 1})
+        with keyfs.transaction(at_serial=0) as tx:
+            entries = [x for batch in tx.iter_snapshot(batch_size=1)
+                       for x in batch]
+        assert entries == [
+            ("a", "NAME", 0, {0: 0}), ("b", "NAME", 0, {0: 0})]
+        with keyfs.transaction() as tx:
+            entries = [x for batch in tx.iter_snapshot() for x in batch]
+        assert entries == [
+            ("a", "NAME", 1, {1: 1}), ("c", "NAME", 1, {1: 1})]
+
+    def test_import_snapshot(self, keyfs, gentmp, storage):
+        pkey = keyfs.add_key("NAME", "{name}", dict)
+        with keyfs.transaction(write=True):
+            pkey(name="a").set({0: 0})
+        with keyfs.transaction(write=True):
+            pkey(name="b").set({1: 1})
+        with keyfs.transaction() as tx:
+            batches = list(tx.iter_snapshot())
+            changes = tx.conn.get_changes(1)
+        other = KeyFS(gentmp(), storage)
+        opkey = other.add_key("NAME", "{name}", dict)
+        assert other.import_snapshot(1, changes, batches) == 2
+        assert other.get_current_serial() == 1
+        assert other.notifier.read_event_serial() == 1
+        with other.transaction() as tx:
+            assert opkey(name="a").get() == {0: 0}
+            assert tx.get_value_at(opkey(name="a"), 1) == {0: 0}
+            assert tx.derive_key("b") == opkey(name="b")
+        with other.transaction(write=True):
+            opkey(name="a").set({2: 2})
+        assert other.get_current_serial() == 2
+        with pytest.raises(ValueError):
+            other.import_snapshot(1, changes, batches)
 
 
 @notransaction
@@ -608,6 +1178,43 @@ class TestSubscriber:
         wait_serial = keyfs.get_next_serial()
         assert not keyfs.wait_tx_serial(wait_serial, timeout=0.001, recheck=0.0001)
 
+    def test_wait_tx_serial_watcher(self, keyfs, pool, queue):
+        watcher = keyfs.serial_watcher
+        watcher.interval = 0.01
+        pool.register(watcher)
+        wait_serial = keyfs.get_next_serial()
+
+        class T:
+            def thread_run(self):
+                # only the watcher wakes us up for commits of other processes
+                ret = keyfs.wait_tx_serial(
+                    wait_serial, timeout=30, recheck=1000)
+                queue.put(ret)
+        pool.register(T())
+        pool.start()
+
+        # directly modify the database like another process
+        with keyfs._storage.get_connection(write=True) as conn:
+            conn.write_changelog_entry(wait_serial, [{}, ()])
+            conn.commit()
+
+        assert queue.get() == True
+        assert watcher.serial == wait_serial
+
+    def test_wait_tx_serial_watcher_timeout(self, keyfs, pool):
+        pool.register(keyfs.serial_watcher)
+        pool.start()
+        wait_serial = keyfs.get_next_serial()
+        assert not keyfs.wait_tx_serial(wait_serial, timeout=0.01)
+        assert keyfs.serial_watcher.serial == wait_serial - 1
+
+    def test_serial_watcher_in_process_commit(self, keyfs):
+        key = keyfs.add_key("NAME", "hello", int)
+        with keyfs.transaction(write=True):
+            key.set(1)
+        # commits of this process are seen without the thread
+        assert keyfs.serial_watcher.serial == keyfs.get_current_serial()
+
     def test_commit_serial(self, keyfs):
         with keyfs.transaction() as tx:
             pass
@@ -663,7 +1270,121 @@ def test_keyfs_sqlite(gentmp):
     with keyfs.transaction(write=False) as tx:
         assert tx.conn.io_file_os_path('foo') is None
         assert tx.conn.io_file_get('foo') == b'bar'
-    assert [x.basename for x in tmp.listdir()] == ['.sqlite']
+    assert sorted(x.basename for x in tmp.listdir()) == [
+        '.sqlite', '.sqlite-shm', '.sqlite-wal']
+
+
+def test_keyfs_sqlite_chunked_files(gentmp, monkeypatch):
+    from devpi_server import keyfs_sqlite
+    monkeypatch.setattr(keyfs_sqlite.Storage, "file_chunk_size", 3)
+    tmp = gentmp()
+    keyfs = KeyFS(tmp, keyfs_sqlite.Storage)
+    with keyfs.transaction(write=True) as tx:
+        tx.conn.io_file_set('foo', py.io.BytesIO(b'abcdefg'))
+        # readable before the commit
+        with tx.conn.io_file_open('foo') as f:
+            assert f.read() == b'abcdefg'
+        tx.conn.io_file_set('bar', b'')
+        tx.conn._sqlconn.commit()
+    with keyfs.transaction(write=False) as tx:
+        assert tx.conn.io_file_size('foo') == 7
+        assert tx.conn.io_file_get('foo') == b'abcdefg'
+        assert tx.conn.io_file_get('bar') == b''
+        f = tx.conn.io_file_open('foo')
+        c = tx.conn._sqlconn.cursor()
+        rows = c.execute(
+            "SELECT idx, data FROM file_chunks WHERE path = 'foo' "
+            "ORDER BY idx").fetchall()
+        assert [(x[0], bytes(x[1])) for x in rows] == [
+            (0, b'abc'), (1, b'def'), (2, b'g')]
+    # the chunks are read lazily, even after the transaction
+    assert list(f.iter_chunks()) == [b'abc', b'def', b'g']
+    with keyfs.transaction(write=True) as tx:
+        tx.conn.io_file_delete('foo')
+        c = tx.conn._sqlconn.cursor()
+        c.execute(
+            "INSERT INTO files (path, size, data) VALUES (?, ?, ?)",
+            ('legacy', 3, b'old'))
+        tx.conn._sqlconn.commit()
+    with keyfs.transaction(write=False) as tx:
+        assert not tx.conn.io_file_exists('foo')
+        c = tx.conn._sqlconn.cursor()
+        assert c.execute("SELECT * FROM file_chunks").fetchall() == []
+        # files stored before chunking are still readable
+        assert tx.conn.io_file_get('legacy') == b'old'
+        with tx.conn.io_file_open('legacy') as f:
+            assert f.read() == b'old'
+
+
+@pytest.mark.parametrize("backend", ["keyfs_sqlite", "keyfs_sqlite_fs"])
+def test_keyfs_sqlite_upgrade_value_column(gentmp, backend):
+    import sqlite3
+    from pydoc import locate
+    from devpi_server.fileutil import dumps
+    storage = locate("devpi_server.%s.Storage" % backend)
+    tmp = gentmp()
+    sqlconn = sqlite3.connect(tmp.join(".sqlite").strpath)
+    sqlconn.execute(
+        "CREATE TABLE kv (key TEXT NOT NULL PRIMARY KEY, keyname TEXT, serial INTEGER)")
+    sqlconn.execute(
+        "CREATE TABLE changelog (serial INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+    sqlconn.execute(
+        "CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, data BLOB NOT NULL)")
+    sqlconn.execute(
+        "INSERT INTO kv (key, keyname, serial) VALUES (?, ?, ?)",
+        ("hello", "NAME", 0))
+    sqlconn.execute(
+        "INSERT INTO changelog (serial, data) VALUES (?, ?)",
+        (0, sqlite3.Binary(dumps(({"hello": ("NAME", -1, {1: 1})}, [])))))
+    sqlconn.commit()
+    sqlconn.close()
+    keyfs = KeyFS(tmp, storage)
+    D = keyfs.add_key("NAME", "hello", dict)
+    with keyfs.transaction():
+        assert D.get() == {1: 1}
+    with keyfs.transaction(write=True):
+        D.set({2: 2})
+    with keyfs.transaction() as tx:
+        assert tx.conn.db_read_typedkey_value("hello") == ("NAME", 1, {2: 2})
+        assert tx.get_value_at(D, 0) == {1: 1}
+
+
+@pytest.mark.parametrize("backend", ["keyfs_sqlite", "keyfs_sqlite_fs"])
+def test_keyfs_sqlite_compact_without_value_column(gentmp, backend):
+    import sqlite3
+    from pydoc import locate
+    from devpi_server.fileutil import dumps
+    storage = locate("devpi_server.%s.Storage" % backend)
+    tmp = gentmp()
+    sqlconn = sqlite3.connect(tmp.join(".sqlite").strpath)
+    sqlconn.execute(
+        "CREATE TABLE kv (key TEXT NOT NULL PRIMARY KEY, keyname TEXT, serial INTEGER)")
+    sqlconn.execute(
+        "CREATE TABLE changelog (serial INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+    sqlconn.execute(
+        "CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, data BLOB NOT NULL)")
+    for serial, relpath in enumerate(("hello", "world")):
+        sqlconn.execute(
+            "INSERT INTO kv (key, keyname, serial) VALUES (?, ?, ?)",
+            (relpath, "NAME", serial))
+        sqlconn.execute(
+            "INSERT INTO changelog (serial, data) VALUES (?, ?)",
+            (serial, sqlite3.Binary(dumps(
+                ({relpath: ("NAME", -1, {serial: serial})}, [])))))
+    sqlconn.commit()
+    sqlconn.close()
+    keyfs = KeyFS(tmp, storage)
+    pkey = keyfs.add_key("NAME", "{name}", dict)
+    with keyfs.transaction(write=True):
+        pkey(name="hello").set({2: 2})
+    assert keyfs.compact_changelog(2) == 2
+    keyfs = KeyFS(tmp, storage)
+    pkey = keyfs.add_key("NAME", "{name}", dict)
+    with keyfs.transaction() as tx:
+        assert tx.conn.get_raw_changelog_entry(1) is None
+        assert pkey(name="hello").get() == {2: 2}
+        assert pkey(name="world").get() == {1: 1}
+        assert tx.get_value_at(pkey(name="world"), 2) == {1: 1}
 
 
 def test_keyfs_sqlite_fs(gentmp):
@@ -678,4 +1399,284 @@ def test_keyfs_sqlite_fs(gentmp):
         assert tx.conn.io_file_get('foo') == b'bar'
         with open(tx.conn.io_file_os_path('foo'), 'rb') as f:
             assert f.read() == b'bar'
-    assert sorted(x.basename for x in tmp.listdir()) == ['.sqlite', 'foo']
+    assert sorted(x.basename for x in tmp.listdir()) == [
+        '.sqlite', '.sqlite-shm', '.sqlite-wal', 'foo']
+
+
+@pytest.mark.parametrize("backend", ["keyfs_sqlite", "keyfs_sqlite_fs"])
+class TestSqliteConnections:
+    @pytest.fixture
+    def makestorage(self, gentmp, backend):
+        from pydoc import locate
+        storage = locate("devpi_server.%s.Storage" % backend)
+
+        def makestorage(settings=None):
+            return storage(
+                gentmp(), notify_on_commit=lambda serial: None,
+                cache_size=10, settings=settings)
+        return makestorage
+
+    def test_read_connection_per_thread(self, makestorage):
+        storage = makestorage()
+        with storage.get_connection() as conn1:
+            with storage.get_connection() as conn2:
+                assert conn1._sqlconn is conn2._sqlconn
+        # the pooled connection is still usable after closing
+        assert conn1.db_read_last_changelog_serial() == -1
+        result = []
+
+        def run():
+            with storage.get_connection() as conn:
+                result.append(conn._sqlconn)
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        assert result[0] is not conn1._sqlconn
+        with storage.get_connection(write=True) as conn:
+            assert conn._sqlconn is not conn1._sqlconn
+
+    def test_wait_for_commit(self, makestorage):
+        storage = makestorage()
+        storage.files_check_interval = 0.001
+        # the first call reports a change to get the initial state
+        assert storage.wait_for_commit(0)
+        assert not storage.wait_for_commit(0.01)
+        with storage.get_connection(write=True) as conn:
+            conn.write_changelog_entry(0, [{}, ()])
+            conn.commit()
+        assert storage.wait_for_commit(0.01)
+        assert not storage.wait_for_commit(0.01)
+
+    def test_wal_mode(self, makestorage):
+        storage = makestorage()
+        with storage.get_connection() as conn:
+            c = conn._sqlconn
+            assert c.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert storage.checkpointer is not None
+        with storage.get_connection(write=True) as conn:
+            conn.write_changelog_entry(0, [{}, ()])
+            conn.commit()
+        sqlconn = storage._get_sqlconn(storage._get_uri("rw"))
+        storage.checkpointer.checkpoint(sqlconn)
+        sqlconn.close()
+
+    def test_journal_mode_setting(self, makestorage):
+        storage = makestorage(settings={"journal_mode": "DELETE"})
+        with storage.get_connection() as conn:
+            c = conn._sqlconn
+            assert c.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+        assert storage.checkpointer is None
+
+    def test_journal_mode_invalid(self, makestorage):
+        with pytest.raises(ValueError) as e:
+            makestorage(settings={"journal_mode": "wal; DROP TABLE kv"})
+        assert "journal_mode" in str(e.value)
+
+    def test_close(self, makestorage):
+        import sqlite3
+        storage = makestorage()
+        result = []
+
+        def run():
+            with storage.get_connection() as conn:
+                result.append(conn._sqlconn)
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        with storage.get_connection() as conn:
+            sqlconn = conn._sqlconn
+        storage.close()
+        for c in (result[0], sqlconn):
+            with pytest.raises(sqlite3.ProgrammingError):
+                c.execute("SELECT 1")
+        # a new one is opened on the next use
+        with storage.get_connection() as conn:
+            assert conn._sqlconn is not sqlconn
+            assert conn.db_read_last_changelog_serial() == -1
+        storage.close()
+
+    def test_pragma_settings(self, makestorage):
+        storage = makestorage(settings={
+            "cache_size": "-4000", "mmap_size": "1048576",
+            "synchronous": "normal"})
+        for write in (False, True):
+            with storage.get_connection(write=write) as conn:
+                c = conn._sqlconn
+                assert c.execute("PRAGMA cache_size").fetchone()[0] == -4000
+                assert c.execute("PRAGMA mmap_size").fetchone()[0] == 1048576
+                # NORMAL
+                assert c.execute("PRAGMA synchronous").fetchone()[0] == 1
+
+    def test_writer_queue_commits_before_handing_over(self, makestorage):
+        storage = makestorage()
+        notified = []
+        storage._notify_on_commit = notified.append
+        started = threading.Event()
+        proceed = threading.Event()
+        result = []
+
+        def run():
+            started.set()
+            with storage.get_connection(write=True) as conn:
+                result.append(conn.last_changelog_serial)
+                # a slow writer, like one fetching from a mirror
+                proceed.wait(10)
+                conn.write_changelog_entry(1, [{}, ()])
+                conn.commit_serial(1)
+        thread = threading.Thread(target=run)
+        with storage.get_connection(write=True) as conn:
+            thread.start()
+            started.wait()
+            while not storage.writer_queue.get_stats()["waiting"]:
+                time.sleep(0.01)
+            conn.write_changelog_entry(0, [{}, ()])
+            # returns without waiting for the second writer
+            conn.commit_serial(0)
+        try:
+            assert notified == [0]
+            with storage.get_connection() as conn:
+                assert conn.db_read_last_changelog_serial() == 0
+            while not result:
+                time.sleep(0.01)
+            # the second writer saw the committed entry of the first
+            assert result == [0]
+        finally:
+            proceed.set()
+            thread.join()
+        assert notified == [0, 1]
+        stats = storage.writer_queue.get_stats()
+        assert stats["held"] == 0
+        assert stats["wait-count"] >= 2
+        with storage.get_connection() as conn:
+            assert conn.db_read_last_changelog_serial() == 1
+
+    def test_writer_queue_hold(self, makestorage):
+        storage = makestorage()
+        notified = []
+        storage._notify_on_commit = notified.append
+        commits = storage.writer_queue.get_stats()["commits"]
+        with storage.hold_commits():
+            for serial in range(3):
+                with storage.get_connection(write=True) as conn:
+                    assert conn.last_changelog_serial == serial - 1
+                    conn.write_changelog_entry(serial, [{}, ()])
+                    conn.commit_serial(serial)
+            # nothing is committed yet
+            assert notified == []
+            with storage.get_connection() as conn:
+                assert conn.db_read_last_changelog_serial() == -1
+        assert notified == [0, 1, 2]
+        stats = storage.writer_queue.get_stats()
+        assert stats["commits"] == commits + 1
+        assert stats["held"] == 3
+        with storage.get_connection() as conn:
+            assert conn.db_read_last_changelog_serial() == 2
+        # without writes nothing is committed
+        with storage.hold_commits():
+            pass
+        assert storage.writer_queue.get_stats()["commits"] == commits + 1
+
+    def test_writer_queue_hold_cache(self, makestorage):
+        storage = makestorage()
+        cache = storage._changelog_cache
+        with storage.hold_commits():
+            with storage.get_connection(write=True) as conn:
+                conn.write_changelog_entry(0, [{}, ()])
+                conn.commit_serial(0, changes={})
+            with storage.get_connection(write=True) as conn:
+                # reading the uncommitted entry doesn't cache it either
+                assert conn.get_changes(0) == {}
+                conn.write_changelog_entry(1, [{}, ()])
+                conn.commit_serial(1, changes={})
+            assert cache.get(0) is None
+            assert cache.get(1) is None
+        assert cache.get(0) == {}
+        assert cache.get(1) == {}
+
+    def test_writer_queue_hold_rollback_cache(self, makestorage):
+        storage = makestorage()
+        with pytest.raises(RuntimeError):
+            with storage.hold_commits():
+                with storage.get_connection(write=True) as conn:
+                    conn.write_changelog_entry(0, [{}, ()])
+                    conn.commit_serial(0, changes={})
+                group = storage.writer_queue._held
+
+                def fail(after_commit=None):
+                    group.sqlconn.rollback()
+                    group.sqlconn.close()
+                    raise RuntimeError()
+                group.commit = fail
+        assert storage._changelog_cache.get(0) is None
+        with storage.get_connection() as conn:
+            assert conn.db_read_last_changelog_serial() == -1
+
+    def test_writer_queue_hold_other_thread(self, makestorage):
+        storage = makestorage()
+        notified = []
+        storage._notify_on_commit = notified.append
+        result = []
+
+        def run():
+            with storage.get_connection(write=True) as conn:
+                conn.write_changelog_entry(1, [{}, ()])
+                conn.commit_serial(1)
+            # committed before returning, although commits are held
+            with storage.get_connection() as conn:
+                result.append(conn.db_read_last_changelog_serial())
+        with storage.hold_commits():
+            with storage.get_connection(write=True) as conn:
+                conn.write_changelog_entry(0, [{}, ()])
+                conn.commit_serial(0)
+            assert notified == []
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+            assert result == [1]
+            assert notified == [0, 1]
+        with storage.get_connection() as conn:
+            assert conn.db_read_last_changelog_serial() == 1
+
+    def test_writer_queue_rollback_in_group(self, makestorage):
+        storage = makestorage()
+        group = WriteGroup(storage, storage._new_write_sqlconn())
+        storage.writer_queue.acquire()
+        conn = storage.Connection(
+            group.sqlconn, storage.basedir, storage, write_group=group)
+        conn.write_changelog_entry(0, [{}, ()])
+        group.end(conn, serial=0)
+        group.begin()
+        conn = storage.Connection(
+            group.sqlconn, storage.basedir, storage, write_group=group)
+        conn.write_changelog_entry(1, [{}, ()])
+        # only the changes of the second writer are rolled back
+        conn.rollback()
+        with storage.get_connection() as conn:
+            assert conn.db_read_last_changelog_serial() == 0
+
+    def test_recode(self, makestorage):
+        from devpi_server.fileutil import Codec, get_codec_info
+        storage = makestorage(settings={"codec": "legacy"})
+        with storage.get_connection(write=True) as conn:
+            conn.db_write_typedkey("hello", "NAME", 0, {1: 1})
+            conn.write_changelog_entry(0, [{"hello": ("NAME", -1, {1: 1})}, ()])
+            conn.commit_serial(0)
+        with storage.get_connection() as conn:
+            raw = conn.get_raw_changelog_entry(0)
+        assert get_codec_info(raw) == ("legacy", "none")
+        storage.codec = Codec("marshal")
+        assert dict(storage.recode(batch_size=1)) == {
+            "changelog": 1, "kv": 1, "kv_history": 1}
+        with storage.get_connection() as conn:
+            raw = conn.get_raw_changelog_entry(0)
+            assert get_codec_info(raw) == ("marshal", "none")
+            assert conn.db_read_typedkey_value("hello") == ("NAME", 0, {1: 1})
+        # nothing left to do
+        assert dict(storage.recode()) == {
+            "changelog": 0, "kv": 0, "kv_history": 0}
+
+    def test_invalid_pragma_settings(self, makestorage):
+        with pytest.raises(ValueError):
+            makestorage(settings={"synchronous": "sometimes"})
+        with pytest.raises(ValueError):
+            makestorage(settings={"cache_size": "big"})
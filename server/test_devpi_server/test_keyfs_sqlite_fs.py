@@ -1,7 +1,10 @@
 
+from devpi_server.keyfs import KeyFS
 from devpi_server.keyfs_sqlite_fs import (
     commit_renames, make_rel_renames, check_pending_renames
 )
+from devpi_server.keyfs_sqlite_fs import Storage
+import py
 
 class TestRenameFileLogic:
     def test_new_content_nocrash(self, tmpdir):
@@ -57,3 +60,45 @@ class TestRenameFileLogic:
         assert not file1.exists()
         assert len(caplog.getrecords(".*completed.*file-del.*")) == 1
 
+
+
+class TestSpooledFiles:
+    def test_commit(self, tmpdir):
+        keyfs = KeyFS(tmpdir, Storage)
+        with keyfs.transaction(write=True) as tx:
+            f = tx.conn.io_file_new_open('foo/bar')
+            assert f.name.startswith(tmpdir.join('foo', 'bar-').strpath)
+            f.write(b'hello')
+            f.seek(0)
+            tx.conn.io_file_set('foo/bar', f)
+            assert f.closed
+            assert tx.conn.io_file_get('foo/bar') == b'hello'
+            assert tx.conn.io_file_size('foo/bar') == 5
+            with tx.conn.io_file_open('foo/bar') as f2:
+                assert f2.read() == b'hello'
+            # the commit needs a changed key
+            tx.set(keyfs.add_key("NAME", "name", dict), {})
+        assert tmpdir.join('foo', 'bar').read_binary() == b'hello'
+        assert tmpdir.join('foo').listdir() == [tmpdir.join('foo', 'bar')]
+
+    def test_rollback(self, tmpdir):
+        keyfs = KeyFS(tmpdir, Storage)
+        tx = keyfs.begin_transaction_in_thread(write=True)
+        f = tx.conn.io_file_new_open('foo/bar')
+        f.write(b'hello')
+        tx.conn.io_file_set('foo/bar', f)
+        assert len(tmpdir.join('foo').listdir()) == 1
+        keyfs.rollback_transaction_in_thread()
+        assert tmpdir.join('foo').listdir() == []
+
+    def test_replaced(self, tmpdir):
+        keyfs = KeyFS(tmpdir, Storage)
+        with keyfs.transaction(write=True) as tx:
+            f = tx.conn.io_file_new_open('foo/bar')
+            f.write(b'hello')
+            tx.conn.io_file_set('foo/bar', f)
+            tx.conn.io_file_set('foo/bar', py.io.BytesIO(b'world'))
+            assert len(tmpdir.join('foo').listdir()) == 1
+            tx.set(keyfs.add_key("NAME", "name", dict), {})
+        assert tmpdir.join('foo').listdir() == [tmpdir.join('foo', 'bar')]
+        assert tmpdir.join('foo', 'bar').read_binary() == b'world'
@@ -65,13 +65,14 @@ def test_pyramid_configure_called(makexom):
 
 
 def test_requests_only(makexom):
+    # only the thread which learns about commits of other processes runs
     xom = makexom(opts=["--requests-only"])
     xom.create_app()
-    assert not xom.thread_pool._objects
+    assert xom.thread_pool._objects == [xom.keyfs.serial_watcher]
 
     xom = makexom(opts=["--requests-only", "--master=http://localhost:3140"])
     xom.create_app()
-    assert not xom.thread_pool._objects
+    assert xom.thread_pool._objects == [xom.keyfs.serial_watcher]
 
 
 @wsgi_run_throws
@@ -727,6 +727,19 @@ class TestStage:
         stage.set_versiondata(udict(name="hello", version="0.9"))
         assert stage.get_latest_version_perstage("hello") == "1.1"
 
+    def test_get_versiondata_many_perstage(self, stage):
+        stage.set_versiondata(udict(name="hello", version="1.0"))
+        stage.set_versiondata(udict(name="hello", version="1.1"))
+        stage.set_versiondata(udict(name="world", version="2.0"))
+        assert stage.list_versions_many_perstage(
+            ["hello", "world", "other"]) == [
+                set(["1.0", "1.1"]), set(["2.0"]), set()]
+        verdatas = stage.get_versiondata_many_perstage([
+            ("hello", "1.1"), ("world", "2.0"), ("world", "3.0")])
+        assert verdatas[0]["version"] == "1.1"
+        assert verdatas[1]["name"] == "world"
+        assert verdatas[2] == {}
+
     def test_get_versiondata_latest_inheritance(self, user, model, stage):
         stage_base_name = stage.index + "base"
         user.create_stage(index=stage_base_name, bases=(stage.name,))
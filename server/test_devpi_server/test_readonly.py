@@ -1,5 +1,6 @@
 import pytest
 
+from devpi_server import readonly
 from devpi_server.readonly import *
 
 class TestDictReadonlyView:
@@ -114,3 +115,99 @@ def test_is_sequence():
     assert is_sequence(())
     assert is_sequence(ensure_deeply_readonly(()))
     assert is_sequence(ensure_deeply_readonly([]))
+
+
+class TestFrozen:
+    def test_no_allocation_on_access(self):
+        r = ensure_deeply_readonly({1: {2: [3]}})
+        assert r[1] is r[1]
+        assert r[1][2] is r[1][2]
+        assert ensure_deeply_readonly(r) is r
+
+    def test_mutation_raises(self):
+        r = ensure_deeply_readonly({1: 2})
+        with pytest.raises(TypeError):
+            r[1] = 3
+        with pytest.raises(AttributeError):
+            r.update({})
+        with pytest.raises(AttributeError):
+            r.pop(1)
+        assert r == {1: 2}
+
+    def test_list_tuple_equality(self):
+        assert ensure_deeply_readonly([]) == []
+        assert ensure_deeply_readonly([]) != ()
+        assert ensure_deeply_readonly(()) == ()
+        assert ensure_deeply_readonly(()) != []
+        assert get_mutable_deepcopy(ensure_deeply_readonly([1])) == [1]
+        assert get_mutable_deepcopy(ensure_deeply_readonly((1,))) == (1,)
+
+    def test_json(self):
+        import json
+        r = ensure_deeply_readonly({"a": [1, {"b": (2,)}]})
+        assert json.loads(json.dumps(r)) == {"a": [1, {"b": [2]}]}
+
+
+class TestCopyOnWrite:
+    @pytest.mark.skipif(
+        not readonly._dict_copy_uses_getitem,
+        reason="dicts are copied right away")
+    def test_only_touched_path_copied(self):
+        r = ensure_deeply_readonly({"a": {"x": [1]}, "b": {"y": [2]}})
+        c = get_mutable_copy(r)
+        c["a"]["x"].append(3)
+        assert c == {"a": {"x": [1, 3]}, "b": {"y": [2]}}
+        assert r == {"a": {"x": [1]}, "b": {"y": [2]}}
+        # untouched values are shared
+        assert dict.__getitem__(c, "b") is r["b"]
+        f = ensure_deeply_readonly(c)
+        assert f["b"] is r["b"]
+        assert f == {"a": {"x": [1, 3]}, "b": {"y": [2]}}
+
+    def test_iteration_thaws(self):
+        r = ensure_deeply_readonly({"a": [{"x": 1}], "b": set([1])})
+        c = get_mutable_copy(r)
+        for key, val in c.items():
+            assert not is_deeply_readonly(val)
+        for item in c["a"]:
+            item["x"] = 2
+        c["b"].add(2)
+        assert c == {"a": [{"x": 2}], "b": set([1, 2])}
+        assert r == {"a": [{"x": 1}], "b": set([1])}
+
+    def test_pop(self):
+        r = ensure_deeply_readonly({"a": [[1]]})
+        c = get_mutable_copy(r)
+        l = c.pop("a")
+        l.pop().append(2)
+        assert r == {"a": [[1]]}
+
+    def test_deepcopy_is_plain(self):
+        c = get_mutable_copy(ensure_deeply_readonly({"a": [{"x": 1}]}))
+        d = get_mutable_deepcopy(c)
+        assert type(d) is dict
+        assert type(d["a"]) is list
+        assert type(d["a"][0]) is dict
+
+    def test_dict_copies_thaw(self):
+        r = ensure_deeply_readonly({"a": {"x": 0}})
+        other = {}
+        other.update(get_mutable_copy(r))
+        for d in (dict(get_mutable_copy(r)), dict(**get_mutable_copy(r)),
+                  get_mutable_copy(r).copy(), other):
+            d["a"]["x"] = 1
+            assert d == {"a": {"x": 1}}
+        assert r == {"a": {"x": 0}}
+
+    def test_list_copies_thaw(self):
+        r = ensure_deeply_readonly([{"x": 0}])
+        copies = [
+            list(get_mutable_copy(r)), [] + get_mutable_copy(r),
+            get_mutable_copy(r) + [], get_mutable_copy(r) * 1,
+            get_mutable_copy(r)[:]]
+        if hasattr(list, "copy"):
+            copies.append(get_mutable_copy(r).copy())
+        for l in copies:
+            l[0]["x"] = 1
+            assert l == [{"x": 1}]
+        assert r == [{"x": 0}]
@@ -52,6 +52,67 @@ class TestChangelog:
         data = loads(body)
         assert "this" in str(data)
 
+    def test_get_next_serial_header(self, testapp, monkeypatch):
+        import threading
+        keyfs = testapp.xom.keyfs
+        latest_serial = self.get_latest_serial(testapp)
+
+        def commit():
+            with keyfs.transaction(write=True):
+                keyfs.USER(user="hello").set({})
+
+        def wait_tx_serial(serial, timeout=None):
+            # the entry is committed while the request waits for it
+            thread = threading.Thread(target=commit)
+            thread.start()
+            thread.join()
+            return True
+
+        monkeypatch.setattr(keyfs, "wait_tx_serial", wait_tx_serial)
+        r = testapp.get("/+changelog/%s" % (latest_serial + 1))
+        assert r.headers["X-DEVPI-SERIAL"] == str(latest_serial + 1)
+
+    def test_get_since_codecs(self, testapp, mapp, noiter):
+        from devpi_server.fileutil import get_codec_info
+        from devpi_server.fileutil import loads as codec_loads
+        mapp.create_user("this", password="p")
+        latest_serial = self.get_latest_serial(testapp)
+        with testapp.xom.keyfs.transaction() as tx:
+            raw_entry = tx.conn.get_raw_changelog_entry(latest_serial)
+        r = testapp.get(
+            "/+changelog/%s" % latest_serial, expect_errors=False,
+            headers={H_REPLICA_CODECS: "marshal,zlib"})
+        body = b''.join(r.app_iter)
+        # the entry is sent as stored
+        assert body == raw_entry
+        assert get_codec_info(body)[0] == "marshal"
+        assert "this" in str(codec_loads(body))
+
+    def test_get_since_compressed(self, testapp, noiter):
+        from devpi_server.fileutil import get_codec_info
+        from devpi_server.fileutil import loads as codec_loads
+        keyfs = testapp.xom.keyfs
+        with keyfs.transaction(write=True):
+            keyfs.USER(user="big").set({"data": "x" * 5000})
+        latest_serial = self.get_latest_serial(testapp)
+        with keyfs.transaction() as tx:
+            raw_entry = tx.conn.get_raw_changelog_entry(latest_serial)
+        assert get_codec_info(raw_entry) == ("marshal", "none")
+        url = "/+changelog/%s" % latest_serial
+        r = testapp.get(url, headers={H_REPLICA_CODECS: "marshal"})
+        assert b''.join(r.app_iter) == raw_entry
+        r = testapp.get(url, headers={H_REPLICA_CODECS: "marshal,zlib"})
+        body = b''.join(r.app_iter)
+        assert get_codec_info(body) == ("marshal", "zlib")
+        assert len(body) < len(raw_entry) // 10
+        assert codec_loads(body) == codec_loads(raw_entry)
+        # the compressed entry is reused for other replicas
+        cache = testapp.xom.replica_entry_cache
+        assert cache.get((latest_serial, "zlib")) == body
+        cache.put((latest_serial, "zlib"), b"cached")
+        r = testapp.get(url, headers={H_REPLICA_CODECS: "marshal,zlib"})
+        assert b''.join(r.app_iter) == b"cached"
+
     def test_wait_entry_fails(self, testapp, mapp, noiter, monkeypatch,
                                     reqchangelog):
         mapp.create_user("this", password="p")
@@ -72,6 +133,130 @@ class TestChangelog:
             entry = mcr._wait_for_entry(xom.keyfs.get_current_serial())
         assert entry
 
+    def test_compacted_entry_gone(self, testapp, mapp, noiter):
+        mapp.create_user("this", password="p")
+        mapp.create_user("that", password="p")
+        latest_serial = self.get_latest_serial(testapp)
+        testapp.xom.keyfs.compact_changelog(latest_serial)
+        testapp.xget(410, "/+changelog/%s" % (latest_serial - 1))
+        testapp.xget(200, "/+changelog/%s" % latest_serial)
+
+    def test_get_changes_range(self, testapp, mapp):
+        from devpi_server.fileutil import loads as codec_loads
+        mapp.create_user("this", password="p")
+        mapp.create_user("that", password="p")
+        latest_serial = self.get_latest_serial(testapp)
+        # the end is capped at the current serial
+        r = testapp.xget(
+            200, "/+changelog/%s-%s" % (latest_serial - 1, latest_serial + 10))
+        assert int(r.headers["X-DEVPI-SERIAL"]) == latest_serial
+        frames = list(iter_frames(py.io.BytesIO(r.body)))
+        assert len(frames) == 2
+        with testapp.xom.keyfs.transaction() as tx:
+            for serial, frame in zip(range(latest_serial - 1, 100), frames):
+                changes = tx.conn.get_changes(serial)
+                assert codec_loads(frame)[0] == changes
+        assert "that/.config" in str(codec_loads(frames[-1]))
+
+    def test_get_changes_range_limited(self, testapp, mapp, monkeypatch):
+        monkeypatch.setattr("devpi_server.replica.MAX_CHANGELOG_RANGE", 2)
+        mapp.create_user("this", password="p")
+        mapp.create_user("that", password="p")
+        latest_serial = self.get_latest_serial(testapp)
+        assert latest_serial >= 2
+        r = testapp.xget(200, "/+changelog/0-%s" % latest_serial)
+        assert len(list(iter_frames(py.io.BytesIO(r.body)))) == 2
+
+    def test_get_changes_range_invalid(self, testapp, mapp):
+        mapp.create_user("this", password="p")
+        latest_serial = self.get_latest_serial(testapp)
+        testapp.xget(400, "/+changelog/%s-0" % latest_serial)
+        testapp.xget(404, "/+changelog/0-foo")
+
+    def test_get_changes_range_compacted(self, testapp, mapp):
+        mapp.create_user("this", password="p")
+        mapp.create_user("that", password="p")
+        latest_serial = self.get_latest_serial(testapp)
+        testapp.xom.keyfs.compact_changelog(latest_serial)
+        testapp.xget(410, "/+changelog/0-%s" % latest_serial)
+
+    def test_get_changes_stream(self, testapp, mapp, noiter, monkeypatch):
+        from devpi_server.fileutil import loads as codec_loads
+        monkeypatch.setattr(
+            MasterChangelogRequest, "STREAM_HEARTBEAT_INTERVAL", 0.01)
+        mapp.create_user("this", password="p")
+        latest_serial = self.get_latest_serial(testapp)
+        r = testapp.xget(
+            200, "/+changelog/%s-" % latest_serial,
+            headers={H_REPLICA_UUID: self.replica_uuid})
+        assert int(r.headers["X-DEVPI-SERIAL"]) == latest_serial
+        chunks = iter(r.app_iter)
+
+        def next_frame():
+            (frame,) = iter_frames(py.io.BytesIO(next(chunks)))
+            return frame
+        assert "this" in str(codec_loads(next_frame()))
+        # nothing new yet
+        assert next_frame() == b""
+        status = testapp.xom.polling_replicas[self.replica_uuid]
+        assert status["in-request"]
+        assert status["serial"] == latest_serial
+        mapp.create_user("that", password="p")
+        frame = next_frame()
+        while not frame:
+            frame = next_frame()
+        assert "that" in str(codec_loads(frame))
+        assert next_frame() == b""
+        assert status["serial"] == latest_serial + 1
+        r.app_iter.close()
+        assert not status["in-request"]
+
+    def test_get_changes_stream_invalid(self, testapp, mapp):
+        mapp.create_user("this", password="p")
+        mapp.create_user("that", password="p")
+        latest_serial = self.get_latest_serial(testapp)
+        testapp.xget(404, "/+changelog/%s-" % (latest_serial + 2))
+        testapp.xom.keyfs.compact_changelog(latest_serial)
+        testapp.xget(410, "/+changelog/0-")
+
+    def test_get_snapshot(self, testapp, mapp):
+        from devpi_server.fileutil import loads as codec_loads
+        mapp.create_user("this", password="p")
+        latest_serial = self.get_latest_serial(testapp)
+        r = testapp.xget(200, "/+snapshot")
+        assert int(r.headers["X-DEVPI-SERIAL"]) == latest_serial
+        frames = list(iter_snapshot_frames(py.io.BytesIO(r.body)))
+        (kind, header) = frames[0]
+        assert kind == "header"
+        assert header["serial"] == latest_serial
+        with testapp.xom.keyfs.transaction() as tx:
+            changes = tx.conn.get_changes(latest_serial)
+        assert "this/.config" in changes
+        assert codec_loads(header["changelog_entry"])[0] == changes
+        entries = dict(
+            (x[0], x[1:]) for kind, data in frames if kind == "keys"
+            for x in data)
+        (keyname, last_serial, val) = entries["this/.config"]
+        assert keyname == "USER"
+        assert last_serial == latest_serial
+        assert frames[-2] == ("files", [])
+        assert frames[-1] == ("end", dict(keys=len(entries), files=0))
+
+    def test_get_snapshot_zstd(self, testapp, mapp):
+        from devpi_server.fileutil import get_codec_info
+        pytest.importorskip("zstandard")
+        mapp.create_user("this", password="p")
+        r = testapp.xget(
+            200, "/+snapshot", headers={H_REPLICA_CODECS: "marshal,zstd"})
+        frames = list(iter_frames(py.io.BytesIO(r.body)))
+        assert get_codec_info(frames[0]) == ("marshal", "zstd")
+        (kind, header) = next(iter_snapshot_frames(py.io.BytesIO(r.body)))
+        assert kind == "header"
+
+    def test_get_snapshot_not_master(self, testapp):
+        testapp.xom.config.nodeinfo["role"] = "standalone"
+        testapp.xget(403, "/+snapshot")
+
     def test_master_id_mismatch(self, testapp):
         testapp.xget(400, "/+changelog/0", headers={H_EXPECTED_MASTER_ID:str("123")})
         r = testapp.xget(200, "/+changelog/0", headers={H_EXPECTED_MASTER_ID: ''})
@@ -79,6 +264,38 @@ class TestChangelog:
         del testapp.headers[H_EXPECTED_MASTER_ID]
         testapp.xget(400, "/+changelog/0")
 
+    def test_replica_no_cascade(self, maketestapp, makexom):
+        replica_xom = makexom(["--master", "http://localhost:3111"])
+        r_app = maketestapp(replica_xom)
+        r_app.xget(403, "/+changelog/nop", headers={H_EXPECTED_MASTER_ID: ''})
+
+    def test_replica_cascade(self, maketestapp, makexom, xom):
+        from devpi_server.fileutil import loads as codec_loads
+        replica_xom = makexom([
+            "--master", "http://localhost:3111", "--replica-cascade"])
+        r_app = maketestapp(replica_xom)
+        replica_xom.config.set_master_uuid("123")
+        raw_entry = get_raw_changelog_entry(xom, 0)
+        replica_xom.keyfs.import_changes(0, codec_loads(raw_entry)[0])
+        rt = replica_xom.replica_thread
+        rt._master_serial = 5
+        rt._upstream_serials = [7]
+        r_app.xget(400, "/+changelog/0", headers={H_EXPECTED_MASTER_ID: "456"})
+        r = r_app.xget(200, "/+changelog/0", headers={
+            H_EXPECTED_MASTER_ID: "123",
+            H_REPLICA_UUID: "111"})
+        assert codec_loads(r.body) == codec_loads(raw_entry)
+        # downstream replicas see the uuid of the master of the cascade
+        assert r.headers[H_MASTER_UUID] == "123"
+        assert r.headers[H_UPSTREAM_SERIALS] == "5,7"
+        assert replica_xom.polling_replicas["111"]["serial"] == -1
+        # also on responses which tell the replica to try again
+        rt._master_serial = 6
+        replica_xom.keyfs.wait_tx_serial = lambda *args, **kw: False
+        r = r_app.xget(202, "/+changelog/1", headers={
+            H_EXPECTED_MASTER_ID: "123"})
+        assert r.headers[H_UPSTREAM_SERIALS] == "6,7"
+
 
 def get_raw_changelog_entry(xom, serial):
     with xom.keyfs._storage.get_connection() as conn:
@@ -115,6 +332,13 @@ class TestReplicaThread:
             rt.thread_run()
         assert caplog.getrecords("404.*failed fetching*")
 
+    def test_thread_run_gone(self, rt, mockchangelog, caplog):
+        rt.thread.sleep = lambda x: 0/0
+        mockchangelog(0, code=410)
+        with pytest.raises(ZeroDivisionError):
+            rt.thread_run()
+        assert caplog.getrecords("410.*compacted its changelog")
+
     def test_thread_run_decode_error(self, rt, mockchangelog, caplog):
         rt.thread.sleep = lambda x: 0/0
         mockchangelog(0, code=200, data=b'qwelk')
@@ -158,6 +382,97 @@ class TestReplicaThread:
             rt.thread_run()
         assert caplog.getrecords("committed")
 
+    def test_thread_run_range(self, rt, reqmock, mockchangelog, caplog, xom):
+        rt.thread.sleep = lambda *x: 0/0
+        with xom.keyfs.transaction(write=True):
+            xom.model.create_user("qlwkej", "qwe")
+        with xom.keyfs.transaction(write=True):
+            xom.model.create_user("hello", "qwe")
+        rt._master_serial = 2
+        data = b"".join(
+            dump_frame(get_raw_changelog_entry(xom, serial))
+            for serial in range(3))
+        reqmock.mockresponse(
+            "http://localhost/+changelog/0-2", code=200, data=data,
+            headers={
+                "X-DEVPI-SERIAL": "2",
+                "X-DEVPI-MASTER-UUID": "123",
+                "X-DEVPI-UUID": "123"})
+        mockchangelog(3, code=404)
+        with pytest.raises(ZeroDivisionError):
+            rt.thread_run()
+        assert rt.xom.keyfs.get_current_serial() == 2
+        with rt.xom.keyfs.transaction() as tx:
+            assert tx.get(rt.xom.keyfs.USER(user="hello"))
+        assert rt.use_range
+
+    def test_tick_upstream_serials(self, rt, mockchangelog, xom):
+        rt.log = threadlog
+        rt.session = rt.xom.new_http_session("replica")
+        rt.use_range = False
+        assert rt.get_upstream_serials() == []
+        mockchangelog(0, code=202, headers={H_UPSTREAM_SERIALS: "3,4"})
+        rt.tick()
+        assert rt.get_upstream_serials() == [2, 3, 4]
+        # a master doesn't send the header
+        mockchangelog(0, code=202)
+        rt.tick()
+        assert rt.get_upstream_serials() == [2]
+
+    def test_thread_run_range_unsupported(self, rt, reqmock, mockchangelog,
+                                          caplog, xom):
+        rt.thread.sleep = lambda *x: 0/0
+        rt._master_serial = 2
+        reqmock.mockresponse(
+            "http://localhost/+changelog/0-2", code=404,
+            headers={"X-DEVPI-SERIAL": "2"})
+        mockchangelog(0, code=404)
+        with pytest.raises(ZeroDivisionError):
+            rt.thread_run()
+        assert not rt.use_range
+        assert caplog.getrecords("doesn't support fetching ranges")
+
+    def test_thread_run_stream(self, makexom, reqmock, mockchangelog, xom):
+        replica_xom = makexom(["--master=http://localhost", "--replica-stream"])
+        rt = ReplicaThread(replica_xom)
+        replica_xom.thread_pool.register(rt)
+        rt.thread.sleep = lambda *x: 0/0
+        with xom.keyfs.transaction(write=True):
+            xom.model.create_user("qlwkej", "qwe")
+        data = b"".join([
+            dump_frame(get_raw_changelog_entry(xom, 0)),
+            dump_frame(b""),
+            dump_frame(get_raw_changelog_entry(xom, 1)),
+            dump_frame(b"")])
+        reqmock.mockresponse(
+            "http://localhost/+changelog/0-", code=200, data=data,
+            headers={
+                "X-DEVPI-SERIAL": "0",
+                "X-DEVPI-MASTER-UUID": "123",
+                "X-DEVPI-UUID": "123"})
+        with pytest.raises(ZeroDivisionError):
+            rt.thread_run()
+        assert replica_xom.keyfs.get_current_serial() == 1
+        assert rt.get_master_serial() == 1
+        assert rt.replica_in_sync_at is not None
+        assert replica_xom.config.get_master_uuid() == "123"
+        assert rt.use_stream
+
+    def test_thread_run_stream_unsupported(self, makexom, reqmock,
+                                           mockchangelog, caplog):
+        replica_xom = makexom(["--master=http://localhost", "--replica-stream"])
+        rt = ReplicaThread(replica_xom)
+        replica_xom.thread_pool.register(rt)
+        rt.thread.sleep = lambda *x: 0/0
+        reqmock.mockresponse(
+            "http://localhost/+changelog/0-", code=404,
+            headers={"X-DEVPI-SERIAL": "2"})
+        mockchangelog(0, code=404)
+        with pytest.raises(ZeroDivisionError):
+            rt.thread_run()
+        assert not rt.use_stream
+        assert caplog.getrecords("doesn't support streaming")
+
     def test_thread_run_no_uuid(self, rt, mockchangelog, caplog, xom):
         rt.thread.sleep = lambda x: 0/0
         mockchangelog(0, code=200, data=b'123', uuid=None)
@@ -168,6 +483,8 @@ class TestReplicaThread:
     def test_thread_run_ok_uuid_change(self, rt, mockchangelog, caplog, xom, monkeypatch):
         monkeypatch.setattr("os._exit", lambda n: 0/0)
         rt.thread.sleep = lambda *x: 0/0
+        # fetch one entry per request
+        rt.use_range = False
         data = get_raw_changelog_entry(xom, 0)
         mockchangelog(0, code=200, data=data)
         mockchangelog(1, code=200, data=data,
@@ -179,6 +496,8 @@ class TestReplicaThread:
     def test_thread_run_serial_mismatch(self, rt, mockchangelog, caplog, xom, monkeypatch):
         monkeypatch.setattr("os._exit", lambda n: 0/0)
         rt.thread.sleep = lambda *x: 0/0
+        # fetch one entry per request
+        rt.use_range = False
 
         # we need to have at least two commits
         with xom.keyfs.transaction(write=True):
@@ -197,6 +516,8 @@ class TestReplicaThread:
     def test_thread_run_invalid_serial(self, rt, mockchangelog, caplog, xom, monkeypatch):
         monkeypatch.setattr("os._exit", lambda n: 0/0)
         rt.thread.sleep = lambda *x: 0/0
+        # fetch one entry per request
+        rt.use_range = False
         data = get_raw_changelog_entry(xom, 0)
         assert data
         mockchangelog(0, code=200, data=data)
@@ -210,6 +531,8 @@ class TestReplicaThread:
     def test_thread_run_missing_serial(self, rt, mockchangelog, caplog, xom, monkeypatch):
         monkeypatch.setattr("os._exit", lambda n: 0/0)
         rt.thread.sleep = lambda *x: 0/0
+        # fetch one entry per request
+        rt.use_range = False
         data = get_raw_changelog_entry(xom, 0)
         mockchangelog(0, code=200, data=data)
         data = get_raw_changelog_entry(xom, 1)
@@ -275,8 +598,50 @@ class TestTweenReplica:
         handler = tween_replica_proxy(None, {"xom": xom})
         response = handler(blank_request(method="PUT"))
         assert response.headers.get("X-DEVPI-SERIAL") == "10"
+        # the wait happens while the body is sent
+        assert l == []
+        assert response.body == b""
         assert l == [10]
 
+    def test_write_proxies_streaming(self, makexom, blank_request, reqmock,
+                                     monkeypatch):
+        xom = makexom(["--master", "http://localhost"])
+        monkeypatch.setattr("devpi_server.replica.PROXY_CHUNK_SIZE", 3)
+        reply = reqmock.mock(
+            "http://localhost/blankpath", code=200, data=b"1234567",
+            headers={"X-DEVPI-SERIAL": "10"})
+        l = []
+        monkeypatch.setattr(xom.keyfs, "wait_tx_serial",
+                            lambda x: l.append(x))
+        handler = tween_replica_proxy(None, {"xom": xom})
+        request = blank_request(method="PUT", body=b"upload" * 100)
+        response = handler(request)
+        # the upload is passed on as a stream
+        (proxied,) = reply.requests
+        assert not isinstance(proxied.body, bytes)
+        assert len(proxied.body) == 600
+        assert proxied.body.read() == b"upload" * 100
+        app_iter = iter(response.app_iter)
+        assert next(app_iter) == b"123"
+        assert next(app_iter) == b"456"
+        assert l == []
+        assert next(app_iter) == b"7"
+        assert l == [10]
+        assert list(app_iter) == []
+
+    def test_write_proxies_error(self, makexom, blank_request, reqmock,
+                                 monkeypatch):
+        xom = makexom(["--master", "http://localhost"])
+        reqmock.mock("http://localhost/blankpath", code=403, data=b"denied")
+        l = []
+        monkeypatch.setattr(xom.keyfs, "wait_tx_serial",
+                            lambda x: l.append(x))
+        handler = tween_replica_proxy(None, {"xom": xom})
+        response = handler(blank_request(method="PUT"))
+        assert response.status_code == 403
+        assert response.body == b"denied"
+        assert l == []
+
     def test_preserve_reason(self, makexom, blank_request, reqmock, monkeypatch):
         xom = makexom(["--master", "http://localhost"])
         reqmock.mock("http://localhost/blankpath",
@@ -551,6 +916,205 @@ class TestFileReplication:
             assert headers['content-length'] == '3'
             assert b''.join(result) == b'123'
 
+    def test_snapshot_bootstrap(self, xom, replica_xom, maketestapp,
+                                makemapp, reqmock):
+        xom.config.nodeinfo["role"] = "master"
+        app = maketestapp(xom)
+        app.set_header_default(H_EXPECTED_MASTER_ID, "")
+        mapp = makemapp(app)
+        api = mapp.create_and_use()
+        content1 = mapp.makepkg("hello-1.0.zip", b"content1", "hello", "1.0")
+        mapp.upload_file_pypi("hello-1.0.zip", content1, "hello", "1.0")
+        serial = xom.keyfs.get_current_serial()
+        r = app.xget(200, "/+snapshot")
+        master_url = replica_xom.config.master_url
+        reqmock.mockresponse(
+            master_url.joinpath("+snapshot").url, code=200, data=r.body,
+            headers={
+                H_MASTER_UUID: xom.config.get_master_uuid(),
+                "X-DEVPI-SERIAL": str(serial)})
+        (path,) = mapp.get_release_paths('hello')
+        replica_xom.httpget.mockresponse(
+            master_url.joinpath(path).url, code=200, content=content1,
+            headers={"content-length": "8",
+                     "last-modified": "Thu, 25 Nov 2010 20:00:27 GMT",
+                     "content-type": "application/zip"})
+        replica_xom.config.args.replica_file_workers = 4
+        rt = ReplicaThread(replica_xom)
+        replica_xom.thread_pool.register(rt)
+        rt.log = threadlog
+        rt.session = replica_xom.new_http_session("replica")
+        rt.bootstrap()
+        keyfs = replica_xom.keyfs
+        assert keyfs.get_current_serial() == serial
+        assert keyfs.notifier.read_event_serial() == serial
+        assert rt.get_master_serial() == serial
+        assert replica_xom.config.get_master_uuid() == xom.config.get_master_uuid()
+        # the files are downloaded by the file replication workers
+        queue = rt.file_queue
+        assert queue.get_stats() == {"queued": 1, "in-flight": 0}
+        relpath = queue.get(timeout=0)
+        assert relpath == path.strip("/")
+        FileReplicationWorker(replica_xom, queue, rt.errors).replicate(relpath)
+        queue.done(relpath)
+        assert queue.get_stats() == {"queued": 0, "in-flight": 0}
+        with keyfs.transaction():
+            stage = replica_xom.model.getstage(api.stagename)
+            assert stage.list_versions("hello") == set(["1.0"])
+            entry = replica_xom.filestore.get_file_entry(path.strip("/"))
+            assert entry.file_exists()
+            assert entry.file_get_content() == content1
+        # the changelog replication continues from the snapshot
+        mapp.set_versiondata(dict(name="hello", version="1.1"))
+        replay(xom, replica_xom, events=False)
+        with keyfs.transaction():
+            stage = replica_xom.model.getstage(api.stagename)
+            assert stage.list_versions("hello") == set(["1.0", "1.1"])
+
+    def test_fetch_queued(self, gen, xom, makexom):
+        replica_xom = makexom(["--master", "http://localhost"])
+        keyfs = replica_xom.keyfs
+        errors = ReplicationErrors(replica_xom.config.serverdir)
+        queue = FileReplicationQueue(replica_xom.config.serverdir)
+        for key in (keyfs.STAGEFILE, keyfs.PYPIFILE_NOMD5):
+            keyfs.subscribe_on_import(
+                key, ImportFileReplica(replica_xom, errors, queue=queue))
+        worker = FileReplicationWorker(replica_xom, queue, errors)
+        content1 = b'hello'
+        md5 = hashlib.md5(content1).hexdigest()
+        link = gen.pypi_package_link("pytest-1.8.zip#md5=%s" % md5, md5=False)
+        with xom.keyfs.transaction(write=True):
+            entry = xom.filestore.maplink(link, "root", "pypi")
+            entry.file_set_content(content1)
+        master_file_path = replica_xom.config.master_url.joinpath(
+            entry.relpath).url
+        replica_xom.httpget.mockresponse(
+            master_file_path, code=200, content=content1)
+        # the import only queues the file
+        replay(xom, replica_xom)
+        assert queue.get_stats() == {"queued": 1, "in-flight": 0}
+        with keyfs.transaction():
+            r_entry = replica_xom.filestore.get_file_entry(entry.relpath)
+            assert not r_entry.file_exists()
+        relpath = queue.get(timeout=0)
+        assert relpath == entry.relpath
+        assert queue.get_stats() == {"queued": 1, "in-flight": 1}
+        worker.replicate(relpath)
+        queue.done(relpath)
+        assert queue.get_stats() == {"queued": 0, "in-flight": 0}
+        with keyfs.transaction():
+            assert r_entry.file_exists()
+            assert r_entry.file_get_content() == content1
+        # deleting removes the file and a pending download
+        queue.add(entry.relpath)
+        with xom.keyfs.transaction(write=True):
+            entry.delete()
+        replay(xom, replica_xom)
+        assert queue.get_stats() == {"queued": 0, "in-flight": 0}
+        with keyfs.transaction():
+            assert not r_entry.file_exists()
+
+    def test_fetch_queued_checksum_mismatch(self, gen, xom, makexom):
+        replica_xom = makexom(["--master", "http://localhost"])
+        errors = ReplicationErrors(replica_xom.config.serverdir)
+        queue = FileReplicationQueue(replica_xom.config.serverdir)
+        worker = FileReplicationWorker(replica_xom, queue, errors)
+        content1 = b'hello'
+        md5 = hashlib.md5(content1).hexdigest()
+        link = gen.pypi_package_link("pytest-1.8.zip#md5=%s" % md5, md5=False)
+        with xom.keyfs.transaction(write=True):
+            entry = xom.filestore.maplink(link, "root", "pypi")
+            entry.file_set_content(content1)
+        replay(xom, replica_xom)
+        master_file_path = replica_xom.config.master_url.joinpath(
+            entry.relpath).url
+        replica_xom.httpget.mockresponse(
+            master_file_path, code=200, content=b'13')
+        worker.replicate(entry.relpath)
+        assert list(errors.errors) == [entry.relpath]
+        assert "mismatch" in errors.errors[entry.relpath]["message"]
+        with replica_xom.keyfs.transaction():
+            r_entry = replica_xom.filestore.get_file_entry(entry.relpath)
+            assert not r_entry.file_exists()
+
+    @pytest.mark.parametrize("code, content", [
+        (200, b'13'), (410, b''), (500, b'')])
+    def test_fetch_queued_removes_spool(self, gen, xom, makexom, monkeypatch,
+                                        code, content):
+        from devpi_server.filestore import FileEntry
+        replica_xom = makexom(["--master", "http://localhost"])
+        errors = ReplicationErrors(replica_xom.config.serverdir)
+        queue = FileReplicationQueue(replica_xom.config.serverdir)
+        worker = FileReplicationWorker(replica_xom, queue, errors)
+        spools = []
+        file_new_open = FileEntry.file_new_open
+
+        def new_open(entry):
+            f = file_new_open(entry)
+            spools.append(f)
+            return f
+        monkeypatch.setattr(FileEntry, "file_new_open", new_open)
+        content1 = b'hello'
+        md5 = hashlib.md5(content1).hexdigest()
+        link = gen.pypi_package_link("pytest-1.8.zip#md5=%s" % md5, md5=False)
+        with xom.keyfs.transaction(write=True):
+            entry = xom.filestore.maplink(link, "root", "pypi")
+            entry.file_set_content(content1)
+        replay(xom, replica_xom)
+        master_file_path = replica_xom.config.master_url.joinpath(
+            entry.relpath).url
+        replica_xom.httpget.mockresponse(
+            master_file_path, status_code=code, content=content)
+        if code == 500:
+            with pytest.raises(FileReplicationError):
+                worker.replicate(entry.relpath)
+        else:
+            worker.replicate(entry.relpath)
+        assert len(spools) == 1
+        assert spools[0].closed
+        name = getattr(spools[0], "name", None)
+        if isinstance(name, str):
+            assert not os.path.exists(name)
+        with replica_xom.keyfs.transaction():
+            r_entry = replica_xom.filestore.get_file_entry(entry.relpath)
+            assert not r_entry.file_exists()
+
+    def test_worker_retries(self, gen, xom, makexom, monkeypatch):
+        replica_xom = makexom(["--master", "http://localhost"])
+        errors = ReplicationErrors(replica_xom.config.serverdir)
+        queue = FileReplicationQueue(replica_xom.config.serverdir)
+        worker = FileReplicationWorker(replica_xom, queue, errors)
+        replica_xom.thread_pool.register(worker)
+        link = gen.pypi_package_link("some-1.8.zip", md5=False)
+        with xom.keyfs.transaction(write=True):
+            entry = xom.filestore.maplink(link, "root", "pypi")
+            entry.file_set_content(b'hello')
+        replay(xom, replica_xom)
+        master_file_path = replica_xom.config.master_url.joinpath(
+            entry.relpath).url
+        replica_xom.httpget.mockresponse(
+            master_file_path, status_code=500, content=b'')
+        queue.add(entry.relpath)
+        results = [entry.relpath]
+
+        def get(timeout=None):
+            # stop the worker after the first try
+            if not results:
+                raise mythread.Shutdown()
+            return FileReplicationQueue.get(queue, timeout=0)
+        monkeypatch.setattr(queue, "get", get)
+        monkeypatch.setattr(worker, "replicate", lambda relpath: (
+            results.pop(), FileReplicationWorker.replicate(worker, relpath)))
+        with pytest.raises(mythread.Shutdown):
+            worker.thread_run()
+        (relpath, tries, next_try) = queue._sqlconn.execute(
+            "SELECT relpath, tries, next_try FROM queue").fetchone()
+        assert relpath == entry.relpath
+        assert tries == 1
+        assert next_try > time.time()
+        # not due yet
+        assert FileReplicationQueue.get(queue, timeout=0) is None
+
     def test_checksum_mismatch(self, xom, replica_xom, gen, maketestapp,
                                makemapp, reqmock):
         # this test might seem to be doing the same as test_fetch above, but
@@ -701,3 +1265,47 @@ def test_auth_status_master_down(maketestapp, replica_xom, mock):
     assert len(calls) == 1
     assert calls[0][0][1].url == 'http://localhost/+api'
     assert r.json['result']['authstatus'] == ['fail', '', []]
+
+
+class TestFileReplicationQueue:
+    @pytest.fixture
+    def queue(self, tmpdir):
+        return FileReplicationQueue(tmpdir)
+
+    def test_persistent(self, queue, tmpdir):
+        queue.add("a")
+        queue.add("b")
+        assert queue.get(timeout=0) == "a"
+        # in flight entries are still queued after a restart
+        queue = FileReplicationQueue(tmpdir)
+        assert queue.get_stats() == {"queued": 2, "in-flight": 0}
+        assert queue.get(timeout=0) == "a"
+        assert queue.get(timeout=0) == "b"
+        assert queue.get(timeout=0) is None
+        queue.done("a")
+        queue.done("b")
+        assert queue.get_stats() == {"queued": 0, "in-flight": 0}
+
+    def test_added_again_while_in_flight(self, queue):
+        queue.add("a")
+        assert queue.get(timeout=0) == "a"
+        queue.add("a")
+        queue.done("a")
+        # the new request stays queued
+        assert queue.get(timeout=0) == "a"
+
+    def test_retry_backoff(self, queue, monkeypatch):
+        queue.add("a")
+        assert queue.get(timeout=0) == "a"
+        assert queue.retry("a") == 1
+        assert queue.get(timeout=0) is None
+        monkeypatch.setattr(queue, "retry_delay", 0)
+        queue.add("b")
+        assert queue.get(timeout=0) == "b"
+        assert queue.retry("b") == 1
+        assert queue.get(timeout=0.1) == "b"
+
+    def test_discard(self, queue):
+        queue.add("a")
+        queue.discard("a")
+        assert queue.get(timeout=0) is None
@@ -416,6 +416,119 @@ def test_pkgserv_remote_failure(httpget, pypistage, testapp):
     r = testapp.get(url)
     assert r.status_code == 502
 
+class TestPkgservConditional:
+    @pytest.fixture
+    def path(self, mapp):
+        mapp.create_and_use()
+        mapp.upload_file_pypi("pkg5-2.6.tgz", b"0123456789", "pkg5", "2.6")
+        path, = mapp.get_release_paths("pkg5")
+        return path
+
+    def test_etag(self, path, testapp):
+        r = testapp.xget(200, path)
+        assert r.body == b"0123456789"
+        assert r.headers["accept-ranges"] == "bytes"
+        assert r.headers["X-DEVPI-SERIAL"]
+        etag = r.headers["ETag"]
+        assert etag.startswith('"sha256=')
+        r = testapp.get(path, headers={"If-None-Match": etag})
+        assert r.status_code == 304
+        assert r.body == b""
+        r = testapp.get(path, headers={"If-None-Match": '"other"'})
+        assert r.status_code == 200
+
+    def test_if_modified_since(self, path, testapp):
+        r = testapp.xget(200, path)
+        last_modified = r.headers["last-modified"]
+        r = testapp.get(path, headers={"If-Modified-Since": last_modified})
+        assert r.status_code == 304
+        r = testapp.get(path, headers={
+            "If-Modified-Since": "Thu, 25 Nov 2010 20:00:27 GMT"})
+        assert r.status_code == 200
+
+    def test_range(self, path, testapp):
+        r = testapp.get(path, headers={"Range": "bytes=2-4"})
+        assert r.status_code == 206
+        assert r.body == b"234"
+        assert r.headers["content-range"] == "bytes 2-4/10"
+        assert r.headers["content-length"] == "3"
+        r = testapp.get(path, headers={"Range": "bytes=-3"})
+        assert r.status_code == 206
+        assert r.body == b"789"
+        r = testapp.get(path, headers={"Range": "bytes=20-"}, status=416)
+        assert r.status_code == 416
+
+    def test_if_range(self, path, testapp):
+        etag = testapp.xget(200, path).headers["ETag"]
+        r = testapp.get(path, headers={"Range": "bytes=2-4", "If-Range": etag})
+        assert r.status_code == 206
+        r = testapp.get(
+            path, headers={"Range": "bytes=2-4", "If-Range": '"other"'})
+        assert r.status_code == 200
+        assert r.body == b"0123456789"
+
+    def test_head(self, path, testapp):
+        r = testapp.head(path)
+        assert r.status_code == 200
+        assert r.headers["content-length"] == "10"
+        assert r.headers["ETag"]
+
+    @pytest.mark.storage_with_filesystem
+    def test_file_wrapper(self, path, testapp):
+        wrapped = []
+
+        def file_wrapper(f, block_size):
+            wrapped.append(f.name)
+            return iter(lambda: f.read(block_size), b"")
+
+        environ = {"wsgi.file_wrapper": file_wrapper}
+        r = testapp.get(path, extra_environ=environ)
+        assert r.body == b"0123456789"
+        assert len(wrapped) == 1
+        assert wrapped[0].endswith("pkg5-2.6.tgz")
+        # ranges are read from the file directly
+        r = testapp.get(
+            path, headers={"Range": "bytes=2-4"}, extra_environ=environ)
+        assert r.body == b"234"
+        assert len(wrapped) == 1
+
+    @pytest.mark.storage_with_filesystem
+    def test_x_accel_redirect(self, path, testapp):
+        testapp.xom.config.args.file_offload = "x-accel-redirect"
+        r = testapp.xget(200, path)
+        assert r.body == b""
+        redirect = r.headers["X-Accel-Redirect"]
+        assert redirect.startswith("/+files/")
+        assert redirect.endswith("/pkg5-2.6.tgz")
+        assert testapp.xom.keyfs.basedir.join(redirect).read_binary() == (
+            b"0123456789")
+        assert r.headers["ETag"]
+        assert r.headers["X-DEVPI-SERIAL"]
+        # conditional requests and HEAD are answered directly
+        r = testapp.get(path, headers={"If-None-Match": r.headers["ETag"]})
+        assert r.status_code == 304
+        assert "X-Accel-Redirect" not in r.headers
+        r = testapp.head(path)
+        assert r.headers["content-length"] == "10"
+        assert "X-Accel-Redirect" not in r.headers
+
+    @pytest.mark.storage_with_filesystem
+    def test_x_sendfile(self, path, testapp):
+        testapp.xom.config.args.file_offload = "x-sendfile"
+        r = testapp.xget(200, path)
+        assert r.body == b""
+        sendfile = py.path.local(r.headers["X-Sendfile"])
+        assert sendfile.read_binary() == b"0123456789"
+
+    def test_file_offload_without_filesystem(self, path, testapp, monkeypatch):
+        from devpi_server.filestore import FileEntry
+        monkeypatch.setattr(FileEntry, "file_os_path", lambda self: None)
+        testapp.xom.config.args.file_offload = "x-accel-redirect"
+        r = testapp.xget(200, path)
+        assert "X-Accel-Redirect" not in r.headers
+        assert r.body == b"0123456789"
+
+
 def test_apiconfig(testapp):
     r = testapp.get_json("/user/name/+api", status=404)
     assert r.status_code == 404
@@ -431,10 +544,27 @@ def test_getchanges(testapp):
 
 class TestStatus:
     def test_status_master(self, testapp):
+        testapp.get_json("/root", status=200)
+        testapp.get_json("/root", status=200)
         r = testapp.get_json("/+status", status=200)
         assert r.status_code == 200
         data = r.json["result"]
         assert data["role"] == "MASTER"
+        if "writer-queue" in data:
+            assert data["writer-queue"]["wait-count"] > 0
+        assert data["value-cache"]["misses"] > 0
+        assert data["value-cache"]["hits"] > 0
+
+    def test_status_storage_pools(self, testapp, monkeypatch):
+        storage = testapp.xom.keyfs._storage
+        if not hasattr(storage, "get_pool_stats"):
+            monkeypatch.setattr(
+                storage, "get_pool_stats",
+                lambda: {"read": {"size": 1, "checkouts": 1}}, raising=False)
+        r = testapp.get_json("/+status", status=200)
+        pools = r.json["result"]["storage-pools"]
+        assert set(pools) == set(storage.get_pool_stats())
+        assert pools["read"]["checkouts"] > 0
 
     def test_status_replica(self, maketestapp, replica_xom):
         testapp = maketestapp(replica_xom)
@@ -444,6 +574,27 @@ class TestStatus:
         assert data["role"] == "REPLICA"
         assert data["serial"] == replica_xom.keyfs.get_current_serial()
         assert data["replication-errors"] == {}
+        # files are fetched in the replication thread by default
+        assert "file-replication" not in data
+        assert data["upstream-serials"] == []
+        assert data["upstream-lag"] == []
+
+    def test_status_replica_file_workers(self, maketestapp, replica_xom):
+        replica_xom.config.args.replica_file_workers = 2
+        testapp = maketestapp(replica_xom)
+        r = testapp.get_json("/+status", status=200)
+        data = r.json["result"]
+        assert data["file-replication"] == {"queued": 0, "in-flight": 0}
+
+    def test_status_replica_cascade(self, maketestapp, replica_xom):
+        testapp = maketestapp(replica_xom)
+        serial = replica_xom.keyfs.get_current_serial()
+        replica_xom.replica_thread._master_serial = serial + 2
+        replica_xom.replica_thread._upstream_serials = [serial + 5]
+        r = testapp.get_json("/+status", status=200)
+        data = r.json["result"]
+        assert data["upstream-serials"] == [serial + 2, serial + 5]
+        assert data["upstream-lag"] == [2, 3]
 
 
 class TestStatusInfoPlugin:
@@ -865,6 +1016,22 @@ class TestSubmitValidation:
             assert log1['who'] == 'user'
             assert log1['dst'] == 'user/dev'
 
+    def test_upload_removes_spooled_files(self, submit, testapp, mapp, xom):
+        mapp.modify_index(submit.stagename, indexconfig=dict(volatile=False))
+        metadata = {"name": "Pkg5", "version": "2.6", ":action": "submit"}
+        submit.metadata(metadata, code=200)
+        submit.file("pkg5-2.6.tgz", b"123", {"name": "Pkg5"}, code=200)
+        mapp.upload_doc("pkg5-2.6.doc.zip", b"123", "pkg5", "2.6", code=200)
+        submit.file("pkg5-2.6.tgz", b"1234", {"name": "Pkg5"}, code=409)
+        mapp.upload_doc("pkg5-2.6.doc.zip", b"1234", "Pkg5", "2.6", code=409)
+        submit.file("pkg5-2.6.tgz", b"123", {"name": "Pkg5"}, code=200)
+        path, = mapp.get_release_paths("Pkg5")
+        assert testapp.xget(200, path).body == b"123"
+        spooled = [
+            x for x in xom.config.serverdir.visit()
+            if x.basename.endswith("-spool")]
+        assert spooled == []
+
     def test_upload_twice_to_volatile(self, submit, testapp, mapp):
         metadata = {"name": "Pkg5", "version": "2.6", ":action": "submit"}
         submit.metadata(metadata, code=200)
@@ -14,6 +14,15 @@ def is_project_cached(stage, project):
     return True
 
 
+def has_batch_reads(stage):
+    """ return True if the stage reads the versiondata of several versions
+    at once, the default of mirror stages only loops over them. """
+    if stage.ixconfig['type'] == 'mirror':
+        return False
+    # devpi-server without batch reads doesn't have the method
+    return hasattr(stage, "get_versiondata_many_perstage")
+
+
 def preprocess_project(stage, name_input):
     name = normalize_name(name_input)
     try:
@@ -27,6 +36,10 @@ def preprocess_project(stage, name_input):
         'author', 'author_email', 'classifiers', 'description', 'download_url',
         'home_page', 'keywords', 'license', 'platform', 'summary'))
     versions = get_sorted_versions(stage.list_versions_perstage(name))
+    if has_batch_reads(stage):
+        # reads the versiondata for all linkstores at once
+        stage.get_versiondata_many_perstage(
+            (name, version) for version in versions)
     result = dict(name=name)
     for i, version in enumerate(versions):
         if i == 0:
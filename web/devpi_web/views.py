@@ -1,6 +1,7 @@
 # coding: utf-8
 from __future__ import unicode_literals
 from defusedxml.xmlrpc import DefusedExpatParser
+from devpi_common.metadata import get_latest_version
 from devpi_common.metadata import get_pyversion_filetype
 from devpi_common.metadata import get_sorted_versions
 from devpi_common.validation import normalize_name
@@ -391,9 +392,7 @@ def index_get(context, request):
                 special=special,
                 users=users))
 
-    for project in stage.list_projects_perstage():
-        version = stage.get_latest_version_perstage(project)
-        verdata = stage.get_versiondata_perstage(project, version)
+    for project, verdata in get_latest_versiondata_perstage(stage):
         try:
             name, ver = normalize_name(verdata["name"]), verdata["version"]
         except KeyError:
@@ -421,6 +420,23 @@ def index_get(context, request):
     return result
 
 
+def get_latest_versiondata_perstage(stage):
+    """ return list of (project, versiondata) tuples with the versiondata
+    of the latest version of each project of the stage. """
+    projects = list(stage.list_projects_perstage())
+    if not hasattr(stage, "get_versiondata_many_perstage"):
+        # devpi-server without batch reads
+        return [
+            (project, stage.get_versiondata_perstage(
+                project, stage.get_latest_version_perstage(project)))
+            for project in projects]
+    versions = [
+        get_latest_version(x)
+        for x in stage.list_versions_many_perstage(projects)]
+    return list(zip(projects, stage.get_versiondata_many_perstage(
+        zip(projects, versions))))
+
+
 @view_config(
     route_name="/{user}/{index}/{project}",
     accept="text/html", request_method="GET",
@@ -0,0 +1,2 @@
+the index page and the search indexing read the version data of all projects
+or versions at once if devpi-server supports it.
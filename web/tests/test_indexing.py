@@ -19,6 +19,44 @@ def test_inheritance(xom):
         preprocess_project(stage, "proj")
 
 
+def test_batch_reads(xom, monkeypatch):
+    with xom.keyfs.transaction(write=True):
+        user = xom.model.create_user("one", "one")
+        stage = user.create_stage("dev")
+        stage.set_versiondata({"name": "proj", "version": "1.0"})
+        stage.set_versiondata({"name": "proj", "version": "1.1"})
+    calls = []
+    with xom.keyfs.transaction():
+        stage = xom.model.getstage(stage.name)
+        get_versiondata_many_perstage = stage.get_versiondata_many_perstage
+        monkeypatch.setattr(
+            stage, "get_versiondata_many_perstage",
+            lambda x: calls.append(x) or get_versiondata_many_perstage(x))
+        result = preprocess_project(stage, "proj")
+    assert result["version"] == "1.1"
+    assert len(calls) == 1
+
+
+def test_mirror_without_batch_reads(pypistage, monkeypatch):
+    pypistage.mock_simple("proj", text=(
+        '<a href="/proj-1.0.zip" /><a href="/proj-1.1.zip" />'))
+    with pypistage.keyfs.transaction(write=True):
+        assert pypistage.list_versions_perstage("proj") == set(["1.0", "1.1"])
+    calls = []
+    get_versiondata_perstage = pypistage.get_versiondata_perstage
+    monkeypatch.setattr(
+        pypistage, "get_versiondata_perstage",
+        lambda *args, **kw: calls.append(args) or get_versiondata_perstage(
+            *args, **kw))
+    with pypistage.keyfs.transaction(write=False):
+        result = preprocess_project(pypistage, "proj")
+    assert result["version"] == "1.1"
+    # the looping default of get_versiondata_many_perstage would
+    # compute the versiondata of every version once more
+    assert sorted(calls) == [
+        ("proj", "1.0"), ("proj", "1.1"), ("proj", "1.1")]
+
+
 @pytest.mark.with_notifier
 def test_doc_unpack_cleanup(mapp, testapp):
     api = mapp.create_and_use()